@@ -1,13 +1,23 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, session
+from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, session, g, has_app_context, Response
 import sqlite3
 import hashlib
-from datetime import datetime, date
+import csv
+import io
+from datetime import datetime, date, timedelta, timezone
 import os
 import json
+import base64
 import re
 import secrets
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from functools import wraps
+from itertools import groupby
 from urllib.parse import urlencode
 import requests
+import click
 print(f"DEBUG: Railway Environment: {os.environ.get('RAILWAY_ENVIRONMENT')}")
 print(f"DEBUG: DATABASE_URL: {'Exists' if os.environ.get('DATABASE_URL') else 'Not Found'}")
 
@@ -23,305 +33,1871 @@ else:
     # Development environment
     app.config['SECRET_KEY'] = 'dev-key-change-in-production'
 
-def get_db():
-    conn = sqlite3.connect(app.config['DATABASE'])
+# ============ CONNECTION POOL ============
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '5'))
+DB_POOL_IDLE_TIMEOUT = float(os.environ.get('DB_POOL_IDLE_TIMEOUT', '300'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '30'))
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', '1') != '0'
+
+# SQLite engine profile (WAL lets report readers run while a posting commits)
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+SQLITE_CACHE_SIZE_KB = int(os.environ.get('SQLITE_CACHE_SIZE_KB', '20000'))
+SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))
+
+def use_postgres():
+    """True when running on Railway (PostgreSQL backend)"""
+    return bool(os.environ.get('RAILWAY_ENVIRONMENT'))
+
+def get_database_url():
+    """DATABASE_URL normalised for psycopg2"""
+    DATABASE_URL = os.environ.get('DATABASE_URL')
+    # Convert postgres:// to postgresql:// for psycopg2
+    if DATABASE_URL and DATABASE_URL.startswith('postgres://'):
+        DATABASE_URL = DATABASE_URL.replace('postgres://', 'postgresql://')
+    return DATABASE_URL
+
+def connect_postgres():
+    """Open a new autocommit PostgreSQL connection"""
+    import psycopg2
+    DATABASE_URL = get_database_url()
+    if not DATABASE_URL:
+        raise RuntimeError("DATABASE_URL environment variable not found!")
+    conn = psycopg2.connect(DATABASE_URL, sslmode='require')
+    # Transactions are opened explicitly, idle pooled connections never sit "idle in transaction"
+    conn.autocommit = True
+    return conn
+
+def connect_sqlite(read_only=False):
+    """Open a new autocommit SQLite connection with the engine profile applied"""
+    conn = sqlite3.connect(app.config['DATABASE'], check_same_thread=False, isolation_level=None,
+                           timeout=SQLITE_BUSY_TIMEOUT_MS / 1000)
     conn.row_factory = sqlite3.Row
+    if not read_only:
+        # Persistent in the database file; only the writer path needs to (re)apply it
+        conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    # ON DELETE CASCADE from journals to their lines and source documents
+    conn.execute("PRAGMA foreign_keys=ON")
+    if read_only:
+        conn.execute("PRAGMA query_only=ON")
+    return conn
+
+def connect_sqlite_reader():
+    """Open a read-only SQLite connection for report routes"""
+    return connect_sqlite(read_only=True)
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection becomes free in time"""
+
+class PoolEntry:
+    """A raw connection plus the bookkeeping the pool keeps for it"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        # Named queries already PREPAREd on this PostgreSQL session
+        self.prepared = set()
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+
+class ConnectionPool:
+    """Thread-safe pool of reusable connections, private to one worker process"""
+
+    def __init__(self, connect, max_size=DB_POOL_MAX_SIZE, idle_timeout=DB_POOL_IDLE_TIMEOUT,
+                 pre_ping=DB_POOL_PRE_PING, read_only=False):
+        self.connect = connect
+        self.read_only = read_only
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.pre_ping = pre_ping
+        self._cond = threading.Condition()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = []
+        self._in_use = 0
+        self.stats = {
+            'created': 0,
+            'checkouts': 0,
+            'reused': 0,
+            'expired': 0,
+            'ping_failures': 0,
+            'discarded': 0,
+            'waits': 0,
+            'timeouts': 0,
+        }
+
+    def _check_fork(self):
+        # gunicorn forks after app import: never share sockets with the master process
+        if self._pid != os.getpid():
+            self._reset()
+
+    def acquire(self, timeout=None):
+        """Check out a live connection, waiting up to `timeout` seconds for a free slot"""
+        deadline = time.monotonic() + (DB_POOL_TIMEOUT if timeout is None else timeout)
+        with self._cond:
+            self._check_fork()
+            while not self._idle and self._in_use >= self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.stats['timeouts'] += 1
+                    raise PoolTimeout(f"No database connection available after {timeout or DB_POOL_TIMEOUT}s")
+                self.stats['waits'] += 1
+                self._cond.wait(remaining)
+            self._in_use += 1
+            self.stats['checkouts'] += 1
+            entry = self._idle.pop() if self._idle else None
+
+        try:
+            if entry is not None and time.monotonic() - entry.last_used > self.idle_timeout:
+                self._close(entry)
+                self._count('expired')
+                entry = None
+            if entry is not None and self.pre_ping and not self._ping(entry):
+                self._close(entry)
+                self._count('ping_failures')
+                entry = None
+            if entry is None:
+                entry = PoolEntry(self.connect())
+                self._count('created')
+            else:
+                self._count('reused')
+            return entry
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, entry, discard=False):
+        """Return a connection to the pool, rolling back anything left open"""
+        if not discard:
+            try:
+                if _in_transaction(entry.conn):
+                    entry.conn.rollback()
+            except Exception as e:
+                print(f"DEBUG: Discarding pooled connection: {e}")
+                discard = True
+
+        with self._cond:
+            if self._pid != os.getpid():
+                return
+            self._in_use -= 1
+            if discard or len(self._idle) >= self.max_size:
+                self._close(entry)
+                self.stats['discarded'] += 1
+            else:
+                entry.last_used = time.monotonic()
+                self._idle.append(entry)
+            self._cond.notify()
+
+    def statistics(self):
+        """Snapshot of pool size and counters"""
+        with self._cond:
+            self._check_fork()
+            return dict(self.stats,
+                        max_size=self.max_size,
+                        idle=len(self._idle),
+                        in_use=self._in_use,
+                        read_only=self.read_only,
+                        pid=self._pid)
+
+    def close_all(self):
+        """Close every idle connection"""
+        with self._cond:
+            while self._idle:
+                self._close(self._idle.pop())
+
+    def _ping(self, entry):
+        try:
+            cursor = entry.conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+            cursor.close()
+            return True
+        except Exception as e:
+            print(f"DEBUG: Pool pre-ping failed: {e}")
+            return False
+
+    def _count(self, key):
+        with self._cond:
+            self.stats[key] += 1
+
+    @staticmethod
+    def _close(entry):
+        try:
+            entry.conn.close()
+        except Exception:
+            pass
+
+def _in_transaction(conn):
+    """True when the connection has an open (uncommitted) transaction"""
+    if isinstance(conn, sqlite3.Connection):
+        return conn.in_transaction
+    # psycopg2: anything but TRANSACTION_STATUS_IDLE
+    return conn.get_transaction_status() != 0
+
+class PooledConnection:
+    """Checked-out pool connection; close() hands it back instead of closing the socket"""
+
+    def __init__(self, pool, pinned=False):
+        self.pool = pool
+        self.entry = pool.acquire()
+        # Request-bound connections are returned by teardown, not by close()
+        self.pinned = pinned
+        # Active transaction() on this connection, if any
+        self.transaction = None
+
+    @property
+    def raw(self):
+        return self.entry.conn
+
+    def __getattr__(self, name):
+        return getattr(self.entry.conn, name)
+
+    def close(self):
+        if not self.pinned:
+            self.release()
+
+    def release(self, discard=False):
+        if self.entry is not None:
+            self.pool.release(self.entry, discard=discard)
+            self.entry = None
+
+_pool = None
+_read_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """The (writer) connection pool for this worker"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(connect_postgres if use_postgres() else connect_sqlite)
+    return _pool
+
+def get_read_pool():
+    """Pool of read-only SQLite connections; PostgreSQL readers share the main pool"""
+    global _read_pool
+    if use_postgres():
+        return get_pool()
+    if _read_pool is None:
+        with _pool_lock:
+            if _read_pool is None:
+                _read_pool = ConnectionPool(connect_sqlite_reader, read_only=True)
+    return _read_pool
+
+def read_only_db(view):
+    """Serve a report route from the read-only pool so it never waits on the writer"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.db_read_only = True
+        return view(*args, **kwargs)
+    return wrapper
+
+def get_db():
+    """Pooled connection for the current request (one checkout per request)"""
+    if not has_app_context():
+        # Outside a request (startup, scripts): caller must close() to return it
+        return PooledConnection(get_pool())
+    conn = g.get('db_conn')
+    if conn is None or conn.entry is None:
+        pool = get_read_pool() if g.get('db_read_only') else get_pool()
+        conn = g.db_conn = PooledConnection(pool, pinned=True)
     return conn
 
+@app.teardown_appcontext
+def release_db(exception=None):
+    """Return the request's connection to the pool"""
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        conn.release()
+
 def get_db_connection():
     """Handle both SQLite and PostgreSQL"""
     try:
-        if os.environ.get('RAILWAY_ENVIRONMENT'):
-            # Use PostgreSQL on Railway
-            try:
-                import psycopg2
-                DATABASE_URL = os.environ.get('DATABASE_URL')
-                if DATABASE_URL:
-                    # Convert postgres:// to postgresql:// for psycopg2
-                    if DATABASE_URL.startswith('postgres://'):
-                        DATABASE_URL = DATABASE_URL.replace('postgres://', 'postgresql://')
-                    conn = psycopg2.connect(DATABASE_URL, sslmode='require')
-                    return conn
-                else:
-                    print("DATABASE_URL not found")
-                    return None
-            except ImportError:
-                print("psycopg2 not available, falling back to SQLite")
-                conn = sqlite3.connect('money_hop_full.db')  # Fixed: consistent database name
-                conn.row_factory = sqlite3.Row
-                return conn
-        else:
-            # Development - Use SQLite
-            conn = sqlite3.connect('money_hop_full.db')
-            conn.row_factory = sqlite3.Row
-            return conn
+        return get_db()
     except Exception as e:
         print(f"Database connection error: {e}")
         return None
 
+def fetch_dicts(cursor):
+    """Convert the cursor's result set into a list of dicts"""
+    if not cursor.description:
+        return []
+    columns = [desc[0] for desc in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+# Ad-hoc statements rewritten for PostgreSQL, keyed by their SQLite spelling
+PREPARED_SQL_CACHE_SIZE = int(os.environ.get('PREPARED_SQL_CACHE_SIZE', '2000'))
+_postgres_sql = {}
+
+def prepare_query(query):
+    """Adapt placeholders to the active backend; each statement is rewritten once per worker"""
+    if not use_postgres():
+        # SQLite takes the ? spelling as-is
+        return query
+    prepared = _postgres_sql.get(query)
+    if prepared is None:
+        # Convert SQLite ? to PostgreSQL %s jika perlu
+        prepared = query.replace('?', '%s') if '?' in query and '%s' not in query else query
+        if len(_postgres_sql) >= PREPARED_SQL_CACHE_SIZE:
+            # IN (?, ?, ...) lists make some statements unbounded; start over rather than grow
+            _postgres_sql.clear()
+        _postgres_sql[query] = prepared
+    return prepared
+
 def execute_query(query, params=(), fetch=False, commit=False):
     """Handle both SQLite and PostgreSQL"""
+    conn = None
     try:
-        if os.environ.get('RAILWAY_ENVIRONMENT'):
-            # Use PostgreSQL on Railway - FIXED CONNECTION
-            import psycopg2
-            DATABASE_URL = os.environ.get('DATABASE_URL')
-            
-            if not DATABASE_URL:
-                print("ERROR: DATABASE_URL environment variable not found!")
-                return False
-            
-            # Connect menggunakan DATABASE_URL langsung
-            conn = psycopg2.connect(DATABASE_URL, sslmode='require')
-            cursor = conn.cursor()
-            
-            # Convert SQLite ? to PostgreSQL %s jika perlu
-            if '?' in query and '%s' not in query:
-                query = query.replace('?', '%s')
-            
+        conn = get_db()
+        cursor = conn.cursor()
+        query = prepare_query(query)
+
+        if use_postgres():
             print(f"DEBUG: Executing query: {query} with params: {params}")
-            cursor.execute(query, params)
-            
-            if commit:
+
+        cursor.execute(query, params)
+
+        if commit:
+            # Inside transaction() the unit of work decides when to commit
+            if conn.transaction is None:
                 conn.commit()
-                print("DEBUG: Commit successful")
-                return True
-            elif fetch:
-                # For PostgreSQL, convert to dict-like structure
-                if cursor.description:
-                    columns = [desc[0] for desc in cursor.description]
-                    results = cursor.fetchall()
-                    print(f"DEBUG: Fetch results: {results}")
-                    return [dict(zip(columns, row)) for row in results]
-                else:
-                    return []
-            else:
-                return True
-                
+            return True
+        elif fetch:
+            return fetch_dicts(cursor)
         else:
-            # Use SQLite for development
-            conn = sqlite3.connect('money_hop_full.db')
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute(query, params)
-            
-            if commit:
-                conn.commit()
-                return True
-            elif fetch:
-                results = cursor.fetchall()
-                return [dict(row) for row in results]
-            else:
-                return True
-                
+            return True
+
     except Exception as e:
         print(f"Database error in execute_query: {e}")
         import traceback
         print(f"Traceback: {traceback.format_exc()}")
         return False
     finally:
-        if 'conn' in locals():
+        if conn is not None:
+            conn.close()
+
+def insert_on_cursor(cursor, query, params=()):
+    """Execute an INSERT on the cursor and return the new row id without a follow-up SELECT"""
+    if use_postgres():
+        cursor.execute(prepare_query(query.rstrip().rstrip(';')) + " RETURNING id", params)
+        return cursor.fetchone()[0]
+    cursor.execute(query, params)
+    return cursor.lastrowid
+
+# ============ TRANSACTIONS ============
+# Rows per multi-row VALUES statement on PostgreSQL
+BULK_PAGE_SIZE = int(os.environ.get('BULK_PAGE_SIZE', '1000'))
+
+class Transaction:
+    """Unit of work: every statement runs on one connection between one BEGIN and COMMIT"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.cursor = conn.cursor()
+
+    def execute(self, query, params=()):
+        """Run a statement and return the affected row count"""
+        self.cursor.execute(prepare_query(query), params)
+        return self.cursor.rowcount
+
+    def fetch(self, query, params=()):
+        """Run a query and return all rows as dicts"""
+        self.cursor.execute(prepare_query(query), params)
+        return fetch_dicts(self.cursor)
+
+    def run(self, name, params=()):
+        """Run a registered query (see QUERY REGISTRY) and return all rows as dicts"""
+        execute_named(self.conn, self.cursor, name, params)
+        return fetch_dicts(self.cursor)
+
+    def fetch_one(self, query, params=()):
+        """Run a query and return the first row (or None)"""
+        rows = self.fetch(query, params)
+        return rows[0] if rows else None
+
+    def insert(self, query, params=()):
+        """Run a single-row INSERT and return its generated id (RETURNING id / lastrowid)"""
+        return insert_on_cursor(self.cursor, query, params)
+
+    def insert_many(self, table, columns, rows, on_conflict=''):
+        """Insert all rows in one statement: executemany on SQLite, multi-row VALUES on PostgreSQL.
+
+        on_conflict is appended verbatim (e.g. an ON CONFLICT ... DO UPDATE upsert clause).
+        """
+        rows = list(rows)
+        if not rows:
+            return 0
+        column_list = ', '.join(columns)
+        if use_postgres():
+            from psycopg2.extras import execute_values
+            execute_values(self.cursor,
+                           f"INSERT INTO {table} ({column_list}) VALUES %s {on_conflict}",
+                           rows,
+                           page_size=BULK_PAGE_SIZE)
+        else:
+            placeholders = ', '.join('?' * len(columns))
+            self.cursor.executemany(f"INSERT INTO {table} ({column_list}) VALUES ({placeholders}) {on_conflict}", rows)
+        return len(rows)
+
+@contextmanager
+def transaction():
+    """BEGIN on the request's connection, COMMIT on success, ROLLBACK on any exception.
+
+    Nested calls join the outer unit of work, so helpers can be composed freely.
+    SQLite writers take the write lock up front (BEGIN IMMEDIATE): a busy writer is
+    waited out via busy_timeout instead of failing with "database is locked" on upgrade.
+    """
+    conn = get_db()
+    if conn.transaction is not None:
+        yield conn.transaction
+        return
+
+    tx = Transaction(conn)
+    try:
+        immediate = not use_postgres() and not conn.pool.read_only
+        tx.cursor.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        conn.transaction = tx
+        yield tx
+        tx.cursor.execute("COMMIT")
+    except BaseException:
+        try:
+            tx.cursor.execute("ROLLBACK")
+        except Exception as rollback_error:
+            print(f"DEBUG: Rollback failed: {rollback_error}")
+            conn.release(discard=True)
+        raise
+    finally:
+        conn.transaction = None
+        conn.close()
+
+# ============ QUERY REGISTRY ============
+# Server-side prepared statements on PostgreSQL (turn off behind a transaction-mode pgbouncer)
+DB_PREPARED_STATEMENTS = os.environ.get('DB_PREPARED_STATEMENTS', '1') != '0'
+
+# Dialect-specific SQL spelled as {names} in registered queries
+SQL_DIALECT = {
+    'sqlite': {'journal_month': "substr(j.date, 1, 7)"},
+    'postgres': {'journal_month': "to_char(j.date, 'YYYY-MM')"},
+}
+
+class NamedQuery:
+    """A hot query declared once with ? placeholders and compiled for the active backend"""
+
+    def __init__(self, name, sql):
+        self.name = name
+        self.sql = sql
+        self.execute_sql = None
+        self.direct_sql = None
+        self.prepare_sql = None
+
+    def compile(self, dialect):
+        sql = ' '.join(self.sql.format(**SQL_DIALECT[dialect]).split())
+        if dialect == 'postgres':
+            params = sql.count('?')
+            numbered = iter(range(1, params + 1))
+            self.prepare_sql = f"PREPARE {self.name} AS " + re.sub(r'\?', lambda m: f"${next(numbered)}", sql)
+            self.execute_sql = f"EXECUTE {self.name}" + (f" ({', '.join(['%s'] * params)})" if params else "")
+            # Fallback when prepared statements are disabled; literal % must be escaped for psycopg2
+            self.direct_sql = sql.replace('%', '%%').replace('?', '%s')
+        else:
+            # sqlite3 keeps compiled statements in its per-connection statement cache
+            self.execute_sql = self.direct_sql = sql
+
+QUERIES = {}
+
+def register_query(name, sql):
+    """Declare a named query (compiled by compile_queries at startup)"""
+    QUERIES[name] = NamedQuery(name, sql)
+
+def compile_queries():
+    """Compile every registered query for the active backend"""
+    dialect = db_dialect()
+    for query in QUERIES.values():
+        query.compile(dialect)
+
+def execute_named(conn, cursor, name, params=()):
+    """Run a registered query on the cursor, preparing it once per pooled connection"""
+    query = QUERIES[name]
+    if not use_postgres() or not DB_PREPARED_STATEMENTS:
+        cursor.execute(query.direct_sql, params)
+        return
+    if name not in conn.entry.prepared:
+        cursor.execute(query.prepare_sql)
+        conn.entry.prepared.add(name)
+    cursor.execute(query.execute_sql, params)
+
+def run_query(name, params=()):
+    """Fetch the rows of a registered query as dicts (False on error, like execute_query)"""
+    conn = None
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        execute_named(conn, cursor, name, params)
+        return fetch_dicts(cursor)
+    except Exception as e:
+        print(f"Database error in run_query({name}): {e}")
+        import traceback
+        print(f"Traceback: {traceback.format_exc()}")
+        return False
+    finally:
+        if conn is not None:
             conn.close()
 
+register_query('chart_of_accounts', """
+    SELECT code, name, type, normal_balance FROM accounts ORDER BY code
+""")
+register_query('catalog_version', """
+    SELECT version FROM cache_versions WHERE name = 'chart_of_accounts'
+""")
+register_query('account_totals', """
+    SELECT account_code, debit_total, credit_total FROM account_balances WHERE user_id = ?
+""")
+register_query('account_total', """
+    SELECT debit_total, credit_total FROM account_balances WHERE user_id = ? AND account_code = ?
+""")
+register_query('period_totals', """
+    SELECT account_code, SUM(debit_total) as debit_total, SUM(credit_total) as credit_total
+    FROM account_period_balances
+    WHERE user_id = ? AND period BETWEEN ? AND ?
+    GROUP BY account_code
+""")
+register_query('account_totals_between', """
+    SELECT jd.account_code, SUM(jd.debit) as debit_total, SUM(jd.credit) as credit_total
+    FROM journals j
+    JOIN journal_details jd ON jd.journal_id = j.id
+    WHERE j.user_id = ? AND j.date BETWEEN ? AND ?
+    GROUP BY jd.account_code
+""")
+register_query('latest_snapshot_period', """
+    SELECT MAX(period) as period FROM account_balance_snapshots WHERE user_id = ? AND period <= ?
+""")
+register_query('snapshot_totals', """
+    SELECT account_code, debit_total, credit_total FROM account_balance_snapshots WHERE user_id = ? AND period = ?
+""")
+register_query('latest_closed_period', """
+    SELECT MAX(period) as period FROM closed_periods WHERE user_id = ? AND period <= ?
+""")
+register_query('closed_period_totals', """
+    SELECT account_code, debit_total, credit_total FROM closed_period_balances WHERE user_id = ? AND period = ?
+""")
+# History pages: keyset on (date, number) DESC, served by the (user_id, date, number) indexes
+register_query('document_sequence', """
+    SELECT next_value, row_count FROM document_sequences WHERE user_id = ? AND doc_type = ?
+""")
+register_query('journal_page', """
+    SELECT j.id, j.entry_no, j.date, j.description
+    FROM journals j
+    WHERE j.user_id = ? AND (j.date, j.entry_no) < (?, ?)
+    ORDER BY j.date DESC, j.entry_no DESC
+    LIMIT ?
+""")
+register_query('closing_journal_page', """
+    SELECT j.id, j.entry_no, j.date, j.description
+    FROM journals j
+    WHERE j.user_id = ? AND (j.date, j.entry_no) < (?, ?) AND j.description LIKE '[PENUTUP]%'
+    ORDER BY j.date DESC, j.entry_no DESC
+    LIMIT ?
+""")
+register_query('adjusting_journal_page', """
+    SELECT aj.entry_no, aj.date, aj.description, aj.total_debit, aj.total_credit
+    FROM adjusting_journals aj
+    WHERE aj.user_id = ? AND (aj.date, aj.entry_no) < (?, ?)
+    ORDER BY aj.date DESC, aj.entry_no DESC
+    LIMIT ?
+""")
+register_query('cash_payment_page', """
+    SELECT cp.payment_no, cp.date, cp.description, a.name as account_name, cp.amount
+    FROM cash_payments cp
+    JOIN accounts a ON cp.account_code = a.code
+    WHERE cp.user_id = ? AND (cp.date, cp.payment_no) < (?, ?)
+    ORDER BY cp.date DESC, cp.payment_no DESC
+    LIMIT ?
+""")
+register_query('cash_receipt_page', """
+    SELECT cr.receipt_no, cr.date, cr.description, a.name as account_name, cr.amount
+    FROM cash_receipts cr
+    JOIN accounts a ON cr.account_code = a.code
+    WHERE cr.user_id = ? AND (cr.date, cr.receipt_no) < (?, ?)
+    ORDER BY cr.date DESC, cr.receipt_no DESC
+    LIMIT ?
+""")
+# Params: opening balance, balance sign, user, account, cursor date, date_to, (date, entry_no, line id) cursor, limit.
+# Driven by the account side (ix_journal_details_user_account_date), so a page reads only the
+# account's lines; the window runs over the limited page only, on top of the page's opening balance.
+register_query('ledger_page', """
+    SELECT page.date, page.entry_no, page.description, page.line_id, page.debit, page.credit,
+           ? + SUM((page.debit - page.credit) * ?) OVER (
+               ORDER BY page.date, page.entry_no, page.line_id ROWS UNBOUNDED PRECEDING
+           ) as balance
+    FROM (
+        SELECT jd.date, j.entry_no, j.description, jd.id as line_id, jd.debit, jd.credit
+        FROM journal_details jd
+        JOIN journals j ON j.id = jd.journal_id
+        WHERE jd.user_id = ? AND jd.account_code = ? AND jd.date >= ? AND jd.date <= ?
+          AND (jd.date, j.entry_no, jd.id) > (?, ?, ?)
+        ORDER BY jd.date, j.entry_no, jd.id
+        LIMIT ?
+    ) page
+    ORDER BY page.date, page.entry_no, page.line_id
+""")
+
+# Full-range exports, streamed in date order (see EXPORT)
+register_query('export_journal_lines', """
+    SELECT j.entry_no, j.date, j.description, jd.account_code, jd.debit, jd.credit
+    FROM journals j
+    JOIN journal_details jd ON jd.journal_id = j.id
+    WHERE j.user_id = ? AND j.date >= ? AND j.date <= ?
+    ORDER BY j.date, j.entry_no, jd.id
+""")
+register_query('export_ledger_lines', """
+    SELECT j.date, j.entry_no, j.description, jd.debit, jd.credit
+    FROM journals j
+    JOIN journal_details jd ON jd.journal_id = j.id
+    WHERE j.user_id = ? AND jd.account_code = ? AND j.date >= ? AND j.date <= ?
+    ORDER BY j.date, j.entry_no, jd.id
+""")
+
+# ============ JOURNAL WRITER ============
+# user_id and date are copied from the journal so that ledgers can be read from the account side
+JOURNAL_LINE_COLUMNS = ('journal_id', 'account_code', 'debit', 'credit', 'user_id', 'date')
+CASH_ACCOUNT = '1-1000'
+
+# Maintenance run for every batch of journal lines written (sign=1) or removed (sign=-1)
+POSTING_HOOKS = []
+
+def posting_hook(func):
+    """Register func(tx, user_id, lines, sign); lines are (account_code, debit, credit, journal_date[, line_count])"""
+    POSTING_HOOKS.append(func)
+    return func
+
+def run_posting_hooks(tx, user_id, lines, sign=1):
+    """Apply every posting hook to one batch of lines in the caller's transaction"""
+    lines = list(lines)
+    for hook in POSTING_HOOKS:
+        hook(tx, user_id, lines, sign)
+    return len(lines)
+
+def insert_journal_header(tx, entry_no, date, description, user_id):
+    """Insert a journals row and return its id"""
+    journal_id = tx.insert(
+        "INSERT INTO journals (entry_no, date, description, user_id) VALUES (?, ?, ?, ?)",
+        (entry_no, date, description, user_id)
+    )
+    count_documents(tx, user_id, 'journal', 1, [entry_no])
+    return journal_id
+
+def insert_journal_lines(tx, lines, user_id, journal_date):
+    """Write (journal_id, account_code, debit, credit) lines of one or many journals in one statement.
+
+    The posting hooks (balances, month rollup, snapshots) run in the same transaction.
+    """
+    lines = list(lines)
+    tx.insert_many('journal_details', JOURNAL_LINE_COLUMNS, [line + (user_id, journal_date) for line in lines])
+    return run_posting_hooks(tx, user_id, [(line[1], line[2], line[3], journal_date) for line in lines])
+
+def post_journal(tx, user_id, entry_no, journal_date, description, lines, source=None):
+    """Post one balanced journal in the caller's transaction and return its id.
+
+    lines are (account_code, debit, credit); lines without an account or amount are dropped.
+    Without an entry_no the next number of the user's journal sequence is used.
+    source is an optional (table, {column: value}) document row, written with the new
+    journal_id so that deleting the journal cascades to it; document, journal and
+    balance hooks commit or roll back as one unit.
+    """
+    lines = [(account_code, float(debit or 0), float(credit or 0))
+             for account_code, debit, credit in lines if account_code and (debit or credit)]
+    total_debit = sum(line[1] for line in lines)
+    total_credit = sum(line[2] for line in lines)
+    if not lines:
+        raise ValueError('Jurnal harus memiliki minimal satu baris')
+    if abs(total_debit - total_credit) > 0.01:
+        raise ValueError(f'Total debit ({total_debit:,.2f}) dan kredit ({total_credit:,.2f}) harus seimbang!')
+    
+    entry_no = entry_no or reserve_document_number(tx, user_id, 'journal')
+    journal_id = insert_journal_header(tx, entry_no, journal_date, description, user_id)
+    if source is not None:
+        table, row = source
+        row = dict(row, journal_id=journal_id)
+        tx.execute(f"INSERT INTO {table} ({', '.join(row)}) VALUES ({', '.join('?' * len(row))})",
+                   tuple(row.values()))
+    insert_journal_lines(tx, [(journal_id,) + line for line in lines], user_id, journal_date)
+    return journal_id
+
+# Cash documents: source table, number column, journal entry prefix, description label, Kas side
+CASH_DOCUMENTS = {
+    'cash_payment': {'table': 'cash_payments', 'number': 'payment_no', 'prefix': 'CP',
+                     'label': 'Cash Payment', 'cash_debit': False},
+    'cash_receipt': {'table': 'cash_receipts', 'number': 'receipt_no', 'prefix': 'CR',
+                     'label': 'Cash Receipt', 'cash_debit': True},
+}
+
+def post_cash_document(tx, user_id, kind, number, journal_date, description, account_code, amount):
+    """Post a cash payment or receipt: the document row plus its two-line Kas journal.
+
+    Without a number the next one of the user's payment/receipt sequence is used.
+    """
+    document = CASH_DOCUMENTS[kind]
+    number = number or reserve_document_number(tx, user_id, kind)
+    count_documents(tx, user_id, kind, 1, [number])
+    if document['cash_debit']:
+        lines = [(CASH_ACCOUNT, amount, 0), (account_code, 0, amount)]
+    else:
+        lines = [(CASH_ACCOUNT, 0, amount), (account_code, amount, 0)]
+    return post_journal(tx, user_id, f"{document['prefix']}{number}", journal_date,
+                        f"{document['label']}: {description}", lines,
+                        source=(document['table'], {
+                            document['number']: number,
+                            'date': journal_date,
+                            'description': description,
+                            'account_code': account_code,
+                            'amount': amount,
+                            'user_id': user_id,
+                        }))
+
+def delete_journals(tx, user_id, journal_ids):
+    """Reverse and delete journals with a few set-based statements; returns the journals deleted.
+
+    The lines are reversed as one per-account, per-date aggregate through the posting
+    hooks; journal_details and linked cash documents go with the journals (ON DELETE CASCADE).
+    """
+    journal_ids = tuple(journal_ids)
+    if not journal_ids:
+        return 0
+    placeholders = ', '.join('?' * len(journal_ids))
+    totals = tx.fetch(f"""
+        SELECT jd.account_code, j.date, SUM(jd.debit) as debit, SUM(jd.credit) as credit, COUNT(*) as line_count
+        FROM journals j
+        JOIN journal_details jd ON jd.journal_id = j.id
+        WHERE j.user_id = ? AND j.id IN ({placeholders})
+        GROUP BY jd.account_code, j.date
+    """, (user_id,) + journal_ids)
+    run_posting_hooks(tx, user_id, [(row['account_code'], row['debit'], row['credit'], row['date'], row['line_count'])
+                                    for row in totals], sign=-1)
+    for kind, document in CASH_DOCUMENTS.items():
+        linked = tx.fetch_one(f"SELECT COUNT(*) as count FROM {document['table']} WHERE journal_id IN ({placeholders})",
+                              journal_ids)['count']
+        if linked:
+            count_documents(tx, user_id, kind, -linked)
+    deleted = tx.execute(f"DELETE FROM journals WHERE user_id = ? AND id IN ({placeholders})", (user_id,) + journal_ids)
+    count_documents(tx, user_id, 'journal', -deleted)
+    return deleted
+
+def delete_cash_document(tx, user_id, kind, number):
+    """Delete a cash payment or receipt together with its journal; False when it does not exist"""
+    document = CASH_DOCUMENTS[kind]
+    row = tx.fetch_one(f"SELECT id, journal_id FROM {document['table']} WHERE {document['number']} = ? AND user_id = ?",
+                       (number, user_id))
+    if row is None:
+        return False
+    if row['journal_id'] is None:
+        # Not linked (yet): find the journal post_cash_document wrote for it and link it,
+        # so deleting the journal reverses its postings and cascades to the document
+        journal = tx.fetch_one("SELECT id FROM journals WHERE user_id = ? AND entry_no = ?",
+                               (user_id, f"{document['prefix']}{number}"))
+        if journal is not None:
+            tx.execute(f"UPDATE {document['table']} SET journal_id = ? WHERE id = ?", (journal['id'], row['id']))
+            row['journal_id'] = journal['id']
+    if row['journal_id'] is not None:
+        delete_journals(tx, user_id, [row['journal_id']])
+    else:
+        # Journal already gone: only the document is left
+        tx.execute(f"DELETE FROM {document['table']} WHERE id = ?", (row['id'],))
+        count_documents(tx, user_id, kind, -1)
+    return True
+
+def post_adjusting_entry(tx, user_id, entry_no, journal_date, description, lines):
+    """Post an adjusting journal: header, (account_code, debit, credit) entries and account balances.
+
+    Without an entry_no the next number of the user's adjusting sequence is used.
+    Raises PeriodLocked when the date falls into a closed period, like post_journal.
+    """
+    check_period_open(tx, user_id, [journal_date])
+    entry_no = entry_no or reserve_document_number(tx, user_id, 'adjusting')
+    tx.execute(
+        """INSERT INTO adjusting_journals 
+           (entry_no, date, description, total_debit, total_credit, user_id) 
+           VALUES (?, ?, ?, ?, ?, ?)""",
+        (entry_no, journal_date, description, sum(line[1] for line in lines), sum(line[2] for line in lines), user_id)
+    )
+    count_documents(tx, user_id, 'adjusting', 1, [entry_no])
+    tx.insert_many('adjusting_entries', ('entry_no', 'account_code', 'debit', 'credit', 'user_id'),
+                   [(entry_no, account_code, debit, credit, user_id) for account_code, debit, credit in lines])
+    tx.cursor.executemany(prepare_query("UPDATE accounts SET balance = balance + ? - ? WHERE code = ? AND user_id = ?"),
+                          [(debit, credit, account_code, user_id) for account_code, debit, credit in lines])
+
+def delete_adjusting_journal(tx, user_id, entry_no):
+    """Reverse and delete an adjusting journal; False when it does not exist.
+
+    Raises PeriodLocked when the journal lies in a closed period.
+    """
+    header = tx.fetch_one("SELECT date FROM adjusting_journals WHERE entry_no = ? AND user_id = ?", (entry_no, user_id))
+    if header is None:
+        return False
+    check_period_open(tx, user_id, [header['date']])
+    # Reverse saldo akun: one grouped UPDATE over the entries being deleted
+    tx.execute(
+        """UPDATE accounts 
+           SET balance = balance - (
+               SELECT SUM(ae.debit) - SUM(ae.credit) FROM adjusting_entries ae
+               WHERE ae.entry_no = ? AND ae.user_id = ? AND ae.account_code = accounts.code
+           )
+           WHERE user_id = ? AND code IN (
+               SELECT account_code FROM adjusting_entries WHERE entry_no = ? AND user_id = ?
+           )""",
+        (entry_no, user_id, user_id, entry_no, user_id)
+    )
+    tx.execute("DELETE FROM adjusting_entries WHERE entry_no = ? AND user_id = ?", (entry_no, user_id))
+    tx.execute("DELETE FROM adjusting_journals WHERE entry_no = ? AND user_id = ?", (entry_no, user_id))
+    count_documents(tx, user_id, 'adjusting', -1)
+    return True
+
+# ============ IDEMPOTENCY ============
+# Posting routes accept an Idempotency-Key header (the HTML forms send a fresh
+# idempotency_key field per page); a retry with the same key replays the stored result.
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+IDEMPOTENCY_KEY_TTL_DAYS = int(os.environ.get('IDEMPOTENCY_KEY_TTL_DAYS', '30'))
+
+class IdempotencyConflict(Exception):
+    """Raised when an idempotency key is reused for a different request"""
+
+def request_idempotency_key():
+    """The request's idempotency key, or None when the client sent none"""
+    key = (request.headers.get(IDEMPOTENCY_HEADER) or request.form.get('idempotency_key') or '').strip()
+    return key[:100] or None
+
+def upload_digest(upload):
+    """SHA-256 of an uploaded file's bytes; the stream is rewound so the view still reads it all"""
+    digest = hashlib.sha256()
+    for block in iter(lambda: upload.stream.read(64 * 1024), b''):
+        digest.update(block)
+    upload.stream.seek(0)
+    return digest.hexdigest()
+
+def request_fingerprint():
+    """Hash of the endpoint and payload, so a key cannot replay a different request"""
+    if request.is_json:
+        payload = request.get_data()
+    else:
+        # Form fields and file contents rather than the raw body: multipart boundaries change on every resubmit
+        payload = json.dumps([sorted(request.form.items(multi=True)),
+                              sorted((name, upload.filename, upload_digest(upload))
+                                     for name, upload in request.files.items(multi=True))]).encode()
+    return hashlib.sha256(request.endpoint.encode() + b'\0' + payload).hexdigest()
+
+def idempotent_post(tx, user_id, post):
+    """Run post() (which returns a JSON-serialisable result) at most once per idempotency key.
+
+    The key is claimed with the first statement of the caller's transaction, so it commits
+    or rolls back together with the posting: a failed attempt leaves no key behind, and a
+    concurrent retry waits on the key's unique index until the first attempt finishes.
+    Returns (result, replayed).
+    """
+    key = request_idempotency_key()
+    if key is None:
+        return post(), False
+    fingerprint = request_fingerprint()
+    claimed = tx.execute("""
+        INSERT INTO idempotency_keys (user_id, idem_key, request_hash, response) VALUES (?, ?, ?, '')
+        ON CONFLICT (user_id, idem_key) DO NOTHING
+    """, (user_id, key, fingerprint))
+    if not claimed:
+        stored = tx.fetch_one("SELECT request_hash, response FROM idempotency_keys WHERE user_id = ? AND idem_key = ?",
+                              (user_id, key))
+        if stored['request_hash'] != fingerprint:
+            raise IdempotencyConflict(f"Idempotency key '{key}' sudah dipakai untuk request lain")
+        return json.loads(stored['response']), True
+    result = post()
+    tx.execute("UPDATE idempotency_keys SET response = ? WHERE user_id = ? AND idem_key = ?",
+               (json.dumps(result), user_id, key))
+    return result, False
+
+@app.cli.command('purge-idempotency-keys')
+@click.option('--days', type=int, default=IDEMPOTENCY_KEY_TTL_DAYS, help='Keep keys newer than this many days')
+def purge_idempotency_keys_command(days):
+    """Delete idempotency keys older than --days (retries after that post again)."""
+    # created_at defaults to CURRENT_TIMESTAMP, which is UTC
+    cutoff = datetime.now(timezone.utc) - timedelta(days=days)
+    with transaction() as tx:
+        rows = tx.execute("DELETE FROM idempotency_keys WHERE created_at < ?", (cutoff.strftime('%Y-%m-%d %H:%M:%S'),))
+    click.echo(f"Purged {rows} idempotency keys")
+
+# ============ DOCUMENT SEQUENCES ============
+# Per-user number sequences and document counts, replacing COUNT(*) scans on every form
+DOCUMENT_SEQUENCES = {
+    'journal': {'table': 'journals', 'number': 'entry_no', 'prefix': 'J'},
+    'adjusting': {'table': 'adjusting_journals', 'number': 'entry_no', 'prefix': 'AJ'},
+    'cash_payment': {'table': 'cash_payments', 'number': 'payment_no', 'prefix': 'CP'},
+    'cash_receipt': {'table': 'cash_receipts', 'number': 'receipt_no', 'prefix': 'CR'},
+}
+
+def document_number_value(doc_type, number):
+    """Sequence value a document number uses: 41 for 'J041', 0 when it is not in the sequence's format"""
+    prefix = DOCUMENT_SEQUENCES[doc_type]['prefix']
+    number = str(number or '')
+    suffix = number[len(prefix):]
+    return int(suffix) if number.startswith(prefix) and suffix.isdigit() else 0
+
+def format_document_number(doc_type, value):
+    return f"{DOCUMENT_SEQUENCES[doc_type]['prefix']}{value:03d}"
+
+def peek_document_number(user_id, doc_type):
+    """Number the next posting without one would get, and the user's document count; reads only.
+
+    Forms show it as a suggestion: the number itself is taken by reserve_document_number
+    when the document is posted, so page views never use up (or lock) the sequence.
+    """
+    rows = run_query('document_sequence', (user_id, doc_type))
+    row = rows[0] if rows else {'next_value': 1, 'row_count': 0}
+    return format_document_number(doc_type, row['next_value']), row['row_count']
+
+def reserve_document_number(tx, user_id, doc_type):
+    """Take the next number of the user's sequence in the posting transaction"""
+    tx.execute("""
+        INSERT INTO document_sequences (user_id, doc_type, next_value, row_count) VALUES (?, ?, 2, 0)
+        ON CONFLICT (user_id, doc_type) DO UPDATE SET next_value = document_sequences.next_value + 1
+    """, (user_id, doc_type))
+    row = tx.fetch_one("SELECT next_value - 1 as value FROM document_sequences WHERE user_id = ? AND doc_type = ?",
+                       (user_id, doc_type))
+    return format_document_number(doc_type, row['value'])
+
+def count_documents(tx, user_id, doc_type, delta, numbers=()):
+    """Keep the user's document count in step with an insert (delta > 0) or delete (delta < 0).
+
+    The sequence is moved past any of `numbers` typed by hand, so it never offers a taken number.
+    """
+    next_value = max((document_number_value(doc_type, number) for number in numbers), default=0) + 1
+    tx.execute("""
+        INSERT INTO document_sequences (user_id, doc_type, next_value, row_count) VALUES (?, ?, ?, ?)
+        ON CONFLICT (user_id, doc_type) DO UPDATE SET
+            row_count = document_sequences.row_count + excluded.row_count,
+            next_value = CASE WHEN excluded.next_value > document_sequences.next_value
+                              THEN excluded.next_value ELSE document_sequences.next_value END
+    """, (user_id, doc_type, next_value, delta))
+
+# ============ ACCOUNT BALANCES ============
+def invalidate_request_balances():
+    """Drop the request's cached balances after a posting changed them"""
+    if has_app_context():
+        g.pop('account_balances', None)
+
+def period_of(journal_date):
+    """Rollup period key ('YYYY-MM') of a journal date (string or date)"""
+    return str(journal_date)[:7]
+
+@posting_hook
+def apply_balance_deltas(tx, user_id, lines, sign=1):
+    """Add (sign=1) or remove (sign=-1) (account_code, debit, credit, journal_date[, line_count]) lines.
+
+    line_count (default 1) lets callers pass lines already grouped per account and date.
+
+    account_balances and the account_period_balances month rollup each take one upsert;
+    existing balance snapshots at or after the lines' months are adjusted as well.
+    Raises PeriodLocked when a line falls into a closed period.
+    """
+    lines = list(lines)
+    check_period_open(tx, user_id, [line[3] for line in lines])
+    invalidate_request_balances()
+    totals = {}
+    period_totals = {}
+    for account_code, debit, credit, journal_date, *line_count in lines:
+        for total in (totals.setdefault(account_code, [0.0, 0.0, 0]),
+                      period_totals.setdefault((account_code, period_of(journal_date)), [0.0, 0.0, 0])):
+            total[0] += float(debit or 0)
+            total[1] += float(credit or 0)
+            total[2] += int(line_count[0]) if line_count else 1
+    
+    tx.insert_many(
+        'account_period_balances',
+        ('user_id', 'account_code', 'period', 'debit_total', 'credit_total', 'line_count'),
+        [(user_id, account_code, period, sign * debit, sign * credit, sign * count)
+         for (account_code, period), (debit, credit, count) in period_totals.items()],
+        on_conflict="""ON CONFLICT (user_id, account_code, period) DO UPDATE SET
+            debit_total = account_period_balances.debit_total + excluded.debit_total,
+            credit_total = account_period_balances.credit_total + excluded.credit_total,
+            line_count = account_period_balances.line_count + excluded.line_count"""
+    )
+    adjust_balance_snapshots(tx, user_id, period_totals, sign)
+    ensure_balance_snapshots(tx, user_id)
+    return tx.insert_many(
+        'account_balances',
+        ('user_id', 'account_code', 'debit_total', 'credit_total', 'line_count'),
+        [(user_id, account_code, sign * debit, sign * credit, sign * count)
+         for account_code, (debit, credit, count) in totals.items()],
+        on_conflict="""ON CONFLICT (user_id, account_code) DO UPDATE SET
+            debit_total = account_balances.debit_total + excluded.debit_total,
+            credit_total = account_balances.credit_total + excluded.credit_total,
+            line_count = account_balances.line_count + excluded.line_count"""
+    )
+
+def rebuild_account_balances(tx, user_id=None):
+    """Recompute account_balances from journal_details (every user, or just one)"""
+    invalidate_request_balances()
+    user_filter = "WHERE j.user_id = ?" if user_id is not None else ""
+    params = (user_id,) if user_id is not None else ()
+    tx.execute("DELETE FROM account_balances" + (" WHERE user_id = ?" if user_id is not None else ""), params)
+    return tx.execute(f"""
+        INSERT INTO account_balances (user_id, account_code, debit_total, credit_total, line_count)
+        SELECT j.user_id, jd.account_code, COALESCE(SUM(jd.debit), 0), COALESCE(SUM(jd.credit), 0), COUNT(*)
+        FROM journal_details jd
+        JOIN journals j ON jd.journal_id = j.id
+        {user_filter}
+        GROUP BY j.user_id, jd.account_code
+    """, params)
+
+def rebuild_period_balances(tx, user_id=None):
+    """Recompute the account_period_balances month rollup from journal_details.
+
+    Snapshots are derived from the rollup; call rebuild_balance_snapshots afterwards.
+    """
+    invalidate_request_balances()
+    user_filter = "WHERE j.user_id = ?" if user_id is not None else ""
+    params = (user_id,) if user_id is not None else ()
+    tx.execute("DELETE FROM account_period_balances" + (" WHERE user_id = ?" if user_id is not None else ""), params)
+    return tx.execute(f"""
+        INSERT INTO account_period_balances (user_id, account_code, period, debit_total, credit_total, line_count)
+        SELECT j.user_id, jd.account_code, {SQL_DIALECT[db_dialect()]['journal_month']},
+               COALESCE(SUM(jd.debit), 0), COALESCE(SUM(jd.credit), 0), COUNT(*)
+        FROM journal_details jd
+        JOIN journals j ON jd.journal_id = j.id
+        {user_filter}
+        GROUP BY j.user_id, jd.account_code, {SQL_DIALECT[db_dialect()]['journal_month']}
+    """, params)
+
+def verify_account_balances(user_id=None):
+    """Compare account_balances with the ledger; returns a list of mismatching rows"""
+    user_filter = "WHERE j.user_id = ?" if user_id is not None else ""
+    params = (user_id,) if user_id is not None else ()
+    actual = execute_query(f"""
+        SELECT j.user_id, jd.account_code, COALESCE(SUM(jd.debit), 0) as debit_total,
+               COALESCE(SUM(jd.credit), 0) as credit_total, COUNT(*) as line_count
+        FROM journal_details jd
+        JOIN journals j ON jd.journal_id = j.id
+        {user_filter}
+        GROUP BY j.user_id, jd.account_code
+    """, params, fetch=True) or []
+    stored = execute_query(
+        "SELECT user_id, account_code, debit_total, credit_total, line_count FROM account_balances"
+        + (" WHERE user_id = ?" if user_id is not None else ""),
+        params, fetch=True
+    ) or []
+    
+    empty = {'debit_total': 0, 'credit_total': 0, 'line_count': 0}
+    actual_by_key = {(row['user_id'], row['account_code']): row for row in actual}
+    stored_by_key = {(row['user_id'], row['account_code']): row for row in stored}
+    mismatches = []
+    for key in sorted(set(actual_by_key) | set(stored_by_key), key=str):
+        expected = actual_by_key.get(key, empty)
+        found = stored_by_key.get(key, empty)
+        if (abs(float(expected['debit_total']) - float(found['debit_total'])) > 0.005
+                or abs(float(expected['credit_total']) - float(found['credit_total'])) > 0.005
+                or int(expected['line_count']) != int(found['line_count'])):
+            mismatches.append({'user_id': key[0], 'account_code': key[1], 'expected': dict(expected), 'stored': dict(found)})
+    return mismatches
+
+@app.cli.command('rebuild-balances')
+@click.option('--user', 'user_id', type=int, default=None, help='Only rebuild this user')
+def rebuild_balances_command(user_id):
+    """Recompute account_balances from the journal lines."""
+    with transaction() as tx:
+        rows = rebuild_account_balances(tx, user_id)
+    click.echo(f"Rebuilt {rows} account balance rows")
+
+@app.cli.command('backfill-period-balances')
+@click.option('--user', 'user_id', type=int, default=None, help='Only backfill this user')
+def backfill_period_balances_command(user_id):
+    """Recompute the monthly rollup and balance snapshots from the journal lines."""
+    with transaction() as tx:
+        rows = rebuild_period_balances(tx, user_id)
+        snapshots = rebuild_balance_snapshots(tx, user_id)
+    click.echo(f"Backfilled {rows} monthly balance rows and {snapshots} snapshot rows")
+
+@app.cli.command('verify-balances')
+@click.option('--user', 'user_id', type=int, default=None, help='Only verify this user')
+def verify_balances_command(user_id):
+    """Check account_balances against the journal lines."""
+    mismatches = verify_account_balances(user_id)
+    for mismatch in mismatches:
+        click.echo(f"user {mismatch['user_id']} {mismatch['account_code']}: "
+                   f"stored {mismatch['stored']} != ledger {mismatch['expected']}")
+    click.echo("Account balances OK" if not mismatches else f"{len(mismatches)} mismatching balances")
+    if mismatches:
+        raise SystemExit(1)
+
+# ============ BALANCE SNAPSHOTS ============
+# Cumulative per-account totals at every N-th month end (default: quarter ends).
+# An as-of balance is the nearest snapshot plus at most N-1 rollup months and one partial month.
+SNAPSHOT_INTERVAL_MONTHS = int(os.environ.get('SNAPSHOT_INTERVAL_MONTHS', '3'))
+
+def month_end(day):
+    """Last day of the month containing `day`"""
+    return (day.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+
+def period_start(period):
+    """First day of a 'YYYY-MM' period; ValueError for anything else (strptime alone accepts '2024-1')"""
+    day = datetime.strptime(period + '-01', '%Y-%m-%d').date()
+    if period_of(day) != period:
+        raise ValueError(f"Periode harus berformat YYYY-MM: {period}")
+    return day
+
+def is_snapshot_period(period):
+    return int(period[5:7]) % SNAPSHOT_INTERVAL_MONTHS == 0
+
+def snapshot_periods_between(first_period, last_period):
+    """Snapshot boundary periods in [first_period, last_period]"""
+    periods = []
+    day = period_start(first_period)
+    while period_of(day) <= last_period:
+        if is_snapshot_period(period_of(day)):
+            periods.append(period_of(day))
+        day = month_end(day) + timedelta(days=1)
+    return periods
+
+def adjust_balance_snapshots(tx, user_id, period_totals, sign=1):
+    """Carry a posting or delete into every existing snapshot at or after its month"""
+    tx.cursor.executemany(prepare_query("""
+        INSERT INTO account_balance_snapshots (user_id, account_code, period, debit_total, credit_total)
+        SELECT DISTINCT user_id, ?, period, ?, ? FROM account_balance_snapshots
+        WHERE user_id = ? AND period >= ?
+        ON CONFLICT (user_id, account_code, period) DO UPDATE SET
+            debit_total = account_balance_snapshots.debit_total + excluded.debit_total,
+            credit_total = account_balance_snapshots.credit_total + excluded.credit_total
+    """), [(account_code, sign * debit, sign * credit, user_id, period)
+           for (account_code, period), (debit, credit, _) in period_totals.items()])
+
+def ensure_balance_snapshots(tx, user_id):
+    """Write the snapshots of every completed boundary the user does not have yet.
+
+    Boundaries are walked from the user's earliest rollup month, so a back-dated posting
+    before the first snapshot gets the earlier snapshots backfilled as well.
+    """
+    last_closed = period_of(date.today().replace(day=1) - timedelta(days=1))
+    first = tx.fetch_one(
+        "SELECT MIN(period) as period FROM account_period_balances WHERE user_id = ?", (user_id,)
+    )['period']
+    if first is None or first > last_closed:
+        return 0
+    existing = {row['period'] for row in tx.fetch(
+        "SELECT DISTINCT period FROM account_balance_snapshots WHERE user_id = ?", (user_id,)
+    )}
+    
+    created = 0
+    latest = max((period for period in existing if period < first), default=None)
+    for period in snapshot_periods_between(first, last_closed):
+        if period in existing:
+            latest = period
+            continue
+        # Previous snapshot (if any) plus the rollup months since it
+        created += tx.execute("""
+            INSERT INTO account_balance_snapshots (user_id, account_code, period, debit_total, credit_total)
+            SELECT ?, account_code, ?, SUM(debit_total), SUM(credit_total) FROM (
+                SELECT account_code, debit_total, credit_total FROM account_balance_snapshots
+                WHERE user_id = ? AND period = ?
+                UNION ALL
+                SELECT account_code, debit_total, credit_total FROM account_period_balances
+                WHERE user_id = ? AND period > ? AND period <= ?
+            ) changes
+            GROUP BY account_code
+        """, (user_id, period, user_id, latest or '', user_id, latest or '', period))
+        latest = period
+    return created
+
+def rebuild_balance_snapshots(tx, user_id=None):
+    """Drop and recreate the snapshots from the monthly rollup"""
+    tx.execute("DELETE FROM account_balance_snapshots" + (" WHERE user_id = ?" if user_id is not None else ""),
+               (user_id,) if user_id is not None else ())
+    if user_id is not None:
+        user_ids = [user_id]
+    else:
+        user_ids = [row['user_id'] for row in tx.fetch("SELECT DISTINCT user_id FROM account_period_balances")]
+    return sum(ensure_balance_snapshots(tx, uid) for uid in user_ids)
+
+# ============ PERIOD CLOSING ============
+# Advisory lock class serialising closes and postings of one user (PostgreSQL)
+PERIOD_LOCK_CLASS = 20240102
+
+class PeriodLocked(Exception):
+    """Raised when a posting or delete touches a closed period"""
+
+def lock_user_periods(tx, user_id, exclusive=False):
+    """Closing takes the user's period lock exclusively, postings share it (SQLite writers are already serial)"""
+    if use_postgres():
+        lock = 'pg_advisory_xact_lock' if exclusive else 'pg_advisory_xact_lock_shared'
+        tx.execute(f"SELECT {lock}(?, ?)", (PERIOD_LOCK_CLASS, user_id))
+
+def latest_closed_period(tx, user_id):
+    """Most recent closed 'YYYY-MM' period of the user (None when nothing is closed)"""
+    return tx.run('latest_closed_period', (user_id, '9999-99'))[0]['period']
+
+def check_period_open(tx, user_id, journal_dates):
+    """Refuse to post into or delete from a closed period"""
+    lock_user_periods(tx, user_id)
+    closed = latest_closed_period(tx, user_id)
+    periods = [period_of(journal_date) for journal_date in journal_dates]
+    if closed is not None and periods and min(periods) <= closed:
+        raise PeriodLocked(f"Periode {min(periods)} sudah ditutup (terakhir ditutup: {closed})")
+
+# Cumulative totals through a period: previous closed snapshot plus the rollup months since
+CLOSED_TOTALS_SQL = """
+    SELECT account_code, SUM(debit_total) as debit_total, SUM(credit_total) as credit_total FROM (
+        SELECT account_code, debit_total, credit_total FROM closed_period_balances
+        WHERE user_id = ? AND period = ?
+        UNION ALL
+        SELECT account_code, debit_total, credit_total FROM account_period_balances
+        WHERE user_id = ? AND period > ? AND period <= ?
+    ) changes
+    GROUP BY account_code
+"""
+
+def cumulative_totals_through(tx, user_id, period, last_closed):
+    """Per-account totals of every journal up to the end of `period`"""
+    return tx.fetch(CLOSED_TOTALS_SQL, (user_id, last_closed or '', user_id, last_closed or '', period))
+
+def close_period(tx, user_id, period, last_closed):
+    """Write the immutable balance snapshot of `period` and lock it (and everything before it)"""
+    tx.execute(f"""
+        INSERT INTO closed_period_balances (user_id, period, account_code, debit_total, credit_total)
+        SELECT ?, ?, account_code, debit_total, credit_total FROM ({CLOSED_TOTALS_SQL}) totals
+    """, (user_id, period, user_id, last_closed or '', user_id, last_closed or '', period))
+    tx.execute("INSERT INTO closed_periods (user_id, period) VALUES (?, ?)", (user_id, period))
+
+# Income summary and retained earnings accounts used by the closing journals
+INCOME_SUMMARY_ACCOUNT = '3-3200'
+RETAINED_EARNINGS_ACCOUNT = '3-3100'
+
+def close_books(tx, user_id, period):
+    """Post the closing journals of `period` set-based, snapshot and lock it.
+
+    Every non-zero Revenue/Expense balance is reversed by one INSERT ... SELECT
+    over the period-end totals; returns a summary of what was posted.
+    """
+    lock_user_periods(tx, user_id, exclusive=True)
+    last_closed = latest_closed_period(tx, user_id)
+    if last_closed is not None and period <= last_closed:
+        raise PeriodLocked(f"Periode {period} sudah ditutup (terakhir ditutup: {last_closed})")
+    
+    totals_params = (user_id, last_closed or '', user_id, last_closed or '', period)
+    summary = {row['type']: row for row in tx.fetch(f"""
+        SELECT a.type, COUNT(*) as accounts,
+               SUM(CASE WHEN a.type = 'Revenue' THEN t.credit_total - t.debit_total
+                        ELSE t.debit_total - t.credit_total END) as balance
+        FROM ({CLOSED_TOTALS_SQL}) t
+        JOIN accounts a ON a.code = t.account_code
+        WHERE a.type IN ('Revenue', 'Expense') AND ABS(t.credit_total - t.debit_total) > 0.005
+        GROUP BY a.type
+    """, totals_params)}
+    total_revenue = float(summary['Revenue']['balance']) if 'Revenue' in summary else 0.0
+    total_expense = float(summary['Expense']['balance']) if 'Expense' in summary else 0.0
+    net_income = total_revenue - total_expense
+    
+    closing_date = month_end(period_start(period)).isoformat()
+    closing_description = f"[PENUTUP] Jurnal Penutup Periode {period}"
+    journals = {}
+    if 'Revenue' in summary:
+        journals['Revenue'] = insert_journal_header(tx, f"CL{period}", closing_date,
+                                                    closing_description, user_id)
+    if 'Expense' in summary:
+        journals['Expense'] = insert_journal_header(tx, f"CL{period}-EXP", closing_date,
+                                                    f"{closing_description} - Beban", user_id)
+    if abs(net_income) > 0.005:
+        journals['Income'] = insert_journal_header(tx, f"CL{period}-INC", closing_date,
+                                                   f"{closing_description} - Laba", user_id)
+    
+    # 1 + 2. Reverse every temporary account into its closing journal in one statement
+    if 'Revenue' in journals or 'Expense' in journals:
+        tx.execute(f"""
+            INSERT INTO journal_details (journal_id, account_code, debit, credit, user_id, date)
+            SELECT CASE WHEN a.type = 'Revenue' THEN ? ELSE ? END, t.account_code,
+                   CASE WHEN t.credit_total > t.debit_total THEN t.credit_total - t.debit_total ELSE 0 END,
+                   CASE WHEN t.debit_total > t.credit_total THEN t.debit_total - t.credit_total ELSE 0 END,
+                   ?, ?
+            FROM ({CLOSED_TOTALS_SQL}) t
+            JOIN accounts a ON a.code = t.account_code
+            WHERE a.type IN ('Revenue', 'Expense') AND ABS(t.credit_total - t.debit_total) > 0.005
+        """, (journals.get('Revenue'), journals.get('Expense'), user_id, closing_date) + totals_params)
+    
+    # Income summary side of each journal, then 3. income summary to retained earnings
+    summary_lines = []
+    if 'Revenue' in journals:
+        summary_lines.append((journals['Revenue'], INCOME_SUMMARY_ACCOUNT,
+                              max(-total_revenue, 0), max(total_revenue, 0)))
+    if 'Expense' in journals:
+        summary_lines.append((journals['Expense'], INCOME_SUMMARY_ACCOUNT,
+                              max(total_expense, 0), max(-total_expense, 0)))
+    if 'Income' in journals:
+        summary_lines.append((journals['Income'], INCOME_SUMMARY_ACCOUNT,
+                              max(net_income, 0), max(-net_income, 0)))
+        summary_lines.append((journals['Income'], RETAINED_EARNINGS_ACCOUNT,
+                              max(-net_income, 0), max(net_income, 0)))
+    tx.insert_many('journal_details', JOURNAL_LINE_COLUMNS,
+                   [line + (user_id, closing_date) for line in summary_lines])
+    
+    # Keep balances, rollups and snapshots in step with the lines just written
+    lines = []
+    if journals:
+        placeholders = ', '.join('?' * len(journals))
+        lines = tx.fetch(f"SELECT account_code, debit, credit FROM journal_details WHERE journal_id IN ({placeholders})",
+                         tuple(journals.values()))
+        run_posting_hooks(tx, user_id, [(line['account_code'], line['debit'], line['credit'], closing_date)
+                                        for line in lines])
+    
+    close_period(tx, user_id, period, last_closed)
+    return {
+        'period': period,
+        'date': closing_date,
+        'journals': len(journals),
+        'lines': len(lines),
+        'total_revenue': total_revenue,
+        'total_expense': total_expense,
+        'net_income': net_income,
+    }
+
+def close_user_period(user_id, period):
+    """Close one tenant in its own transaction (process-pool worker for close-period)"""
+    with app.app_context():
+        try:
+            with transaction() as tx:
+                return user_id, 'closed', close_books(tx, user_id, period)
+        except PeriodLocked as e:
+            return user_id, 'skipped', str(e)
+        except Exception as e:
+            return user_id, 'failed', str(e)
+
+def users_to_close(period, user_ids=()):
+    """Users that have not closed `period` yet; closed_periods doubles as the resume checkpoint"""
+    query = """
+        SELECT u.id FROM users u
+        WHERE NOT EXISTS (SELECT 1 FROM closed_periods c WHERE c.user_id = u.id AND c.period >= ?)
+    """
+    params = [period]
+    if user_ids:
+        query += f" AND u.id IN ({', '.join('?' * len(user_ids))})"
+        params.extend(user_ids)
+    return [row['id'] for row in execute_query(query + " ORDER BY u.id", tuple(params), fetch=True) or []]
+
+@app.cli.command('close-period')
+@click.argument('period')
+@click.option('--user', 'user_ids', type=int, multiple=True, help='Only close these users (repeatable)')
+@click.option('--workers', type=int, default=None,
+              help='Worker processes (default: CPU count on PostgreSQL, 1 on SQLite)')
+def close_period_command(period, user_ids, workers):
+    """Close PERIOD (YYYY-MM) for every user that has not closed it yet.
+
+    Each user is closed in its own transaction; rerunning the command resumes
+    with the users that are still open.
+    """
+    try:
+        period_start(period)
+    except ValueError:
+        raise click.BadParameter('period must be YYYY-MM', param_hint='PERIOD')
+    
+    pending = users_to_close(period, user_ids)
+    if not pending:
+        click.echo(f"Nothing to close for {period}")
+        return
+    if workers is None:
+        # SQLite has a single writer: more processes would only queue on the lock
+        workers = (os.cpu_count() or 1) if use_postgres() else 1
+    
+    click.echo(f"Closing {period} for {len(pending)} users with {workers} workers")
+    counts = {'closed': 0, 'skipped': 0, 'failed': 0}
+    started = time.monotonic()
+    # Connections must not cross the fork: each worker opens its own pool
+    get_pool().close_all()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(close_user_period, user_id, period) for user_id in pending]
+        for done, future in enumerate(as_completed(futures), 1):
+            user_id, status, detail = future.result()
+            counts[status] += 1
+            if status == 'closed':
+                detail = f"{detail['lines']} lines, net income {detail['net_income']:.2f}"
+            click.echo(f"[{done}/{len(pending)}] user {user_id}: {status} ({detail})")
+    
+    click.echo(f"{counts['closed']} closed, {counts['skipped']} skipped, {counts['failed']} failed "
+               f"in {time.monotonic() - started:.1f}s")
+    if counts['failed']:
+        raise SystemExit(1)
+
 def hash_pw(password):
     """Hash password dengan salt"""
     return hashlib.sha256(password.encode()).hexdigest()
 
+# ============ SCHEMA MIGRATIONS ============
+def db_dialect():
+    """'postgres' or 'sqlite'"""
+    return 'postgres' if use_postgres() else 'sqlite'
+
+# Column types that differ between the two backends
+SQL_TYPES = {
+    'sqlite': {'pk': 'INTEGER PRIMARY KEY AUTOINCREMENT', 'money': 'REAL', 'date': 'TEXT'},
+    'postgres': {'pk': 'SERIAL PRIMARY KEY', 'money': 'DECIMAL(15,2)', 'date': 'DATE'},
+}
+
+def ddl(statement, **names):
+    """Render a DDL template for the active backend"""
+    return statement.format(**SQL_TYPES[db_dialect()], **names)
+
+SCHEMA_TABLES = {
+    'users': """
+        CREATE TABLE IF NOT EXISTS {name} (
+            id {pk},
+            username VARCHAR(50) UNIQUE NOT NULL,
+            email VARCHAR(100) UNIQUE,
+            password VARCHAR(100),
+            google_id VARCHAR(100) UNIQUE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )""",
+    'accounts': """
+        CREATE TABLE IF NOT EXISTS {name} (
+            id {pk},
+            code VARCHAR(20) UNIQUE NOT NULL,
+            name VARCHAR(100) NOT NULL,
+            type VARCHAR(50) NOT NULL,
+            normal_balance VARCHAR(10) NOT NULL,
+            balance {money} DEFAULT 0,
+            user_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )""",
+    'journals': """
+        CREATE TABLE IF NOT EXISTS {name} (
+            id {pk},
+            entry_no VARCHAR(50) NOT NULL,
+            date {date} NOT NULL,
+            description TEXT,
+            user_id INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )""",
+    'journal_details': """
+        CREATE TABLE IF NOT EXISTS {name} (
+            id {pk},
+            journal_id INTEGER NOT NULL REFERENCES journals (id) ON DELETE CASCADE,
+            account_code VARCHAR(20) NOT NULL,
+            debit {money} DEFAULT 0,
+            credit {money} DEFAULT 0,
+            user_id INTEGER,
+            date {date}
+        )""",
+    'adjustments': """
+        CREATE TABLE IF NOT EXISTS {name} (
+            id {pk},
+            date {date} NOT NULL,
+            description TEXT NOT NULL,
+            account_code VARCHAR(20) NOT NULL,
+            debit {money} DEFAULT 0,
+            credit {money} DEFAULT 0,
+            user_id INTEGER NOT NULL
+        )""",
+    'adjusting_journals': """
+        CREATE TABLE IF NOT EXISTS {name} (
+            id {pk},
+            entry_no VARCHAR(50) NOT NULL,
+            date {date} NOT NULL,
+            description TEXT,
+            total_debit {money} DEFAULT 0,
+            total_credit {money} DEFAULT 0,
+            user_id INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(entry_no, user_id)
+        )""",
+    'adjusting_entries': """
+        CREATE TABLE IF NOT EXISTS {name} (
+            id {pk},
+            entry_no VARCHAR(50) NOT NULL,
+            account_code VARCHAR(20) NOT NULL,
+            debit {money} DEFAULT 0,
+            credit {money} DEFAULT 0,
+            user_id INTEGER NOT NULL
+        )""",
+    'inventory': """
+        CREATE TABLE IF NOT EXISTS {name} (
+            id {pk},
+            code VARCHAR(20) UNIQUE NOT NULL,
+            name VARCHAR(100) NOT NULL,
+            qty INTEGER DEFAULT 0,
+            price {money} DEFAULT 0,
+            user_id INTEGER NOT NULL
+        )""",
+    'cash_payments': """
+        CREATE TABLE IF NOT EXISTS {name} (
+            id {pk},
+            payment_no VARCHAR(50) NOT NULL,
+            date {date} NOT NULL,
+            description TEXT NOT NULL,
+            account_code VARCHAR(20) NOT NULL,
+            amount {money} DEFAULT 0,
+            user_id INTEGER NOT NULL,
+            journal_id INTEGER REFERENCES journals (id) ON DELETE CASCADE
+        )""",
+    'cash_receipts': """
+        CREATE TABLE IF NOT EXISTS {name} (
+            id {pk},
+            receipt_no VARCHAR(50) NOT NULL,
+            date {date} NOT NULL,
+            description TEXT NOT NULL,
+            account_code VARCHAR(20) NOT NULL,
+            amount {money} DEFAULT 0,
+            user_id INTEGER NOT NULL,
+            journal_id INTEGER REFERENCES journals (id) ON DELETE CASCADE
+        )""",
+}
+
+DEFAULT_ACCOUNTS = [
+    ('1-1000', 'Kas', 'Asset', 'Debit'),
+    ('1-1100', 'Bank', 'Asset', 'Debit'),
+    ('1-1200', 'Piutang Usaha', 'Asset', 'Debit'),
+    ('1-1300', 'Persediaan', 'Asset', 'Debit'),
+    ('2-2000', 'Hutang Usaha', 'Liability', 'Credit'),
+    ('2-2100', 'Hutang Bank', 'Liability', 'Credit'),
+    ('3-3000', 'Modal', 'Equity', 'Credit'),
+    ('3-3100', 'Laba Ditahan', 'Equity', 'Credit'),
+    ('3-3200', 'Ikhtisar Laba Rugi', 'Equity', 'Credit'),
+    ('4-4000', 'Pendapatan Jasa', 'Revenue', 'Credit'),
+    ('4-4100', 'Pendapatan Lain', 'Revenue', 'Credit'),
+    ('5-5000', 'Beban Gaji', 'Expense', 'Debit'),
+    ('5-5100', 'Beban Sewa', 'Expense', 'Debit'),
+    ('5-5200', 'Beban Listrik', 'Expense', 'Debit'),
+    ('5-5300', 'Beban Perlengkapan', 'Expense', 'Debit'),
+]
+
+MIGRATIONS = []
+
+def migration(version, description):
+    """Register a schema migration; migrations run once each, in version order"""
+    def register(func):
+        MIGRATIONS.append((version, description, func))
+        MIGRATIONS.sort(key=lambda item: item[0])
+        return func
+    return register
+
+def column_exists(tx, table, column):
+    """True if the table already has the column"""
+    if use_postgres():
+        return tx.fetch_one(
+            "SELECT 1 FROM information_schema.columns "
+            "WHERE table_schema = current_schema() AND table_name = ? AND column_name = ?",
+            (table, column)
+        ) is not None
+    return any(row['name'] == column for row in tx.fetch(f"PRAGMA table_info({table})"))
+
+def rebuild_sqlite_table(tx, table):
+    """Recreate a SQLite table from SCHEMA_TABLES keeping its rows (SQLite cannot ALTER constraints)"""
+    old_columns = {row['name'] for row in tx.fetch(f"PRAGMA table_info({table})")}
+    tx.execute(ddl(SCHEMA_TABLES[table], name=f"{table}__new"))
+    columns = ', '.join(row['name'] for row in tx.fetch(f"PRAGMA table_info({table}__new)")
+                        if row['name'] in old_columns)
+    tx.execute(f"INSERT INTO {table}__new ({columns}) SELECT {columns} FROM {table}")
+    tx.execute(f"DROP TABLE {table}")
+    tx.execute(f"ALTER TABLE {table}__new RENAME TO {table}")
+    # Foreign keys are off while migrating (see run_migrations): check the references by hand
+    broken = [row for row in tx.fetch("PRAGMA foreign_key_check") if table in (row['table'], row['parent'])]
+    if broken:
+        raise RuntimeError(f"Rebuilding {table} left {len(broken)} broken foreign key references")
+
+@migration(1, 'base schema')
+def migrate_base_schema(tx):
+    for table, statement in SCHEMA_TABLES.items():
+        tx.execute(ddl(statement, name=table))
+
+@migration(2, 'upgrade tables created by the old init_db')
+def migrate_legacy_columns(tx):
+    for table, column, column_type in [
+        ('accounts', 'balance', '{money} DEFAULT 0'),
+        ('accounts', 'user_id', 'INTEGER'),
+        ('accounts', 'created_at', 'TIMESTAMP'),
+        ('journals', 'created_at', 'TIMESTAMP'),
+    ]:
+        if not column_exists(tx, table, column):
+            tx.execute(ddl(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}"))
+    
+    # entry_no used to be globally UNIQUE; it must only be unique per user
+    if use_postgres():
+        tx.execute("ALTER TABLE journals DROP CONSTRAINT IF EXISTS journals_entry_no_key")
+    else:
+        journals_sql = tx.fetch_one("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'journals'")
+        if journals_sql and re.search(r'entry_no\s+\w+\s+UNIQUE', journals_sql['sql'], re.I):
+            rebuild_sqlite_table(tx, 'journals')
+
+@migration(3, 'secondary indexes')
+def migrate_indexes(tx):
+    for statement in [
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_journals_entry_user ON journals (entry_no, user_id)",
+        "CREATE INDEX IF NOT EXISTS ix_journals_user_date ON journals (user_id, date)",
+        "CREATE INDEX IF NOT EXISTS ix_journal_details_account_journal ON journal_details (account_code, journal_id)",
+        "CREATE INDEX IF NOT EXISTS ix_journal_details_journal ON journal_details (journal_id)",
+        "CREATE INDEX IF NOT EXISTS ix_cash_payments_user_date ON cash_payments (user_id, date)",
+        "CREATE INDEX IF NOT EXISTS ix_cash_receipts_user_date ON cash_receipts (user_id, date)",
+        "CREATE INDEX IF NOT EXISTS ix_adjusting_entries_entry_user ON adjusting_entries (entry_no, user_id)",
+    ]:
+        tx.execute(statement)
+
+@migration(4, 'seed default chart of accounts')
+def migrate_seed_accounts(tx):
+    existing = {row['code'] for row in tx.fetch("SELECT code FROM accounts")}
+    tx.insert_many('accounts', ('code', 'name', 'type', 'normal_balance'),
+                   [account for account in DEFAULT_ACCOUNTS if account[0] not in existing])
+
+@migration(5, 'account_balances table')
+def migrate_account_balances(tx):
+    tx.execute(ddl("""
+        CREATE TABLE IF NOT EXISTS account_balances (
+            user_id INTEGER NOT NULL,
+            account_code VARCHAR(20) NOT NULL,
+            debit_total {money} DEFAULT 0,
+            credit_total {money} DEFAULT 0,
+            line_count INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, account_code)
+        )
+    """))
+    rebuild_account_balances(tx)
+
+@migration(6, 'cache version counters')
+def migrate_cache_versions(tx):
+    tx.execute("""
+        CREATE TABLE IF NOT EXISTS cache_versions (
+            name VARCHAR(50) PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    tx.execute("INSERT INTO cache_versions (name, version) VALUES ('chart_of_accounts', 0)")
+
+@migration(7, 'monthly account balance rollup')
+def migrate_account_period_balances(tx):
+    tx.execute(ddl("""
+        CREATE TABLE IF NOT EXISTS account_period_balances (
+            user_id INTEGER NOT NULL,
+            account_code VARCHAR(20) NOT NULL,
+            period VARCHAR(7) NOT NULL,
+            debit_total {money} DEFAULT 0,
+            credit_total {money} DEFAULT 0,
+            line_count INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, account_code, period)
+        )
+    """))
+    rebuild_period_balances(tx)
+
+@migration(8, 'balance snapshots')
+def migrate_balance_snapshots(tx):
+    tx.execute(ddl("""
+        CREATE TABLE IF NOT EXISTS account_balance_snapshots (
+            user_id INTEGER NOT NULL,
+            account_code VARCHAR(20) NOT NULL,
+            period VARCHAR(7) NOT NULL,
+            debit_total {money} DEFAULT 0,
+            credit_total {money} DEFAULT 0,
+            PRIMARY KEY (user_id, account_code, period)
+        )
+    """))
+    rebuild_balance_snapshots(tx)
+
+@migration(9, 'closed periods')
+def migrate_closed_periods(tx):
+    tx.execute("""
+        CREATE TABLE IF NOT EXISTS closed_periods (
+            user_id INTEGER NOT NULL,
+            period VARCHAR(7) NOT NULL,
+            closed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, period)
+        )
+    """)
+    tx.execute(ddl("""
+        CREATE TABLE IF NOT EXISTS closed_period_balances (
+            user_id INTEGER NOT NULL,
+            period VARCHAR(7) NOT NULL,
+            account_code VARCHAR(20) NOT NULL,
+            debit_total {money} DEFAULT 0,
+            credit_total {money} DEFAULT 0,
+            PRIMARY KEY (user_id, period, account_code)
+        )
+    """))
+
+@migration(10, 'keyset indexes for history pages')
+def migrate_history_indexes(tx):
+    for statement in [
+        "CREATE INDEX IF NOT EXISTS ix_journals_user_date_entry ON journals (user_id, date, entry_no)",
+        "CREATE INDEX IF NOT EXISTS ix_cash_payments_user_date_no ON cash_payments (user_id, date, payment_no)",
+        "CREATE INDEX IF NOT EXISTS ix_cash_receipts_user_date_no ON cash_receipts (user_id, date, receipt_no)",
+        "CREATE INDEX IF NOT EXISTS ix_adjusting_journals_user_date_entry ON adjusting_journals (user_id, date, entry_no)",
+        # Prefixes of the indexes above
+        "DROP INDEX IF EXISTS ix_journals_user_date",
+        "DROP INDEX IF EXISTS ix_cash_payments_user_date",
+        "DROP INDEX IF EXISTS ix_cash_receipts_user_date",
+    ]:
+        tx.execute(statement)
+
+@migration(11, 'idempotency keys')
+def migrate_idempotency_keys(tx):
+    tx.execute("""
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            user_id INTEGER NOT NULL,
+            idem_key VARCHAR(100) NOT NULL,
+            request_hash VARCHAR(64) NOT NULL,
+            response TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, idem_key)
+        )
+    """)
+    tx.execute("CREATE INDEX IF NOT EXISTS ix_idempotency_keys_created ON idempotency_keys (created_at)")
+
+@migration(12, 'cascading deletes from journals')
+def migrate_journal_cascades(tx):
+    # Lines of journals that no longer exist would fail the new constraint (balances never counted them)
+    tx.execute("DELETE FROM journal_details WHERE journal_id NOT IN (SELECT id FROM journals)")
+    if use_postgres():
+        foreign_key = tx.fetch_one("""
+            SELECT tc.constraint_name, rc.delete_rule FROM information_schema.table_constraints tc
+            JOIN information_schema.referential_constraints rc
+              ON rc.constraint_schema = tc.constraint_schema AND rc.constraint_name = tc.constraint_name
+            WHERE tc.table_schema = current_schema() AND tc.table_name = 'journal_details'
+              AND tc.constraint_type = 'FOREIGN KEY'
+        """)
+        if foreign_key is None or foreign_key['delete_rule'] != 'CASCADE':
+            if foreign_key is not None:
+                tx.execute(f"ALTER TABLE journal_details DROP CONSTRAINT {foreign_key['constraint_name']}")
+            tx.execute("""
+                ALTER TABLE journal_details ADD CONSTRAINT journal_details_journal_id_fkey
+                FOREIGN KEY (journal_id) REFERENCES journals (id) ON DELETE CASCADE
+            """)
+    elif not any(row['table'] == 'journals' and row['on_delete'] == 'CASCADE'
+                 for row in tx.fetch("PRAGMA foreign_key_list(journal_details)")):
+        # Also rebuilds the old init_db's plain REFERENCES journals(id) without the cascade
+        rebuild_sqlite_table(tx, 'journal_details')
+        tx.execute("CREATE INDEX IF NOT EXISTS ix_journal_details_account_journal ON journal_details (account_code, journal_id)")
+        tx.execute("CREATE INDEX IF NOT EXISTS ix_journal_details_journal ON journal_details (journal_id)")
+    
+    for kind, document in CASH_DOCUMENTS.items():
+        table = document['table']
+        if not column_exists(tx, table, 'journal_id'):
+            tx.execute(f"ALTER TABLE {table} ADD COLUMN journal_id INTEGER REFERENCES journals (id) ON DELETE CASCADE")
+        # Link existing documents to the journal post_cash_document wrote for them
+        tx.execute(f"""
+            UPDATE {table} SET journal_id = (
+                SELECT j.id FROM journals j
+                WHERE j.user_id = {table}.user_id AND j.entry_no = '{document['prefix']}' || {table}.{document['number']}
+            )
+            WHERE journal_id IS NULL
+        """)
+        tx.execute(f"CREATE INDEX IF NOT EXISTS ix_{table}_journal ON {table} (journal_id)")
+
+@migration(13, 'document sequences')
+def migrate_document_sequences(tx):
+    tx.execute("""
+        CREATE TABLE IF NOT EXISTS document_sequences (
+            user_id INTEGER NOT NULL,
+            doc_type VARCHAR(30) NOT NULL,
+            next_value INTEGER NOT NULL DEFAULT 1,
+            row_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, doc_type)
+        )
+    """)
+    for doc_type, sequence in DOCUMENT_SEQUENCES.items():
+        table, number = sequence['table'], sequence['number']
+        counts = {row['user_id']: row['count'] for row in tx.fetch(
+            f"SELECT user_id, COUNT(*) as count FROM {table} GROUP BY user_id")}
+        # Continue after the highest number already in the sequence's format, not after the count
+        last_values = {}
+        for row in tx.fetch(f"SELECT user_id, {number} as number FROM {table} WHERE {number} LIKE ?",
+                            (sequence['prefix'] + '%',)):
+            value = document_number_value(doc_type, row['number'])
+            last_values[row['user_id']] = max(last_values.get(row['user_id'], 0), value)
+        tx.insert_many('document_sequences', ('user_id', 'doc_type', 'next_value', 'row_count'),
+                       [(user_id, doc_type, last_values.get(user_id, 0) + 1, count)
+                        for user_id, count in counts.items()])
+
+@migration(14, 'cash document numbers unique per user')
+def migrate_cash_document_numbers(tx):
+    # payment_no / receipt_no used to be globally UNIQUE; like entry_no they must only be unique per user
+    for kind, document in CASH_DOCUMENTS.items():
+        table, number = document['table'], document['number']
+        if use_postgres():
+            tx.execute(f"ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {table}_{number}_key")
+        else:
+            table_sql = tx.fetch_one("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+            if table_sql and re.search(rf'{number}\s+[\w()]+\s+UNIQUE', table_sql['sql'], re.I):
+                rebuild_sqlite_table(tx, table)
+                tx.execute(f"CREATE INDEX IF NOT EXISTS ix_{table}_user_date_no ON {table} (user_id, date, {number})")
+                tx.execute(f"CREATE INDEX IF NOT EXISTS ix_{table}_journal ON {table} (journal_id)")
+        tx.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS ux_{table}_user_no ON {table} (user_id, {number})")
+
+@migration(15, 'journal line owner and date for ledgers')
+def migrate_journal_line_owner(tx):
+    # Copied from the journal so that a ledger page is an index range scan of one account's lines
+    for column, column_type in [('user_id', 'INTEGER'), ('date', '{date}')]:
+        if not column_exists(tx, 'journal_details', column):
+            tx.execute(ddl(f"ALTER TABLE journal_details ADD COLUMN {column} {column_type}"))
+    tx.execute("""
+        UPDATE journal_details SET
+            user_id = (SELECT j.user_id FROM journals j WHERE j.id = journal_details.journal_id),
+            date = (SELECT j.date FROM journals j WHERE j.id = journal_details.journal_id)
+        WHERE user_id IS NULL OR date IS NULL
+    """)
+    tx.execute("CREATE INDEX IF NOT EXISTS ix_journal_details_user_account_date "
+               "ON journal_details (user_id, account_code, date)")
+
+@migration(16, 'api keys')
+def migrate_api_keys(tx):
+    tx.execute(ddl("""
+        CREATE TABLE IF NOT EXISTS api_keys (
+            id {pk},
+            user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+            name VARCHAR(100),
+            key_hash VARCHAR(64) UNIQUE NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """))
+
+def run_migrations():
+    """Apply pending migrations in one transaction and return the resulting schema version.
+
+    SQLite runs them with foreign keys off (the PRAGMA is ignored inside a transaction, so it
+    is set before BEGIN): rebuilding a referenced table must not fail on, or cascade from, its
+    DROP TABLE. rebuild_sqlite_table runs the foreign key check itself.
+    """
+    with app.app_context():
+        # Pinned to the context: the PRAGMAs and the migration transaction share one connection
+        conn = get_db()
+        if not use_postgres():
+            conn.execute("PRAGMA foreign_keys=OFF")
+        try:
+            with transaction() as tx:
+                if use_postgres():
+                    # Serialise concurrent gunicorn workers starting up at the same time
+                    tx.execute("SELECT pg_advisory_xact_lock(20240101)")
+                tx.execute("""
+                    CREATE TABLE IF NOT EXISTS schema_version (
+                        version INTEGER PRIMARY KEY,
+                        description VARCHAR(200),
+                        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                """)
+                current = tx.fetch_one("SELECT COALESCE(MAX(version), 0) as version FROM schema_version")['version']
+                
+                for version, description, func in MIGRATIONS:
+                    if version <= current:
+                        continue
+                    print(f"DEBUG: Applying migration {version}: {description}")
+                    func(tx)
+                    tx.execute("INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                               (version, description))
+                    current = version
+                
+                return current
+        finally:
+            if not use_postgres() and conn.entry is not None:
+                conn.execute("PRAGMA foreign_keys=ON")
+
 def init_db():
     """Initialize database tables"""
     print("DEBUG: Initializing database...")
     try:
-        if os.environ.get('RAILWAY_ENVIRONMENT'):
-            # PostgreSQL table definitions
-            execute_query('''
-                CREATE TABLE IF NOT EXISTS users (
-                    id SERIAL PRIMARY KEY,
-                    username VARCHAR(50) UNIQUE NOT NULL,
-                    email VARCHAR(100) UNIQUE,
-                    password VARCHAR(100),
-                    google_id VARCHAR(100) UNIQUE,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''', commit=True)
-            
-            execute_query('''
-                CREATE TABLE IF NOT EXISTS accounts (
-                    id SERIAL PRIMARY KEY,
-                    code VARCHAR(20) UNIQUE NOT NULL,
-                    name VARCHAR(100) NOT NULL,
-                    type VARCHAR(50) NOT NULL,
-                    normal_balance VARCHAR(10) NOT NULL
-                )
-            ''', commit=True)
-            
-            execute_query('''
-                CREATE TABLE IF NOT EXISTS journals (
-                    id SERIAL PRIMARY KEY,
-                    entry_no VARCHAR(50) UNIQUE NOT NULL,
-                    date DATE NOT NULL,
-                    description TEXT NOT NULL,
-                    user_id INTEGER NOT NULL
-                )
-            ''', commit=True)
-            
-            execute_query('''
-                CREATE TABLE IF NOT EXISTS journal_details (
-                    id SERIAL PRIMARY KEY,
-                    journal_id INTEGER NOT NULL,
-                    account_code VARCHAR(20) NOT NULL,
-                    debit DECIMAL(15,2) DEFAULT 0,
-                    credit DECIMAL(15,2) DEFAULT 0
-                )
-            ''', commit=True)
-            
-            execute_query('''
-                CREATE TABLE IF NOT EXISTS inventory (
-                    id SERIAL PRIMARY KEY,
-                    code VARCHAR(20) UNIQUE NOT NULL,
-                    name VARCHAR(100) NOT NULL,
-                    qty INTEGER DEFAULT 0,
-                    price DECIMAL(15,2) DEFAULT 0,
-                    user_id INTEGER NOT NULL
-                )
-            ''', commit=True)
-            
-            execute_query('''
-                CREATE TABLE IF NOT EXISTS cash_payments (
-                    id SERIAL PRIMARY KEY,
-                    payment_no VARCHAR(50) UNIQUE NOT NULL,
-                    date DATE NOT NULL,
-                    description TEXT NOT NULL,
-                    account_code VARCHAR(20) NOT NULL,
-                    amount DECIMAL(15,2) DEFAULT 0,
-                    user_id INTEGER NOT NULL
-                )
-            ''', commit=True)
-            
-            execute_query('''
-                CREATE TABLE IF NOT EXISTS cash_receipts (
-                    id SERIAL PRIMARY KEY,
-                    receipt_no VARCHAR(50) UNIQUE NOT NULL,
-                    date DATE NOT NULL,
-                    description TEXT NOT NULL,
-                    account_code VARCHAR(20) NOT NULL,
-                    amount DECIMAL(15,2) DEFAULT 0,
-                    user_id INTEGER NOT NULL
-                )
-            ''', commit=True)
-            
-        else:
-            # SQLite table definitions
-            execute_query('''
-                CREATE TABLE IF NOT EXISTS users (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    username TEXT UNIQUE NOT NULL,
-                    email TEXT UNIQUE,
-                    password TEXT,
-                    google_id TEXT UNIQUE,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''', commit=True)
-            
-            execute_query('''
-                CREATE TABLE IF NOT EXISTS accounts (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    code TEXT UNIQUE NOT NULL,
-                    name TEXT NOT NULL,
-                    type TEXT NOT NULL,
-                    normal_balance TEXT NOT NULL
-                )
-            ''', commit=True)
-            
-            execute_query('''
-                CREATE TABLE IF NOT EXISTS journals (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    entry_no TEXT UNIQUE NOT NULL,
-                    date TEXT NOT NULL,
-                    description TEXT NOT NULL,
-                    user_id INTEGER NOT NULL,
-                    FOREIGN KEY (user_id) REFERENCES users(id)
-                )
-            ''', commit=True)
-            
-            execute_query('''
-                CREATE TABLE IF NOT EXISTS journal_details (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    journal_id INTEGER NOT NULL,
-                    account_code TEXT NOT NULL,
-                    debit REAL DEFAULT 0,
-                    credit REAL DEFAULT 0,
-                    FOREIGN KEY (journal_id) REFERENCES journals(id)
-                )
-            ''', commit=True)
-            
-            execute_query('''
-                CREATE TABLE IF NOT EXISTS inventory (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    code TEXT UNIQUE NOT NULL,
-                    name TEXT NOT NULL,
-                    qty INTEGER DEFAULT 0,
-                    price REAL DEFAULT 0,
-                    user_id INTEGER NOT NULL,
-                    FOREIGN KEY (user_id) REFERENCES users(id)
-                )
-            ''', commit=True)
-            
-            execute_query('''
-                CREATE TABLE IF NOT EXISTS cash_payments (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    payment_no TEXT UNIQUE NOT NULL,
-                    date TEXT NOT NULL,
-                    description TEXT NOT NULL,
-                    account_code TEXT NOT NULL,
-                    amount REAL DEFAULT 0,
-                    user_id INTEGER NOT NULL,
-                    FOREIGN KEY (account_code) REFERENCES accounts(code),
-                    FOREIGN KEY (user_id) REFERENCES users(id)
-                )
-            ''', commit=True)
-            
-            execute_query('''
-                CREATE TABLE IF NOT EXISTS cash_receipts (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    receipt_no TEXT UNIQUE NOT NULL,
-                    date TEXT NOT NULL,
-                    description TEXT NOT NULL,
-                    account_code TEXT NOT NULL,
-                    amount REAL DEFAULT 0,
-                    user_id INTEGER NOT NULL,
-                    FOREIGN KEY (account_code) REFERENCES accounts(code),
-                    FOREIGN KEY (user_id) REFERENCES users(id)
-                )
-            ''', commit=True)
-        
-        # Seed accounts if empty
-        accounts_count = execute_query("SELECT COUNT(*) FROM accounts", fetch=True)
-        if accounts_count and accounts_count[0]['count'] == 0:
-            accounts = [
-                ('1-1000', 'Kas', 'Asset', 'Debit'),
-                ('1-1100', 'Bank', 'Asset', 'Debit'),
-                ('1-1200', 'Piutang Usaha', 'Asset', 'Debit'),
-                ('1-1300', 'Persediaan', 'Asset', 'Debit'),
-                ('2-2000', 'Hutang Usaha', 'Liability', 'Credit'),
-                ('2-2100', 'Hutang Bank', 'Liability', 'Credit'),
-                ('3-3000', 'Modal', 'Equity', 'Credit'),
-                ('3-3100', 'Laba Ditahan', 'Equity', 'Credit'),
-                ('4-4000', 'Pendapatan Jasa', 'Revenue', 'Credit'),
-                ('4-4100', 'Pendapatan Lain', 'Revenue', 'Credit'),
-                ('5-5000', 'Beban Gaji', 'Expense', 'Debit'),
-                ('5-5100', 'Beban Sewa', 'Expense', 'Debit'),
-                ('5-5200', 'Beban Listrik', 'Expense', 'Debit'),
-                ('5-5300', 'Beban Perlengkapan', 'Expense', 'Debit'),
-            ]
-            
-            for account in accounts:
-                execute_query(
-                    "INSERT INTO accounts (code, name, type, normal_balance) VALUES (?, ?, ?, ?)",
-                    account,
-                    commit=True
-                )
-        
-        print("Database initialized successfully!")
+        version = run_migrations()
+        print(f"Database initialized successfully! (schema version {version})")
         
     except Exception as e:
         print(f"DEBUG: Error initializing database: {e}")
@@ -329,6 +1905,7 @@ def init_db():
         print(f"DEBUG: Traceback: {traceback.format_exc()}")
 
 # Panggil init_db saat app start
+compile_queries()
 init_db()
 
 # ============ HELPER FUNCTIONS ============
@@ -363,41 +1940,375 @@ def is_valid_email(email):
     return re.match(pattern, email) is not None
 
 def get_account_balance(account_code):
-    """Get account balance using universal query executor"""
+    """Get account balance from the maintained account_balances totals"""
     try:
-        # Get debit and credit totals
-        result = execute_query("""
-            SELECT COALESCE(SUM(debit),0) as total_debit, COALESCE(SUM(credit),0) as total_credit 
-            FROM journal_details jd
-            JOIN journals j ON jd.journal_id = j.id
-            WHERE jd.account_code = %s AND j.user_id = %s
-        """, (account_code, session.get('user_id', 1)), fetch=True)
+        account = get_chart_of_accounts().get(account_code)
+        if account is None:
+            return 0.0
+        
+        result = run_query('account_total', (session.get('user_id', 1), account_code))
         
         if result and len(result) > 0:
-            debit_total = result[0].get('total_debit', 0) or 0
-            credit_total = result[0].get('total_credit', 0) or 0
+            debit_total = float(result[0].get('debit_total', 0) or 0)
+            credit_total = float(result[0].get('credit_total', 0) or 0)
         else:
             debit_total = credit_total = 0
         
-        # Get account normal balance
-        account_result = execute_query(
-            "SELECT normal_balance FROM accounts WHERE code = %s", 
-            (account_code,), 
-            fetch=True
-        )
-        
-        if account_result and len(account_result) > 0:
-            normal_balance = account_result[0].get('normal_balance', 'Debit')
-            if normal_balance == 'Debit':
-                balance = debit_total - credit_total
-            else:
-                balance = credit_total - debit_total
-            return float(balance or 0)
-        return 0.0
+        if account['normal_balance'] == 'Debit':
+            balance = debit_total - credit_total
+        else:
+            balance = credit_total - debit_total
+        return float(balance or 0)
         
     except Exception as e:
         print(f"Error calculating balance: {e}")
         return 0.0
+
+# ============ CHART OF ACCOUNTS CACHE ============
+# Seconds between cross-worker version checks; lookups in between cost no queries
+COA_VERSION_CHECK_INTERVAL = float(os.environ.get('COA_VERSION_CHECK_INTERVAL', '5'))
+
+class ChartOfAccounts:
+    """Snapshot of the accounts table indexed by code, type and normal balance"""
+
+    def __init__(self, rows, version):
+        self.version = version
+        self.accounts = [dict(row) for row in rows]
+        self.by_code = {}
+        self.by_type = {}
+        self.by_normal_balance = {}
+        for account in self.accounts:
+            self.by_code[account['code']] = account
+            self.by_type.setdefault(account['type'], []).append(account)
+            self.by_normal_balance.setdefault(account['normal_balance'], []).append(account)
+
+    def get(self, code):
+        return self.by_code.get(code)
+
+    def of_types(self, *types, exclude=()):
+        """Accounts of the given types in code order, minus the excluded codes"""
+        return [account for account in self.accounts
+                if account['type'] in types and account['code'] not in exclude]
+
+_coa_cache = None
+_coa_checked_at = 0.0
+_coa_lock = threading.Lock()
+
+def get_catalog_version():
+    """Version counter bumped by every chart-of-accounts change (shared by all workers)"""
+    result = run_query('catalog_version')
+    return result[0]['version'] if result else 0
+
+def get_chart_of_accounts():
+    """Worker-wide chart of accounts, reloaded only when another write bumped its version"""
+    global _coa_cache, _coa_checked_at
+    now = time.monotonic()
+    catalog = _coa_cache
+    if catalog is not None and now - _coa_checked_at < COA_VERSION_CHECK_INTERVAL:
+        return catalog
+    
+    with _coa_lock:
+        version = get_catalog_version()
+        if _coa_cache is None or _coa_cache.version != version:
+            # Version is read first: a concurrent change only causes one extra reload
+            rows = run_query('chart_of_accounts')
+            if rows is False:
+                return _coa_cache or ChartOfAccounts([], None)
+            _coa_cache = ChartOfAccounts(rows, version)
+        _coa_checked_at = now
+        return _coa_cache
+
+def invalidate_chart_of_accounts():
+    """Bump the catalog version after add/delete so every worker reloads"""
+    global _coa_cache
+    execute_query(
+        "UPDATE cache_versions SET version = version + 1 WHERE name = 'chart_of_accounts'",
+        commit=True
+    )
+    _coa_cache = None
+
+# ============ TRIAL BALANCE ENGINE ============
+def parse_report_date(value):
+    """'YYYY-MM-DD' query-string value as a date (None when empty, ValueError when malformed)"""
+    if not value:
+        return None
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+def get_report_range():
+    """?from= / ?to= (or ?as_of=, i.e. from inception) of a report request; an invalid range is flashed and ignored"""
+    try:
+        date_from = parse_report_date(request.args.get('from', ''))
+        date_to = parse_report_date(request.args.get('to', ''))
+        as_of = parse_report_date(request.args.get('as_of', ''))
+        if as_of is not None:
+            date_from, date_to = None, as_of
+    except ValueError:
+        flash('Format tanggal harus YYYY-MM-DD!', 'error')
+        return None, None
+    if date_from and date_to and date_from > date_to:
+        flash('Tanggal awal harus sebelum tanggal akhir!', 'error')
+        return None, None
+    return date_from, date_to
+
+def range_account_totals(user_id, date_from=None, date_to=None):
+    """Debit/credit totals per account for journals dated within [date_from, date_to].
+
+    Whole months come from the account_period_balances rollup; only the partial
+    months at either end of the range are summed from journal lines.
+    """
+    first_period, last_period = '0000-00', '9999-99'
+    partial_ranges = []
+    if date_from is not None and date_from.day != 1:
+        partial_ranges.append((date_from, min(month_end(date_from), date_to or month_end(date_from))))
+        first_period = period_of(month_end(date_from) + timedelta(days=1))
+    elif date_from is not None:
+        first_period = period_of(date_from)
+    if date_to is not None and date_to != month_end(date_to):
+        month_start = date_to.replace(day=1)
+        if not partial_ranges or month_start > partial_ranges[0][1]:
+            partial_ranges.append((max(month_start, date_from or month_start), date_to))
+        last_period = period_of(month_start - timedelta(days=1))
+    elif date_to is not None:
+        last_period = period_of(date_to)
+    
+    parts = []
+    if first_period <= last_period:
+        parts.append(run_query('period_totals', (user_id, first_period, last_period)))
+    for start, end in partial_ranges:
+        parts.append(run_query('account_totals_between', (user_id, start.isoformat(), end.isoformat())))
+    
+    totals = {}
+    for rows in parts:
+        merge_totals(totals, rows)
+    return totals
+
+def merge_totals(totals, rows, sign=1):
+    """Add (sign=1) or subtract per-account debit/credit rows (or another totals dict) into totals"""
+    if isinstance(rows, dict):
+        rows = [dict(total, account_code=code) for code, total in rows.items()]
+    for row in rows or []:
+        total = totals.setdefault(row['account_code'], {'debit_total': 0.0, 'credit_total': 0.0})
+        total['debit_total'] += sign * float(row['debit_total'] or 0)
+        total['credit_total'] += sign * float(row['credit_total'] or 0)
+    return totals
+
+def as_of_account_totals(user_id, as_of):
+    """Cumulative totals per account through `as_of`: nearest snapshot plus a bounded delta.
+
+    The nearest snapshot is the later of the rolling snapshot and the last closed period.
+    """
+    if as_of == month_end(as_of):
+        ceiling = period_of(as_of)
+    else:
+        ceiling = period_of(as_of.replace(day=1) - timedelta(days=1))
+    result = run_query('latest_snapshot_period', (user_id, ceiling))
+    snapshot = result[0]['period'] if result else None
+    result = run_query('latest_closed_period', (user_id, ceiling))
+    closed = result[0]['period'] if result else None
+    if snapshot is None and closed is None:
+        return range_account_totals(user_id, None, as_of)
+    
+    if closed is not None and (snapshot is None or closed >= snapshot):
+        snapshot = closed
+        totals = merge_totals({}, run_query('closed_period_totals', (user_id, closed)))
+    else:
+        totals = merge_totals({}, run_query('snapshot_totals', (user_id, snapshot)))
+    delta_from = month_end(period_start(snapshot)) + timedelta(days=1)
+    if delta_from <= as_of:
+        merge_totals(totals, range_account_totals(user_id, delta_from, as_of))
+    return totals
+
+def period_account_totals(user_id, date_from=None, date_to=None):
+    """Totals per account for [date_from, date_to] (either end may be open)"""
+    if date_from is None:
+        return as_of_account_totals(user_id, date_to)
+    before = as_of_account_totals(user_id, date_from - timedelta(days=1))
+    if date_to is None:
+        return merge_totals(merge_totals({}, run_query('account_totals', (user_id,))), before, sign=-1)
+    if (date_to - date_from).days < 31 * SNAPSHOT_INTERVAL_MONTHS:
+        # Short ranges: the rollup months in between are cheaper than two snapshot lookups
+        return range_account_totals(user_id, date_from, date_to)
+    return merge_totals(as_of_account_totals(user_id, date_to), before, sign=-1)
+
+def compute_trial_balance(user_id, account_types=None, date_from=None, date_to=None):
+    """Debit/credit columns for every account of a user.
+
+    All-time balances are read from account_balances; a date range is answered
+    from balance snapshots and the monthly rollup (see period_account_totals).
+    Returns (accounts, total_debit, total_credit); each account dict has
+    code, name, type, normal_balance, balance, debit and credit.
+    """
+    catalog = get_chart_of_accounts()
+    rows = catalog.of_types(*account_types) if account_types else catalog.accounts
+    
+    if date_from is None and date_to is None:
+        totals = {
+            row['account_code']: row
+            for row in run_query('account_totals', (user_id,)) or []
+        }
+    else:
+        totals = period_account_totals(user_id, date_from, date_to)
+    
+    accounts = []
+    total_debit = 0
+    total_credit = 0
+    
+    empty = {'debit_total': 0, 'credit_total': 0}
+    for row in rows:
+        debit_total = float(totals.get(row['code'], empty)['debit_total'] or 0)
+        credit_total = float(totals.get(row['code'], empty)['credit_total'] or 0)
+        
+        # Determine debit/credit based on account type and normal balance
+        if row['normal_balance'] == 'Debit':  # Asset & Expense
+            balance = debit_total - credit_total
+            debit = balance if balance >= 0 else 0
+            credit = abs(balance) if balance < 0 else 0
+        else:  # Liability, Equity, Revenue (Credit normal balance)
+            balance = credit_total - debit_total
+            debit = abs(balance) if balance < 0 else 0
+            credit = balance if balance >= 0 else 0
+        
+        accounts.append({
+            'code': row['code'],
+            'name': row['name'],
+            'type': row['type'],
+            'normal_balance': row['normal_balance'],
+            'balance': balance,
+            'debit': debit,
+            'credit': credit
+        })
+        
+        total_debit += debit
+        total_credit += credit
+    
+    return accounts, total_debit, total_credit
+
+# ============ REQUEST BALANCE PROVIDER ============
+def get_request_balances():
+    """All of the current user's balances, loaded with one query on first use in this request"""
+    balances = g.get('account_balances')
+    if balances is None:
+        accounts, _, _ = compute_trial_balance(session.get('user_id', 1))
+        balances = g.account_balances = {account['code']: account['balance'] for account in accounts}
+    return balances
+
+def cached_account_balance(account_code):
+    """Template version of get_account_balance served from the request's balances"""
+    return get_request_balances().get(account_code, 0.0)
+
+# ============ HISTORY PAGINATION ============
+HISTORY_PAGE_SIZE = int(os.environ.get('HISTORY_PAGE_SIZE', '50'))
+# Sorts after every real (date, number) key: the first page
+KEYSET_START = ('9999-12-31', '')
+
+def pack_cursor(values):
+    """Opaque URL-safe token for a list of keyset values"""
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+def unpack_cursor(token):
+    """Values of a pack_cursor token; None for a missing or mangled token"""
+    if not token:
+        return None
+    try:
+        return json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except ValueError:
+        return None
+
+def encode_cursor(row, number_key):
+    """Opaque ?before= token pointing just past `row`"""
+    return pack_cursor([str(row['date']), row[number_key]])
+
+def decode_cursor(token):
+    """(date, number) of a ?before= token; the first page for a missing or mangled token"""
+    try:
+        date_key, number = unpack_cursor(token)
+        return str(date_key), str(number)
+    except (ValueError, TypeError):
+        return KEYSET_START
+
+def history_page(query_name, params, number_key):
+    """One page of a history list plus the cursor of the next (older) page, or None"""
+    before = decode_cursor(request.args.get('before', ''))
+    rows = run_query(query_name, tuple(params) + before + (HISTORY_PAGE_SIZE + 1,)) or []
+    next_cursor = encode_cursor(rows[HISTORY_PAGE_SIZE - 1], number_key) if len(rows) > HISTORY_PAGE_SIZE else None
+    return rows[:HISTORY_PAGE_SIZE], next_cursor
+
+def attach_lines(rows, row_key, query, params):
+    """Give every history row its structured lines: account_code, account_name, debit, credit.
+
+    `query` selects parent, account_code, debit, credit for the rows of one page.
+    """
+    catalog = get_chart_of_accounts()
+    by_key = {}
+    for row in rows:
+        row['lines'] = []
+        by_key[row[row_key]] = row
+    if not by_key:
+        return rows
+    for line in execute_query(query, params, fetch=True) or []:
+        account = catalog.get(line['account_code'])
+        by_key[line['parent']]['lines'].append({
+            'account_code': line['account_code'],
+            'account_name': account['name'] if account else line['account_code'],
+            'debit': line['debit'],
+            'credit': line['credit'],
+        })
+    return rows
+
+def attach_journal_lines(journals):
+    ids = [journal['id'] for journal in journals]
+    return attach_lines(journals, 'id', f"""
+        SELECT journal_id as parent, account_code, debit, credit FROM journal_details
+        WHERE journal_id IN ({', '.join('?' * len(ids))}) ORDER BY id
+    """, tuple(ids))
+
+def attach_adjusting_lines(adjustings, user_id):
+    entry_nos = [adjusting['entry_no'] for adjusting in adjustings]
+    return attach_lines(adjustings, 'entry_no', f"""
+        SELECT entry_no as parent, account_code, debit, credit FROM adjusting_entries
+        WHERE user_id = ? AND entry_no IN ({', '.join('?' * len(entry_nos))}) ORDER BY id
+    """, (user_id,) + tuple(entry_nos))
+
+# ============ LEDGER ============
+# Sorts before every real (date, entry_no, line id) key
+LEDGER_START = ('0001-01-01', '', 0)
+
+def ledger_opening_balance(user_id, account, date_from):
+    """Balance of `account` before date_from, from the nearest snapshot (0 from inception)"""
+    if date_from is None:
+        return 0.0
+    total = as_of_account_totals(user_id, date_from - timedelta(days=1)).get(account['code'])
+    if total is None:
+        return 0.0
+    movement = total['debit_total'] - total['credit_total']
+    return movement if account['normal_balance'] == 'Debit' else -movement
+
+def ledger_page(user_id, account, date_from=None, date_to=None):
+    """One page of an account's ledger in date order with a running balance.
+
+    The ?after= cursor carries the last (date, entry_no, line id) shown and the
+    balance after it, so a page costs one index range scan however deep it is.
+    Returns (opening_balance, rows, next_cursor); next_cursor is None on the last page.
+    """
+    cursor = unpack_cursor(request.args.get('after', ''))
+    try:
+        date_key, entry_no, line_id, opening = cursor
+        start = (str(date_key), str(entry_no), int(line_id))
+        opening = float(opening)
+    except (ValueError, TypeError):
+        start = (date_from.isoformat(), '', 0) if date_from else LEDGER_START
+        opening = ledger_opening_balance(user_id, account, date_from)
+    
+    sign = 1 if account['normal_balance'] == 'Debit' else -1
+    last_date = date_to.isoformat() if date_to else KEYSET_START[0]
+    rows = run_query('ledger_page', (opening, sign, user_id, account['code'], start[0], last_date)
+                     + start + (HISTORY_PAGE_SIZE + 1,)) or []
+    next_cursor = None
+    if len(rows) > HISTORY_PAGE_SIZE:
+        last = rows[HISTORY_PAGE_SIZE - 1]
+        next_cursor = pack_cursor([str(last['date']), last['entry_no'], last['line_id'], float(last['balance'])])
+    return opening, rows[:HISTORY_PAGE_SIZE], next_cursor
+
 # ============ JINJA2 FILTERS ============
 @app.template_filter('money_format')
 def money_format_filter(amount):
@@ -409,9 +2320,10 @@ def utility_processor():
     """Make functions available to all templates"""
     return {
         'money_format': money_format,
-        'get_account_balance': get_account_balance,
+        'get_account_balance': cached_account_balance,
         'safe_float': safe_float,
-        'safe_int': safe_int
+        'safe_int': safe_int,
+        'new_idempotency_key': lambda: secrets.token_urlsafe(16)
     }
 # ============ ROUTES ============
 @app.route('/')
@@ -534,31 +2446,16 @@ def register():
     
     return render_template('register.html')
 @app.route('/dashboard')
+@read_only_db
 def dashboard():
     if 'user_id' not in session:
         return redirect(url_for('login'))
     
-    # Get revenue total
-    revenue_results = execute_query("""
-        SELECT IFNULL(SUM(jd.credit - jd.debit),0) as total
-        FROM journal_details jd
-        JOIN journals j ON jd.journal_id = j.id
-        JOIN accounts a ON jd.account_code = a.code
-        WHERE a.type = 'Revenue' AND j.user_id = ?
-    """, (session['user_id'],), fetch=True)
-    
-    revenue = revenue_results[0]['total'] if revenue_results and len(revenue_results) > 0 else 0
-    
-    # Get expense total
-    expense_results = execute_query("""
-        SELECT IFNULL(SUM(jd.debit - jd.credit),0) as total
-        FROM journal_details jd
-        JOIN journals j ON jd.journal_id = j.id
-        JOIN accounts a ON jd.account_code = a.code
-        WHERE a.type = 'Expense' AND j.user_id = ?
-    """, (session['user_id'],), fetch=True)
-    
-    expense = expense_results[0]['total'] if expense_results and len(expense_results) > 0 else 0
+    # Revenue and expense totals from the maintained account balances (optionally ?from=&to=)
+    date_from, date_to = get_report_range()
+    accounts, _, _ = compute_trial_balance(session['user_id'], ('Revenue', 'Expense'), date_from, date_to)
+    revenue = sum(account['balance'] for account in accounts if account['type'] == 'Revenue')
+    expense = sum(account['balance'] for account in accounts if account['type'] == 'Expense')
     
     profit = revenue - expense
     
@@ -578,9 +2475,10 @@ def debug_accounts():
     if 'user_id' not in session:
         return redirect(url_for('login'))
     
-    all_accounts = execute_query("SELECT code, name, type FROM accounts ORDER BY code", fetch=True)
-    cash_payment_accounts = execute_query("SELECT code, name FROM accounts WHERE type IN ('Expense', 'Asset') AND code != '1-1000' ORDER BY code", fetch=True)
-    cash_receipt_accounts = execute_query("SELECT code, name FROM accounts WHERE type IN ('Revenue', 'Liability') ORDER BY code", fetch=True)
+    catalog = get_chart_of_accounts()
+    all_accounts = catalog.accounts
+    cash_payment_accounts = catalog.of_types('Expense', 'Asset', exclude=('1-1000',))
+    cash_receipt_accounts = catalog.of_types('Revenue', 'Liability')
     
     debug_info = {
         'total_accounts': len(all_accounts) if all_accounts else 0,
@@ -618,6 +2516,10 @@ def debug_db():
     except Exception as e:
         debug_info['connection'] = f'ERROR: {str(e)}'
     
+    # Connection pool statistics for this worker
+    debug_info['pool'] = get_pool().statistics()
+    debug_info['read_pool'] = get_read_pool().statistics()
+    
     # Test accounts table query
     try:
         result = execute_query("SELECT COUNT(*) as count FROM accounts", fetch=True)
@@ -664,15 +2566,9 @@ def coa():
     except Exception as e:
         print(f"DEBUG: Connection error: {e}")
     
-    # Get accounts count
-    count_result = execute_query("SELECT COUNT(*) as count FROM accounts", fetch=True)
-    print(f"DEBUG: Total accounts in database: {count_result[0]['count'] if count_result else 0}")
-    
-    # Get accounts data
-    accounts = execute_query(
-        "SELECT code, name, type, normal_balance FROM accounts ORDER BY code", 
-        fetch=True
-    )
+    # Get accounts data (cached chart of accounts)
+    accounts = get_chart_of_accounts().accounts
+    print(f"DEBUG: Total accounts in database: {len(accounts)}")
     
     print(f"DEBUG: Accounts type: {type(accounts)}")
     print(f"DEBUG: Accounts length: {len(accounts) if accounts else 0}")
@@ -692,19 +2588,20 @@ def journal():
         if 'user_id' not in session:
             return redirect(url_for('login'))
         
-        # Get accounts for dropdown - FIXED QUERY
-        accounts = execute_query(
-            "SELECT code, name FROM accounts ORDER BY code", 
-            fetch=True
-        )
+        # Get accounts for dropdown (cached chart of accounts)
+        accounts = get_chart_of_accounts().accounts
         
         # Debug accounts
         print(f"DEBUG: Accounts fetched: {len(accounts) if accounts else 0}")
         if accounts and len(accounts) > 0:
             print(f"DEBUG: First account: {dict(accounts[0])}")
         
+        # Suggested entry number and journal count (read-only; the number is taken on posting)
+        next_number, journal_count = peek_document_number(session['user_id'], 'journal')
+        
         if request.method == 'POST':
-            entry_no = request.form['entry_no']
+            # Blank: the next number of the sequence is assigned when the journal is posted
+            entry_no = request.form.get('entry_no', '').strip() or None
             date = request.form['date']
             description = request.form['description']
             accounts_form = request.form.getlist('account_code[]')
@@ -712,11 +2609,12 @@ def journal():
             credits = request.form.getlist('credit[]')
             
             # Validate required fields
-            if not entry_no or not date or not description:
+            if not date or not description:
                 flash('Mohon isi semua field yang required!', 'error')
                 return render_template('journal.html', 
                                      accounts=accounts,
-                                     journal_count=0,
+                                     next_number=next_number,
+                                     journal_count=journal_count,
                                      today=datetime.now().strftime('%Y-%m-%d'),
                                      journals=[])
             
@@ -729,113 +2627,55 @@ def journal():
                 flash('Total debit dan kredit harus seimbang!', 'error')
                 return render_template('journal.html', 
                                      accounts=accounts,
-                                     journal_count=0,
+                                     next_number=next_number,
+                                     journal_count=journal_count,
                                      today=datetime.now().strftime('%Y-%m-%d'),
                                      journals=[])
             
             try:
-                # Start transaction
-                execute_query("BEGIN", commit=True)
-                
-                # Insert journal header
-                journal_success = execute_query(
-                    "INSERT INTO journals (entry_no, date, description, user_id) VALUES (?, ?, ?, ?)",
-                    (entry_no, date, description, session['user_id']),
-                    commit=False
-                )
-                
-                if not journal_success:
-                    execute_query("ROLLBACK", commit=True)
-                    flash('Error menyimpan jurnal!', 'error')
-                    return render_template('journal.html', 
-                                         accounts=accounts,
-                                         journal_count=0,
-                                         today=datetime.now().strftime('%Y-%m-%d'),
-                                         journals=[])
-                
-                # Get the last inserted journal ID
-                journal_results = execute_query(
-                    "SELECT id FROM journals WHERE entry_no = ? AND user_id = ? ORDER BY id DESC LIMIT 1",
-                    (entry_no, session['user_id']),
-                    fetch=True
-                )
-                
-                if not journal_results or len(journal_results) == 0:
-                    execute_query("ROLLBACK", commit=True)
-                    flash('Error mendapatkan ID jurnal!', 'error')
-                    return render_template('journal.html', 
-                                         accounts=accounts,
-                                         journal_count=0,
-                                         today=datetime.now().strftime('%Y-%m-%d'),
-                                         journals=[])
-                
-                journal_id = journal_results[0]['id']
-                
-                # Insert journal details
-                for i, account_code in enumerate(accounts_form):
-                    if account_code and (safe_float(debits[i]) > 0 or safe_float(credits[i]) > 0):
-                        detail_success = execute_query(
-                            "INSERT INTO journal_details (journal_id, account_code, debit, credit) VALUES (?, ?, ?, ?)",
-                            (journal_id, account_code, safe_float(debits[i]), safe_float(credits[i])),
-                            commit=False
-                        )
-                        if not detail_success:
-                            execute_query("ROLLBACK", commit=True)
-                            flash('Error menyimpan detail jurnal!', 'error')
-                            return render_template('journal.html', 
-                                                 accounts=accounts,
-                                                 journal_count=0,
-                                                 today=datetime.now().strftime('%Y-%m-%d'),
-                                                 journals=[])
+                with transaction() as tx:
+                    def post():
+                        # Header, lines (one statement) and balances through the posting engine
+                        post_journal(tx, session['user_id'], entry_no, date, description, [
+                            (account_code, safe_float(debits[i]), safe_float(credits[i]))
+                            for i, account_code in enumerate(accounts_form)
+                        ])
+                        return {'message': 'Jurnal berhasil disimpan!', 'category': 'success'}
+                    
+                    # A resubmitted form (same idempotency_key) replays the original result
+                    result, _ = idempotent_post(tx, session['user_id'], post)
                 
-                # Commit all transactions
-                commit_success = execute_query("COMMIT", commit=True)
-                if commit_success:
-                    flash('Jurnal berhasil disimpan!', 'success')
-                else:
-                    flash('Error commit transaksi!', 'error')
+                flash(result['message'], result['category'])
                     
             except Exception as e:
-                # Rollback on error
-                execute_query("ROLLBACK", commit=True)
+                # transaction() already rolled back
                 print(f"Journal save error: {e}")
                 if 'UNIQUE' in str(e) or 'unique' in str(e).lower():
                     flash('Nomor entri sudah ada!', 'error')
                 else:
                     flash(f'Error menyimpan jurnal: {str(e)}', 'error')
+            
+            # Re-read after a posting moved the sequence
+            next_number, journal_count = peek_document_number(session['user_id'], 'journal')
         
-        # Get journal count
-        journal_count_results = execute_query(
-            "SELECT COUNT(*) as count FROM journals WHERE user_id = ?", 
-            (session['user_id'],), 
-            fetch=True
-        )
-        journal_count = journal_count_results[0]['count'] if journal_count_results and len(journal_count_results) > 0 else 0
-        
-        # Get recent journals
-        journals = execute_query("""
-            SELECT j.entry_no, j.date, j.description, 
-                   GROUP_CONCAT(a.name || ' (D: ' || jd.debit || ', C: ' || jd.credit || ')') as details
-            FROM journals j
-            LEFT JOIN journal_details jd ON j.id = jd.journal_id
-            LEFT JOIN accounts a ON jd.account_code = a.code
-            WHERE j.user_id = ?
-            GROUP BY j.id, j.entry_no, j.date, j.description
-            ORDER BY j.date DESC, j.entry_no DESC
-            LIMIT 50
-        """, (session['user_id'],), fetch=True)
+        # Journal history, one keyset page (?before=) with structured lines
+        journals, next_cursor = history_page('journal_page', (session['user_id'],), 'entry_no')
+        attach_journal_lines(journals)
         
         return render_template('journal.html', 
                              accounts=accounts,
+                             next_number=next_number,
                              journal_count=journal_count,
                              today=datetime.now().strftime('%Y-%m-%d'),
-                             journals=journals or [])
+                             journals=journals,
+                             next_cursor=next_cursor)
                              
     except Exception as e:
         print(f"Journal route error: {e}")
         flash('Error loading journal page', 'error')
         return render_template('journal.html', 
                              accounts=[],
+                             next_number='',
                              journal_count=0,
                              today=datetime.now().strftime('%Y-%m-%d'),
                              journals=[])
@@ -879,6 +2719,7 @@ def add_account():
             )
             
             if success:
+                invalidate_chart_of_accounts()
                 flash('Akun berhasil ditambahkan!', 'success')
                 return redirect(url_for('coa'))
             else:
@@ -927,6 +2768,7 @@ def delete_account():
         )
         
         if success:
+            invalidate_chart_of_accounts()
             flash('Akun berhasil dihapus!', 'success')
         else:
             flash('Gagal menghapus akun!', 'error')
@@ -944,8 +2786,8 @@ def adjusting():
     
     try:
         if request.method == 'POST':
-            # Ambil data dari form
-            entry_no = request.form['entry_no']
+            # Ambil data dari form (nomor kosong: diambil dari sequence saat posting)
+            entry_no = request.form.get('entry_no', '').strip() or None
             date = request.form['date']
             description = request.form['description']
             
@@ -988,62 +2830,23 @@ def adjusting():
                 return redirect(url_for('adjusting'))
             
             try:
-                # Start transaction
-                execute_query("BEGIN", commit=True)
-                
-                # 1. Insert adjusting journal header
-                journal_success = execute_query(
-                    """INSERT INTO adjusting_journals 
-                       (entry_no, date, description, total_debit, total_credit, user_id) 
-                       VALUES (?, ?, ?, ?, ?, ?)""",
-                    (entry_no, date, description, total_debit, total_credit, session['user_id']),
-                    commit=False
-                )
-                
-                if not journal_success:
-                    execute_query("ROLLBACK", commit=True)
-                    flash('Error menyimpan header jurnal penyesuaian!', 'error')
-                    return redirect(url_for('adjusting'))
-                
-                # 2. Insert adjusting entries
-                for entry in valid_entries:
-                    detail_success = execute_query(
-                        """INSERT INTO adjusting_entries 
-                           (entry_no, account_code, debit, credit, user_id) 
-                           VALUES (?, ?, ?, ?, ?)""",
-                        (entry_no, entry['account_code'], entry['debit'], entry['credit'], session['user_id']),
-                        commit=False
-                    )
+                with transaction() as tx:
+                    def post():
+                        # Header, entries and account balances; refused in a closed period
+                        post_adjusting_entry(tx, session['user_id'], entry_no, date, description,
+                                             [(entry['account_code'], entry['debit'], entry['credit'])
+                                              for entry in valid_entries])
+                        return {'message': 'Jurnal penyesuaian berhasil disimpan!', 'category': 'success'}
                     
-                    if not detail_success:
-                        execute_query("ROLLBACK", commit=True)
-                        flash('Error menyimpan detail penyesuaian!', 'error')
-                        return redirect(url_for('adjusting'))
-                    
-                    # 3. Update account balance
-                    update_success = execute_query(
-                        """UPDATE accounts 
-                           SET balance = balance + ? - ?
-                           WHERE code = ? AND user_id = ?""",
-                        (entry['debit'], entry['credit'], entry['account_code'], session['user_id']),
-                        commit=False
-                    )
-                    
-                    if not update_success:
-                        execute_query("ROLLBACK", commit=True)
-                        flash(f'Error update saldo akun {entry["account_code"]}!', 'error')
-                        return redirect(url_for('adjusting'))
+                    result, _ = idempotent_post(tx, session['user_id'], post)
                 
-                # 4. Commit transaction
-                commit_success = execute_query("COMMIT", commit=True)
-                if commit_success:
-                    flash('Jurnal penyesuaian berhasil disimpan!', 'success')
-                else:
-                    flash('Error commit transaksi!', 'error')
+                # Committed by transaction()
+                flash(result['message'], result['category'])
                     
+            except PeriodLocked as e:
+                flash(str(e), 'error')
             except Exception as e:
-                # Rollback on error
-                execute_query("ROLLBACK", commit=True)
+                # transaction() already rolled back
                 print(f"Adjusting journal save error: {e}")
                 if 'UNIQUE' in str(e) or 'unique' in str(e).lower():
                     flash('Nomor entri sudah ada!', 'error')
@@ -1059,44 +2862,30 @@ def adjusting():
             fetch=True
         )
         
-        # Hitung jumlah jurnal untuk nomor entri berikutnya
-        count_result = execute_query(
-            "SELECT COUNT(*) as count FROM adjusting_journals WHERE user_id = ?", 
-            (session['user_id'],), 
-            fetch=True
-        )
-        journal_count = count_result[0]['count'] if count_result else 0
+        # Usulan nomor entri dan jumlah jurnal dari sequence user (hanya dibaca)
+        next_number, journal_count = peek_document_number(session['user_id'], 'adjusting')
         
         # Ambil riwayat jurnal penyesuaian
-        adjustings = execute_query("""
-            SELECT aj.entry_no, aj.date, aj.description, 
-                   aj.total_debit, aj.total_credit,
-                   GROUP_CONCAT(
-                       a.name || ' (D: ' || ae.debit || ', C: ' || ae.credit || ')', 
-                       ', '
-                   ) as account_details
-            FROM adjusting_journals aj
-            LEFT JOIN adjusting_entries ae ON aj.entry_no = ae.entry_no
-            LEFT JOIN accounts a ON ae.account_code = a.code
-            WHERE aj.user_id = ?
-            GROUP BY aj.entry_no, aj.date, aj.description, aj.total_debit, aj.total_credit
-            ORDER BY aj.date DESC, aj.entry_no DESC
-            LIMIT 50
-        """, (session['user_id'],), fetch=True)
-        
-        return render_template('adjusting.html',
+        adjustings, next_cursor = history_page('adjusting_journal_page', (session['user_id'],), 'entry_no')
+        attach_adjusting_lines(adjustings, session['user_id'])
+        
+        return render_template('adjusting_entries.html',
                              accounts=accounts or [],
+                             next_number=next_number,
                              journal_count=journal_count,
-                             adjustings=adjustings or [],
+                             adjustings=adjustings,
+                             next_cursor=next_cursor,
                              today=datetime.now().strftime('%Y-%m-%d'))
                              
     except Exception as e:
         print(f"Adjusting route error: {e}")
         flash('Error loading adjusting journal page', 'error')
-        return render_template('adjusting.html',
+        return render_template('adjusting_entries.html',
                              accounts=[],
+                             next_number='',
                              journal_count=0,
                              adjustings=[],
+                             next_cursor=None,
                              today=datetime.now().strftime('%Y-%m-%d'))
     
 # ============ CLOSING JOURNAL ENTRIES ============
@@ -1116,500 +2905,82 @@ def closing_entries():
                                      current_period=datetime.now().strftime('%Y-%m'),
                                      closing_entries=[])
             
+            # Periods compare as strings ('2024-05' <= '2024-1'): only accept YYYY-MM
             try:
-                # Start transaction
-                execute_query("BEGIN", commit=True)
-                
-                # Calculate revenue and expense totals
-                revenue_results = execute_query("""
-                    SELECT a.code, a.name, 
-                           COALESCE(SUM(jd.credit - jd.debit), 0) as balance
-                    FROM accounts a
-                    LEFT JOIN journal_details jd ON a.code = jd.account_code
-                    LEFT JOIN journals j ON jd.journal_id = j.id
-                    WHERE a.type = 'Revenue' AND j.user_id = ?
-                    GROUP BY a.code, a.name
-                """, (session['user_id'],), fetch=True)
-                
-                expense_results = execute_query("""
-                    SELECT a.code, a.name, 
-                           COALESCE(SUM(jd.debit - jd.credit), 0) as balance
-                    FROM accounts a
-                    LEFT JOIN journal_details jd ON a.code = jd.account_code
-                    LEFT JOIN journals j ON jd.journal_id = j.id
-                    WHERE a.type = 'Expense' AND j.user_id = ?
-                    GROUP BY a.code, a.name
-                """, (session['user_id'],), fetch=True)
-                
-                revenues = revenue_results if revenue_results else []
-                expenses = expense_results if expense_results else []
-                
-                total_revenue = sum(row['balance'] for row in revenues)
-                total_expense = sum(row['balance'] for row in expenses)
-                net_income = total_revenue - total_expense
-                
-                # Create closing entries
-                closing_date = datetime.now().strftime('%Y-%m-%d')
-                closing_description = f"Jurnal Penutup Periode {period}"
-                
-                # 1. Close Revenue accounts to Income Summary
-                if total_revenue > 0:
-                    # Insert closing journal header for revenue
-                    journal_success = execute_query(
-                        "INSERT INTO journals (entry_no, date, description, user_id) VALUES (?, ?, ?, ?)",
-                        (f"CL{period}", closing_date, f"[PENUTUP] {closing_description}", session['user_id']),
-                        commit=False
-                    )
-                    
-                    if not journal_success:
-                        execute_query("ROLLBACK", commit=True)
-                        flash('Error membuat jurnal penutup revenue!', 'error')
-                        return render_template('closing_entries.html',
-                                             current_period=period,
-                                             closing_entries=[])
-                    
-                    # Get the journal ID
-                    journal_results = execute_query(
-                        "SELECT id FROM journals WHERE entry_no = ? AND user_id = ? ORDER BY id DESC LIMIT 1",
-                        (f"CL{period}", session['user_id']),
-                        fetch=True
-                    )
-                    
-                    if not journal_results or len(journal_results) == 0:
-                        execute_query("ROLLBACK", commit=True)
-                        flash('Error mendapatkan ID jurnal!', 'error')
-                        return render_template('closing_entries.html',
-                                             current_period=period,
-                                             closing_entries=[])
-                    
-                    journal_id = journal_results[0]['id']
-                    
-                    # Debit Revenue accounts, Credit Income Summary
-                    for revenue in revenues:
-                        if revenue['balance'] > 0:
-                            detail_success = execute_query(
-                                "INSERT INTO journal_details (journal_id, account_code, debit, credit) VALUES (?, ?, ?, ?)",
-                                (journal_id, revenue['code'], revenue['balance'], 0),
-                                commit=False
-                            )
-                            if not detail_success:
-                                execute_query("ROLLBACK", commit=True)
-                                flash('Error menyimpan detail jurnal revenue!', 'error')
-                                return render_template('closing_entries.html',
-                                                     current_period=period,
-                                                     closing_entries=[])
-                    
-                    # Credit Income Summary for total revenue
-                    income_summary_success = execute_query(
-                        "INSERT INTO journal_details (journal_id, account_code, debit, credit) VALUES (?, ?, ?, ?)",
-                        (journal_id, '3-3200', 0, total_revenue),
-                        commit=False
-                    )
-                    if not income_summary_success:
-                        execute_query("ROLLBACK", commit=True)
-                        flash('Error menyimpan income summary!', 'error')
-                        return render_template('closing_entries.html',
-                                             current_period=period,
-                                             closing_entries=[])
-                
-                # 2. Close Expense accounts to Income Summary
-                if total_expense > 0:
-                    # Insert closing journal header for expenses
-                    journal_success = execute_query(
-                        "INSERT INTO journals (entry_no, date, description, user_id) VALUES (?, ?, ?, ?)",
-                        (f"CL{period}-EXP", closing_date, f"[PENUTUP] {closing_description} - Beban", session['user_id']),
-                        commit=False
-                    )
-                    
-                    if not journal_success:
-                        execute_query("ROLLBACK", commit=True)
-                        flash('Error membuat jurnal penutup expense!', 'error')
-                        return render_template('closing_entries.html',
-                                             current_period=period,
-                                             closing_entries=[])
-                    
-                    # Get the journal ID
-                    journal_results = execute_query(
-                        "SELECT id FROM journals WHERE entry_no = ? AND user_id = ? ORDER BY id DESC LIMIT 1",
-                        (f"CL{period}-EXP", session['user_id']),
-                        fetch=True
-                    )
-                    
-                    if not journal_results or len(journal_results) == 0:
-                        execute_query("ROLLBACK", commit=True)
-                        flash('Error mendapatkan ID jurnal expense!', 'error')
-                        return render_template('closing_entries.html',
-                                             current_period=period,
-                                             closing_entries=[])
-                    
-                    journal_id_exp = journal_results[0]['id']
-                    
-                    # Credit Expense accounts, Debit Income Summary
-                    for expense in expenses:
-                        if expense['balance'] > 0:
-                            detail_success = execute_query(
-                                "INSERT INTO journal_details (journal_id, account_code, debit, credit) VALUES (?, ?, ?, ?)",
-                                (journal_id_exp, expense['code'], 0, expense['balance']),
-                                commit=False
-                            )
-                            if not detail_success:
-                                execute_query("ROLLBACK", commit=True)
-                                flash('Error menyimpan detail jurnal expense!', 'error')
-                                return render_template('closing_entries.html',
-                                                     current_period=period,
-                                                     closing_entries=[])
-                    
-                    # Debit Income Summary for total expenses
-                    income_summary_success = execute_query(
-                        "INSERT INTO journal_details (journal_id, account_code, debit, credit) VALUES (?, ?, ?, ?)",
-                        (journal_id_exp, '3-3200', total_expense, 0),
-                        commit=False
-                    )
-                    if not income_summary_success:
-                        execute_query("ROLLBACK", commit=True)
-                        flash('Error menyimpan income summary expense!', 'error')
-                        return render_template('closing_entries.html',
-                                             current_period=period,
-                                             closing_entries=[])
-                
-                # 3. Close Income Summary to Retained Earnings
-                if net_income != 0:
-                    # Insert closing journal header for income summary
-                    journal_success = execute_query(
-                        "INSERT INTO journals (entry_no, date, description, user_id) VALUES (?, ?, ?, ?)",
-                        (f"CL{period}-INC", closing_date, f"[PENUTUP] {closing_description} - Laba", session['user_id']),
-                        commit=False
-                    )
-                    
-                    if not journal_success:
-                        execute_query("ROLLBACK", commit=True)
-                        flash('Error membuat jurnal penutup income summary!', 'error')
-                        return render_template('closing_entries.html',
-                                             current_period=period,
-                                             closing_entries=[])
-                    
-                    # Get the journal ID
-                    journal_results = execute_query(
-                        "SELECT id FROM journals WHERE entry_no = ? AND user_id = ? ORDER BY id DESC LIMIT 1",
-                        (f"CL{period}-INC", session['user_id']),
-                        fetch=True
-                    )
-                    
-                    if not journal_results or len(journal_results) == 0:
-                        execute_query("ROLLBACK", commit=True)
-                        flash('Error mendapatkan ID jurnal income summary!', 'error')
-                        return render_template('closing_entries.html',
-                                             current_period=period,
-                                             closing_entries=[])
-                    
-                    journal_id_inc = journal_results[0]['id']
-                    
-                    if net_income > 0:
-                        # Debit Income Summary, Credit Retained Earnings (Profit)
-                        debit_success = execute_query(
-                            "INSERT INTO journal_details (journal_id, account_code, debit, credit) VALUES (?, ?, ?, ?)",
-                            (journal_id_inc, '3-3200', net_income, 0),
-                            commit=False
-                        )
-                        credit_success = execute_query(
-                            "INSERT INTO journal_details (journal_id, account_code, debit, credit) VALUES (?, ?, ?, ?)",
-                            (journal_id_inc, '3-3100', 0, net_income),
-                            commit=False
-                        )
-                        if not debit_success or not credit_success:
-                            execute_query("ROLLBACK", commit=True)
-                            flash('Error menyimpan jurnal laba!', 'error')
-                            return render_template('closing_entries.html',
-                                                 current_period=period,
-                                                 closing_entries=[])
-                    else:
-                        # Credit Income Summary, Debit Retained Earnings (Loss)
-                        credit_success = execute_query(
-                            "INSERT INTO journal_details (journal_id, account_code, debit, credit) VALUES (?, ?, ?, ?)",
-                            (journal_id_inc, '3-3200', 0, abs(net_income)),
-                            commit=False
-                        )
-                        debit_success = execute_query(
-                            "INSERT INTO journal_details (journal_id, account_code, debit, credit) VALUES (?, ?, ?, ?)",
-                            (journal_id_inc, '3-3100', abs(net_income), 0),
-                            commit=False
-                        )
-                        if not debit_success or not credit_success:
-                            execute_query("ROLLBACK", commit=True)
-                            flash('Error menyimpan jurnal rugi!', 'error')
-                            return render_template('closing_entries.html',
-                                                 current_period=period,
-                                                 closing_entries=[])
+                period_start(period)
+            except ValueError:
+                flash('Periode harus berformat YYYY-MM!', 'error')
+                return redirect(url_for('closing_entries'))
+            
+            try:
+                with transaction() as tx:
+                    result = close_books(tx, session['user_id'], period)
                 
-                # Commit all transactions
-                commit_success = execute_query("COMMIT", commit=True)
-                if commit_success:
-                    flash(f'Jurnal Penutup untuk periode {period} berhasil dibuat!', 'success')
-                else:
-                    flash('Error commit transaksi penutup!', 'error')
+                flash(f"Jurnal Penutup untuk periode {period} berhasil dibuat! "
+                      f"({result['journals']} jurnal, {result['lines']} baris, "
+                      f"laba bersih {money_format(result['net_income'])})", 'success')
                 
             except Exception as e:
-                # Rollback on error
-                execute_query("ROLLBACK", commit=True)
+                # transaction() already rolled back
                 print(f"Closing entries error: {e}")
                 flash(f'Error membuat jurnal penutup: {str(e)}', 'error')
         
         # Get closing entries history
-        closing_entries = execute_query("""
-            SELECT j.entry_no, j.date, j.description, 
-                   STRING_AGG(a.name || ' (D: ' || jd.debit || ', C: ' || jd.credit || ')', ', ') as details
-            FROM journals j
-            LEFT JOIN journal_details jd ON j.id = jd.journal_id
-            LEFT JOIN accounts a ON jd.account_code = a.code
-            WHERE j.user_id = ? AND j.description LIKE '[PENUTUP]%'
-            GROUP BY j.id, j.entry_no, j.date, j.description
-            ORDER BY j.date DESC, j.entry_no DESC
-            LIMIT 50
-        """, (session['user_id'],), fetch=True)
+        closing_entries, next_cursor = history_page('closing_journal_page', (session['user_id'],), 'entry_no')
+        attach_journal_lines(closing_entries)
         
         # Get current period
         current_period = datetime.now().strftime('%Y-%m')
         
-        return render_template('closing_entries.html',
-                             current_period=current_period,
-                             closing_entries=closing_entries or [])
-                             
-    except Exception as e:
-        print(f"Closing entries route error: {e}")
-        flash('Error loading closing entries page', 'error')
-        return render_template('closing_entries.html',
-                             current_period=datetime.now().strftime('%Y-%m'),
-                             closing_entries=[])
-
-# ============ UPDATE DATABASE SCHEMA ============
-def init_db():
-    """Initialize database tables for PostgreSQL on Railway"""
-    print("DEBUG: Initializing database tables...")
-    
-    try:
-        # Users table
-        execute_query('''
-            CREATE TABLE IF NOT EXISTS users (
-                id SERIAL PRIMARY KEY,
-                username VARCHAR(50) UNIQUE NOT NULL,
-                email VARCHAR(100) UNIQUE NOT NULL,
-                password VARCHAR(100) NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''', commit=True)
-        
-        # Accounts table (Chart of Accounts)
-        execute_query('''
-            CREATE TABLE IF NOT EXISTS accounts (
-                id SERIAL PRIMARY KEY,
-                code VARCHAR(20) UNIQUE NOT NULL,
-                name VARCHAR(100) NOT NULL,
-                type VARCHAR(50) NOT NULL,
-                normal_balance VARCHAR(10) NOT NULL,
-                balance DECIMAL(15,2) DEFAULT 0,
-                user_id INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''', commit=True)
-        
-        # Journals table
-        execute_query('''
-            CREATE TABLE IF NOT EXISTS journals (
-                id SERIAL PRIMARY KEY,
-                entry_no VARCHAR(50) NOT NULL,
-                date DATE NOT NULL,
-                description TEXT,
-                user_id INTEGER NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(entry_no, user_id)
-            )
-        ''', commit=True)
-        
-        # Journal Details table
-        execute_query('''
-            CREATE TABLE IF NOT EXISTS journal_details (
-                id SERIAL PRIMARY KEY,
-                journal_id INTEGER NOT NULL,
-                account_code VARCHAR(20) NOT NULL,
-                debit DECIMAL(15,2) DEFAULT 0,
-                credit DECIMAL(15,2) DEFAULT 0
-            )
-        ''', commit=True)
-        
-        # Adjustments table
-        execute_query('''
-            CREATE TABLE IF NOT EXISTS adjustments (
-                id SERIAL PRIMARY KEY,
-                date DATE NOT NULL,
-                description TEXT NOT NULL,
-                account_code VARCHAR(20) NOT NULL,
-                debit DECIMAL(15,2) DEFAULT 0,
-                credit DECIMAL(15,2) DEFAULT 0,
-                user_id INTEGER NOT NULL
-            )
-        ''', commit=True)
-        
-        # Inventory table
-        execute_query('''
-            CREATE TABLE IF NOT EXISTS inventory (
-                id SERIAL PRIMARY KEY,
-                code VARCHAR(20) UNIQUE NOT NULL,
-                name VARCHAR(100) NOT NULL,
-                qty INTEGER DEFAULT 0,
-                price DECIMAL(15,2) DEFAULT 0,
-                user_id INTEGER NOT NULL
-            )
-        ''', commit=True)
-        
-        # Cash Payments table
-        execute_query('''
-            CREATE TABLE IF NOT EXISTS cash_payments (
-                id SERIAL PRIMARY KEY,
-                payment_no VARCHAR(50) UNIQUE NOT NULL,
-                date DATE NOT NULL,
-                description TEXT NOT NULL,
-                account_code VARCHAR(20) NOT NULL,
-                amount DECIMAL(15,2) DEFAULT 0,
-                user_id INTEGER NOT NULL
-            )
-        ''', commit=True)
-        
-        # Cash Receipts table
-        execute_query('''
-            CREATE TABLE IF NOT EXISTS cash_receipts (
-                id SERIAL PRIMARY KEY,
-                receipt_no VARCHAR(50) UNIQUE NOT NULL,
-                date DATE NOT NULL,
-                description TEXT NOT NULL,
-                account_code VARCHAR(20) NOT NULL,
-                amount DECIMAL(15,2) DEFAULT 0,
-                user_id INTEGER NOT NULL
-            )
-        ''', commit=True)
-        
-        # Add default accounts if empty
-        accounts_count = execute_query("SELECT COUNT(*) as count FROM accounts", fetch=True)
-        if accounts_count and accounts_count[0]['count'] == 0:
-            default_accounts = [
-                ('1-1000', 'Kas', 'Asset', 'Debit', 0, None),
-                ('1-1100', 'Bank', 'Asset', 'Debit', 0, None),
-                ('1-1200', 'Piutang Usaha', 'Asset', 'Debit', 0, None),
-                ('1-1300', 'Persediaan', 'Asset', 'Debit', 0, None),
-                ('2-2000', 'Hutang Usaha', 'Liability', 'Credit', 0, None),
-                ('2-2100', 'Hutang Bank', 'Liability', 'Credit', 0, None),
-                ('3-3000', 'Modal', 'Equity', 'Credit', 0, None),
-                ('3-3100', 'Laba Ditahan', 'Equity', 'Credit', 0, None),
-                ('3-3200', 'Ikhtisar Laba Rugi', 'Equity', 'Credit', 0, None),
-                ('4-4000', 'Pendapatan Jasa', 'Revenue', 'Credit', 0, None),
-                ('4-4100', 'Pendapatan Lain', 'Revenue', 'Credit', 0, None),
-                ('5-5000', 'Beban Gaji', 'Expense', 'Debit', 0, None),
-                ('5-5100', 'Beban Sewa', 'Expense', 'Debit', 0, None),
-                ('5-5200', 'Beban Listrik', 'Expense', 'Debit', 0, None),
-                ('5-5300', 'Beban Perlengkapan', 'Expense', 'Debit', 0, None),
-            ]
-            
-            for account in default_accounts:
-                execute_query(
-                    "INSERT INTO accounts (code, name, type, normal_balance, balance, user_id) VALUES (%s, %s, %s, %s, %s, %s)",
-                    account,
-                    commit=True
-                )
-        
-        print("DEBUG: Database initialized successfully!")
-        
+        return render_template('closing_entries.html',
+                             current_period=current_period,
+                             closing_entries=closing_entries,
+                             next_cursor=next_cursor)
+                             
     except Exception as e:
-        print(f"DEBUG: Error initializing database: {e}")
-        import traceback
-        print(f"DEBUG: Traceback: {traceback.format_exc()}")
-    
+        print(f"Closing entries route error: {e}")
+        flash('Error loading closing entries page', 'error')
+        return render_template('closing_entries.html',
+                             current_period=datetime.now().strftime('%Y-%m'),
+                             closing_entries=[])
+
 # ============ TRIAL BALANCE ============
 @app.route('/trial_balance')
+@read_only_db
 def trial_balance():
     if 'user_id' not in session:
         return redirect(url_for('login'))
     
-    # Get all accounts with their balances
-    accounts_data = execute_query(
-        "SELECT code, name, type, normal_balance FROM accounts ORDER BY code", 
-        fetch=True
-    )
-    
-    accounts = []
-    total_debit = 0
-    total_credit = 0
-    
-    if accounts_data:
-        for account in accounts_data:
-            balance = get_account_balance(account['code'])
-            
-            # Determine debit/credit based on account type and normal balance
-            if account['normal_balance'] == 'Debit':  # Asset & Expense
-                debit = balance if balance >= 0 else 0
-                credit = abs(balance) if balance < 0 else 0
-            else:  # Liability, Equity, Revenue (Credit normal balance)
-                debit = abs(balance) if balance < 0 else 0
-                credit = balance if balance >= 0 else 0
-            
-            accounts.append({
-                'code': account['code'],
-                'name': account['name'],
-                'type': account['type'],
-                'debit': debit,
-                'credit': credit
-            })
-            
-            total_debit += debit
-            total_credit += credit
+    # Get all accounts with their balances (optionally limited to ?from=&to=)
+    date_from, date_to = get_report_range()
+    accounts, total_debit, total_credit = compute_trial_balance(session['user_id'], date_from=date_from, date_to=date_to)
     
     return render_template('trial_balance.html',
                          accounts=accounts,
                          total_debit=total_debit,
-                         total_credit=total_credit)
+                         total_credit=total_credit,
+                         date_from=date_from,
+                         date_to=date_to,
+                         today=date_to.isoformat() if date_to else datetime.now().strftime('%Y-%m-%d'))
 
 # ============ ADJUSTED TRIAL BALANCE ============
 @app.route('/adjusted_trial_balance')
+@read_only_db
 def adjusted_trial_balance():
     if 'user_id' not in session:
         return redirect(url_for('login'))
     
     try:
         # Get all accounts with their balances (including adjustments)
-        accounts_data = execute_query(
-            "SELECT code, name, type, normal_balance FROM accounts ORDER BY code", 
-            fetch=True
-        )
-        
-        accounts = []
-        total_debit = 0
-        total_credit = 0
-        
-        if accounts_data:
-            for account in accounts_data:
-                balance = get_account_balance(account['code'])
-                
-                # Determine debit/credit based on account type and normal balance
-                if account['normal_balance'] == 'Debit':  # Asset & Expense
-                    debit = balance if balance >= 0 else 0
-                    credit = abs(balance) if balance < 0 else 0
-                else:  # Liability, Equity, Revenue (Credit normal balance)
-                    debit = abs(balance) if balance < 0 else 0
-                    credit = balance if balance >= 0 else 0
-                
-                accounts.append({
-                    'code': account['code'],
-                    'name': account['name'],
-                    'type': account['type'],
-                    'debit': debit,
-                    'credit': credit
-                })
-                
-                total_debit += debit
-                total_credit += credit
+        date_from, date_to = get_report_range()
+        accounts, total_debit, total_credit = compute_trial_balance(session['user_id'], date_from=date_from, date_to=date_to)
         
         return render_template('adjusted_trial_balance.html',
                              accounts=accounts,
                              total_debit=total_debit,
-                             total_credit=total_credit)
+                             total_credit=total_credit,
+                             date_from=date_from,
+                             date_to=date_to)
                              
     except Exception as e:
         print(f"Adjusted trial balance error: {e}")
@@ -1621,204 +2992,110 @@ def cash_payment():
     if 'user_id' not in session:
         return redirect(url_for('login'))
     
-    # FIXED: Get accounts for dropdown
-    accounts = execute_query(
-        "SELECT code, name FROM accounts WHERE type IN ('Expense', 'Asset') AND code != '1-1000' ORDER BY code",
-        fetch=True
-    )
+    # Get accounts for dropdown (cached chart of accounts)
+    accounts = get_chart_of_accounts().of_types('Expense', 'Asset', exclude=('1-1000',))
     
     print(f"DEBUG: Cash Payment Accounts: {len(accounts) if accounts else 0}")
     
     if request.method == 'POST':
-        payment_no = request.form['payment_no']
+        # Blank: the next number of the sequence is assigned when the document is posted
+        payment_no = request.form.get('payment_no', '').strip() or None
         date = request.form['date']
         description = request.form['description']
         account_code = request.form['account_code']
         amount = safe_float(request.form['amount'])
         
-        if not payment_no or not date or not description or not account_code or amount <= 0:
+        if not date or not description or not account_code or amount <= 0:
             flash('Mohon isi semua field dengan benar!', 'error')
             return redirect(url_for('cash_payment'))
         
         try:
-            # Insert cash payment
-            success = execute_query("""
-                INSERT INTO cash_payments (payment_no, date, description, account_code, amount, user_id)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (payment_no, date, description, account_code, amount, session['user_id']), commit=True)
-            
-            if not success:
-                flash('Gagal mencatat cash payment!', 'error')
-                return redirect(url_for('cash_payment'))
-            
-            journal_entry_no = f"CP{payment_no}"
-            
-            # Insert journal entry
-            journal_success = execute_query("""
-                INSERT INTO journals (entry_no, date, description, user_id)
-                VALUES (?, ?, ?, ?)
-            """, (journal_entry_no, date, f"Cash Payment: {description}", session['user_id']), commit=True)
-            
-            if not journal_success:
-                flash('Gagal mencatat journal entry!', 'error')
-                return redirect(url_for('cash_payment'))
-            
-            # Get the last inserted journal ID
-            journal_result = execute_query(
-                "SELECT id FROM journals WHERE entry_no = ? AND user_id = ? ORDER BY id DESC LIMIT 1",
-                (journal_entry_no, session['user_id']), 
-                fetch=True
-            )
-            
-            if not journal_result or len(journal_result) == 0:
-                flash('Gagal mendapatkan journal ID!', 'error')
-                return redirect(url_for('cash_payment'))
-            
-            journal_id = journal_result[0]['id']
-            
-            # Insert journal details (Kas credit)
-            execute_query("""
-                INSERT INTO journal_details (journal_id, account_code, debit, credit)
-                VALUES (?, ?, ?, ?)
-            """, (journal_id, '1-1000', 0, amount), commit=True)
-            
-            # Insert journal details (Account debit)
-            execute_query("""
-                INSERT INTO journal_details (journal_id, account_code, debit, credit)
-                VALUES (?, ?, ?, ?)
-            """, (journal_id, account_code, amount, 0), commit=True)
+            # Payment row, journal and balances commit (or roll back) together
+            with transaction() as tx:
+                def post():
+                    # Payment row plus journal (Kas credit, Account debit)
+                    post_cash_document(tx, session['user_id'], 'cash_payment', payment_no, date,
+                                       description, account_code, amount)
+                    return {'message': 'Cash Payment berhasil dicatat!', 'category': 'success'}
+                
+                result, _ = idempotent_post(tx, session['user_id'], post)
             
-            flash('Cash Payment berhasil dicatat!', 'success')
+            flash(result['message'], result['category'])
             
+        except PeriodLocked as e:
+            flash(str(e), 'error')
         except Exception as e:
             print(f"Cash payment error: {e}")
             flash(f'Error: {str(e)}', 'error')
     
-    # Get payment count
-    payment_count_result = execute_query(
-        "SELECT COUNT(*) as count FROM cash_payments WHERE user_id = ?",
-        (session['user_id'],),
-        fetch=True
-    )
-    payment_count = payment_count_result[0]['count'] if payment_count_result else 0
+    # Suggested payment number and payment count (read-only; the number is taken on posting)
+    next_number, payment_count = peek_document_number(session['user_id'], 'cash_payment')
     
     # Get recent payments
-    payments = execute_query("""
-        SELECT cp.payment_no, cp.date, cp.description, a.name as account_name, cp.amount
-        FROM cash_payments cp
-        JOIN accounts a ON cp.account_code = a.code
-        WHERE cp.user_id = ?
-        ORDER BY cp.date DESC, cp.payment_no DESC
-        LIMIT 50
-    """, (session['user_id'],), fetch=True)
+    payments, next_cursor = history_page('cash_payment_page', (session['user_id'],), 'payment_no')
     
     return render_template('cash_payment.html',
                          accounts=accounts or [],
+                         next_number=next_number,
                          payment_count=payment_count,
                          today=datetime.now().strftime('%Y-%m-%d'),
-                         payments=payments or [])
+                         payments=payments,
+                         next_cursor=next_cursor)
 
 @app.route('/cash_receipt', methods=['GET', 'POST'])
 def cash_receipt():
     if 'user_id' not in session:
         return redirect(url_for('login'))
     
-    # FIXED: Get accounts for dropdown
-    accounts = execute_query(
-        "SELECT code, name FROM accounts WHERE type IN ('Revenue', 'Liability') ORDER BY code",
-        fetch=True
-    )
+    # Get accounts for dropdown (cached chart of accounts)
+    accounts = get_chart_of_accounts().of_types('Revenue', 'Liability')
     
     print(f"DEBUG: Cash Receipt Accounts: {len(accounts) if accounts else 0}")
     
     if request.method == 'POST':
-        receipt_no = request.form['receipt_no']
+        # Blank: the next number of the sequence is assigned when the document is posted
+        receipt_no = request.form.get('receipt_no', '').strip() or None
         date = request.form['date']
         description = request.form['description']
         account_code = request.form['account_code']
         amount = safe_float(request.form['amount'])
         
-        if not receipt_no or not date or not description or not account_code or amount <= 0:
+        if not date or not description or not account_code or amount <= 0:
             flash('Mohon isi semua field dengan benar!', 'error')
             return redirect(url_for('cash_receipt'))
         
         try:
-            # Insert cash receipt
-            success = execute_query("""
-                INSERT INTO cash_receipts (receipt_no, date, description, account_code, amount, user_id)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (receipt_no, date, description, account_code, amount, session['user_id']), commit=True)
-            
-            if not success:
-                flash('Gagal mencatat cash receipt!', 'error')
-                return redirect(url_for('cash_receipt'))
-            
-            journal_entry_no = f"CR{receipt_no}"
-            
-            # Insert journal entry
-            journal_success = execute_query("""
-                INSERT INTO journals (entry_no, date, description, user_id)
-                VALUES (?, ?, ?, ?)
-            """, (journal_entry_no, date, f"Cash Receipt: {description}", session['user_id']), commit=True)
-            
-            if not journal_success:
-                flash('Gagal mencatat journal entry!', 'error')
-                return redirect(url_for('cash_receipt'))
-            
-            # Get the last inserted journal ID
-            journal_result = execute_query(
-                "SELECT id FROM journals WHERE entry_no = ? AND user_id = ? ORDER BY id DESC LIMIT 1",
-                (journal_entry_no, session['user_id']), 
-                fetch=True
-            )
-            
-            if not journal_result or len(journal_result) == 0:
-                flash('Gagal mendapatkan journal ID!', 'error')
-                return redirect(url_for('cash_receipt'))
-            
-            journal_id = journal_result[0]['id']
-            
-            # Insert journal details (Kas debit)
-            execute_query("""
-                INSERT INTO journal_details (journal_id, account_code, debit, credit)
-                VALUES (?, ?, ?, ?)
-            """, (journal_id, '1-1000', amount, 0), commit=True)
-            
-            # Insert journal details (Account credit)
-            execute_query("""
-                INSERT INTO journal_details (journal_id, account_code, debit, credit)
-                VALUES (?, ?, ?, ?)
-            """, (journal_id, account_code, 0, amount), commit=True)
+            # Receipt row, journal and balances commit (or roll back) together
+            with transaction() as tx:
+                def post():
+                    # Receipt row plus journal (Kas debit, Account credit)
+                    post_cash_document(tx, session['user_id'], 'cash_receipt', receipt_no, date,
+                                       description, account_code, amount)
+                    return {'message': 'Cash Receipt berhasil dicatat!', 'category': 'success'}
+                
+                result, _ = idempotent_post(tx, session['user_id'], post)
             
-            flash('Cash Receipt berhasil dicatat!', 'success')
+            flash(result['message'], result['category'])
             
+        except PeriodLocked as e:
+            flash(str(e), 'error')
         except Exception as e:
             print(f"Cash receipt error: {e}")
             flash(f'Error: {str(e)}', 'error')
     
-    # Get receipt count
-    receipt_count_result = execute_query(
-        "SELECT COUNT(*) as count FROM cash_receipts WHERE user_id = ?",
-        (session['user_id'],),
-        fetch=True
-    )
-    receipt_count = receipt_count_result[0]['count'] if receipt_count_result else 0
+    # Suggested receipt number and receipt count (read-only; the number is taken on posting)
+    next_number, receipt_count = peek_document_number(session['user_id'], 'cash_receipt')
     
     # Get recent receipts
-    receipts = execute_query("""
-        SELECT cr.receipt_no, cr.date, cr.description, a.name as account_name, cr.amount
-        FROM cash_receipts cr
-        JOIN accounts a ON cr.account_code = a.code
-        WHERE cr.user_id = ?
-        ORDER BY cr.date DESC, cr.receipt_no DESC
-        LIMIT 50
-    """, (session['user_id'],), fetch=True)
+    receipts, next_cursor = history_page('cash_receipt_page', (session['user_id'],), 'receipt_no')
     
     return render_template('cash_receipt.html',
                          accounts=accounts or [],
+                         next_number=next_number,
                          receipt_count=receipt_count,
                          today=datetime.now().strftime('%Y-%m-%d'),
-                         receipts=receipts or [])
+                         receipts=receipts,
+                         next_cursor=next_cursor)
 
 @app.route('/inventory', methods=['GET', 'POST'])
 def inventory():
@@ -1838,7 +3115,7 @@ def inventory():
         try:
             # Check if item already exists
             existing_items = execute_query(
-                "SELECT id, qty FROM inventory WHERE code = %s AND user_id = %s",
+                "SELECT id, qty FROM inventory WHERE code = ? AND user_id = ?",
                 (code, session['user_id']),
                 fetch=True
             )
@@ -1848,7 +3125,7 @@ def inventory():
                 existing = existing_items[0]
                 new_qty = existing['qty'] + qty
                 success = execute_query(
-                    "UPDATE inventory SET qty = %s, price = %s, name = %s WHERE id = %s",
+                    "UPDATE inventory SET qty = ?, price = ?, name = ? WHERE id = ?",
                     (new_qty, price, name, existing['id']),
                     commit=True
                 )
@@ -1859,7 +3136,7 @@ def inventory():
             else:
                 # Insert new item
                 success = execute_query(
-                    "INSERT INTO inventory (code, name, qty, price, user_id) VALUES (%s, %s, %s, %s, %s)",
+                    "INSERT INTO inventory (code, name, qty, price, user_id) VALUES (?, ?, ?, ?, ?)",
                     (code, name, qty, price, session['user_id']),
                     commit=True
                 )
@@ -1874,7 +3151,7 @@ def inventory():
     
     # Get inventory items
     items = execute_query(
-        "SELECT code, name, qty, price FROM inventory WHERE user_id = %s ORDER BY code",
+        "SELECT code, name, qty, price FROM inventory WHERE user_id = ? ORDER BY code",
         (session['user_id'],),
         fetch=True
     )
@@ -1882,108 +3159,42 @@ def inventory():
     return render_template('inventory.html', items=items or [])
 
 @app.route('/reports')
+@read_only_db
 def reports():
     try:
         if 'user_id' not in session:
             return redirect(url_for('login'))
         
-        # Helper function to get account balance
-        def get_account_balance(account_code):
-            try:
-                result = execute_query("""
-                    SELECT COALESCE(SUM(
-                        CASE 
-                            WHEN a.normal_balance = 'Debit' THEN jd.debit - jd.credit
-                            ELSE jd.credit - jd.debit
-                        END
-                    ), 0) as balance
-                    FROM journal_details jd
-                    JOIN journals j ON jd.journal_id = j.id
-                    JOIN accounts a ON jd.account_code = a.code
-                    WHERE jd.account_code = ? AND j.user_id = ?
-                """, (account_code, session['user_id']), fetch=True)
-                
-                return result[0]['balance'] if result and len(result) > 0 else 0
-            except Exception as e:
-                print(f"Error getting balance for {account_code}: {e}")
-                return 0
-        
-        # Get revenue accounts with balances
-        revenues = execute_query("""
-            SELECT a.code, a.name, 
-                   COALESCE((SELECT COALESCE(SUM(jd.credit - jd.debit), 0) 
-                    FROM journal_details jd 
-                    JOIN journals j ON jd.journal_id = j.id
-                    WHERE jd.account_code = a.code AND j.user_id = ?), 0) as balance
-            FROM accounts a
-            WHERE a.type = 'Revenue'
-            ORDER BY a.code
-        """, (session['user_id'],), fetch=True)
-        
-        # Get expense accounts with balances
-        expenses = execute_query("""
-            SELECT a.code, a.name, 
-                   COALESCE((SELECT COALESCE(SUM(jd.debit - jd.credit), 0) 
-                    FROM journal_details jd 
-                    JOIN journals j ON jd.journal_id = j.id
-                    WHERE jd.account_code = a.code AND j.user_id = ?), 0) as balance
-            FROM accounts a
-            WHERE a.type = 'Expense'
-            ORDER BY a.code
-        """, (session['user_id'],), fetch=True)
+        # Income statement covers ?from=&to=, the balance sheet is as of ?to= (all time by default)
+        date_from, date_to = get_report_range()
+        all_accounts, _, _ = compute_trial_balance(session['user_id'], date_to=date_to)
+        balances = {account['code']: account['balance'] for account in all_accounts}
+        if date_from is not None:
+            period_accounts, _, _ = compute_trial_balance(session['user_id'], ('Revenue', 'Expense'), date_from, date_to)
+        else:
+            period_accounts = all_accounts
+        
+        def accounts_of_type(account_type, source=all_accounts):
+            return [{
+                'code': account['code'],
+                'name': account['name'],
+                'balance': account['balance'],
+                'normal_balance': account['normal_balance']
+            } for account in source if account['type'] == account_type]
+        
+        # Get revenue and expense accounts with balances
+        revenues = accounts_of_type('Revenue', period_accounts)
+        expenses = accounts_of_type('Expense', period_accounts)
         
         # Calculate totals
-        total_revenue = sum(row['balance'] for row in revenues) if revenues else 0
-        total_expense = sum(row['balance'] for row in expenses) if expenses else 0
+        total_revenue = sum(row['balance'] for row in revenues)
+        total_expense = sum(row['balance'] for row in expenses)
         net_income = total_revenue - total_expense
         
-        # Get asset accounts with balances
-        asset_accounts = execute_query(
-            "SELECT code, name, type, normal_balance FROM accounts WHERE type = 'Asset' ORDER BY code",
-            fetch=True
-        )
-        assets = []
-        if asset_accounts:
-            for row in asset_accounts:
-                balance = get_account_balance(row['code'])
-                assets.append({
-                    'code': row['code'],
-                    'name': row['name'], 
-                    'balance': balance,
-                    'normal_balance': row['normal_balance']
-                })
-        
-        # Get liability accounts with balances
-        liability_accounts = execute_query(
-            "SELECT code, name, type, normal_balance FROM accounts WHERE type = 'Liability' ORDER BY code",
-            fetch=True
-        )
-        liabilities = []
-        if liability_accounts:
-            for row in liability_accounts:
-                balance = get_account_balance(row['code'])
-                liabilities.append({
-                    'code': row['code'],
-                    'name': row['name'],
-                    'balance': balance,
-                    'normal_balance': row['normal_balance']
-                })
-        
-        # Get equity accounts with balances
-        equity_accounts = execute_query(
-            "SELECT code, name, type, normal_balance FROM accounts WHERE type = 'Equity' ORDER BY code",
-            fetch=True
-        )
-        equities = []
-        if equity_accounts:
-            for row in equity_accounts:
-                balance = get_account_balance(row['code'])
-                equities.append({
-                    'code': row['code'],
-                    'name': row['name'],
-                    'balance': balance,
-                    'normal_balance': row['normal_balance']
-                })
+        # Get asset, liability and equity accounts with balances
+        assets = accounts_of_type('Asset')
+        liabilities = accounts_of_type('Liability')
+        equities = accounts_of_type('Equity')
         
         # Calculate balance sheet totals (absolute values for display)
         total_assets = sum(abs(item['balance']) for item in assets)
@@ -1991,31 +3202,13 @@ def reports():
         total_equity = sum(abs(item['balance']) for item in equities)
         
         # Equity Change Report
-        beginning_equity = get_account_balance('3-3000')  # Modal account
+        beginning_equity = balances.get('3-3000', 0)  # Modal account
         
         # Get owner's contributions (additional investments)
-        investments_result = execute_query("""
-            SELECT COALESCE(SUM(jd.credit - jd.debit), 0) as investments
-            FROM journal_details jd
-            JOIN journals j ON jd.journal_id = j.id
-            WHERE jd.account_code = '3-3000' AND j.user_id = ?
-        """, (session['user_id'],), fetch=True)
-        additional_investments = investments_result[0]['investments'] if investments_result and len(investments_result) > 0 else 0
-        
-        # Get owner's withdrawals (prive) - check if prive account exists
-        withdrawals_result = execute_query("""
-            SELECT COALESCE(SUM(
-                CASE 
-                    WHEN a.normal_balance = 'Debit' THEN jd.debit - jd.credit
-                    ELSE jd.credit - jd.debit
-                END
-            ), 0) as withdrawals
-            FROM journal_details jd
-            JOIN journals j ON jd.journal_id = j.id
-            JOIN accounts a ON jd.account_code = a.code
-            WHERE jd.account_code = '3-3300' AND j.user_id = ?
-        """, (session['user_id'],), fetch=True)
-        owner_withdrawals = abs(withdrawals_result[0]['withdrawals']) if withdrawals_result and len(withdrawals_result) > 0 else 0
+        additional_investments = balances.get('3-3000', 0)
+        
+        # Get owner's withdrawals (prive) - if a prive account exists
+        owner_withdrawals = abs(balances.get('3-3300', 0))
         
         # Calculate ending equity
         ending_equity = beginning_equity + net_income + additional_investments - owner_withdrawals
@@ -2036,6 +3229,8 @@ def reports():
                              additional_investments=additional_investments,
                              owner_withdrawals=owner_withdrawals,
                              ending_equity=ending_equity,
+                             date_from=date_from,
+                             date_to=date_to,
                              today=datetime.now().strftime('%Y-%m-%d'))
                              
     except Exception as e:
@@ -2062,6 +3257,7 @@ def reports():
                              today=datetime.now().strftime('%Y-%m-%d'))
     
 @app.route('/ledger')
+@read_only_db
 def ledger():
     if 'user_id' not in session:
         return redirect(url_for('login'))
@@ -2069,31 +3265,36 @@ def ledger():
     account_code = request.args.get('account_code', '')
     
     try:
-        # Get all accounts for dropdown
-        accounts = execute_query(
-            "SELECT code, name FROM accounts ORDER BY code",
-            fetch=True
-        )
+        # Get all accounts for dropdown (cached chart of accounts)
+        accounts = get_chart_of_accounts().accounts
         
         print(f"DEBUG: Ledger accounts: {len(accounts) if accounts else 0}")
         
+        date_from, date_to = get_report_range()
         ledger_data = []
-        if account_code:
-            # Get ledger entries for selected account
-            ledger_data = execute_query("""
-                SELECT j.date, j.entry_no, j.description, jd.debit, jd.credit
-                FROM journal_details jd
-                JOIN journals j ON jd.journal_id = j.id
-                WHERE jd.account_code = ? AND j.user_id = ?
-                ORDER BY j.date, j.entry_no
-            """, (account_code, session['user_id']), fetch=True)
+        opening_balance = closing_balance = 0.0
+        next_cursor = None
+        account = get_chart_of_accounts().get(account_code) if account_code else None
+        if account:
+            # One page of ledger entries for the selected account, with running balance
+            opening_balance, ledger_data, next_cursor = ledger_page(
+                session['user_id'], account, date_from, date_to)
+            if date_to:
+                closing_balance = ledger_opening_balance(session['user_id'], account, date_to + timedelta(days=1))
+            else:
+                closing_balance = get_account_balance(account_code)
             
-            print(f"DEBUG: Ledger data for {account_code}: {len(ledger_data) if ledger_data else 0}")
+            print(f"DEBUG: Ledger page for {account_code}: {len(ledger_data)}")
         
         return render_template('ledger.html', 
                              accounts=accounts or [], 
                              selected_account=account_code,
-                             ledger_data=ledger_data or [])
+                             ledger_data=ledger_data,
+                             opening_balance=opening_balance,
+                             closing_balance=closing_balance,
+                             next_cursor=next_cursor,
+                             date_from=date_from,
+                             date_to=date_to)
                              
     except Exception as e:
         print(f"Ledger error: {e}")
@@ -2102,94 +3303,547 @@ def ledger():
 
 # ============ POST-CLOSING TRIAL BALANCE ============
 @app.route('/post_closing_trial_balance')
+@read_only_db
 def post_closing_trial_balance():
     if 'user_id' not in session:
         return redirect(url_for('login'))
     
     try:
-        # Get only permanent accounts (Asset, Liability, Equity) after closing entries
-        accounts_data = execute_query(
-            "SELECT code, name, type, normal_balance FROM accounts WHERE type IN ('Asset', 'Liability', 'Equity') ORDER BY code",
-            fetch=True
-        )
-        
-        accounts = []
-        total_debit = 0
-        total_credit = 0
+        # Permanent and temporary accounts in one lookup (cumulative, optionally ?as_of=)
+        _, as_of = get_report_range()
+        all_accounts, _, _ = compute_trial_balance(session['user_id'], date_to=as_of)
         
-        if accounts_data:
-            for account in accounts_data:
-                balance = get_account_balance(account['code'])
-                
-                # For post-closing, we only show permanent accounts
-                # Determine debit/credit based on account type and normal balance
-                if account['normal_balance'] == 'Debit':  # Asset accounts
-                    debit = balance if balance >= 0 else 0
-                    credit = abs(balance) if balance < 0 else 0
-                else:  # Liability & Equity accounts (Credit normal balance)
-                    debit = abs(balance) if balance < 0 else 0
-                    credit = balance if balance >= 0 else 0
-                
-                accounts.append({
-                    'code': account['code'],
-                    'name': account['name'],
-                    'type': account['type'],
-                    'debit': debit,
-                    'credit': credit
-                })
-                
-                total_debit += debit
-                total_credit += credit
-        
-        # Check if temporary accounts have zero balances (proper closing)
-        revenue_balances = execute_query("""
-            SELECT a.code, a.name, 
-                   COALESCE(SUM(jd.credit - jd.debit), 0) as balance
-            FROM accounts a
-            LEFT JOIN journal_details jd ON a.code = jd.account_code
-            LEFT JOIN journals j ON jd.journal_id = j.id
-            WHERE a.type = 'Revenue' AND j.user_id = %s
-            GROUP BY a.code, a.name
-        """, (session['user_id'],), fetch=True)
-        
-        expense_balances = execute_query("""
-            SELECT a.code, a.name, 
-                   COALESCE(SUM(jd.debit - jd.credit), 0) as balance
-            FROM accounts a
-            LEFT JOIN journal_details jd ON a.code = jd.account_code
-            LEFT JOIN journals j ON jd.journal_id = j.id
-            WHERE a.type = 'Expense' AND j.user_id = %s
-            GROUP BY a.code, a.name
-        """, (session['user_id'],), fetch=True)
-        
-        # Check if all temporary accounts have zero balance
-        all_temporary_zero = True
-        temporary_accounts_with_balance = []
-        
-        if revenue_balances:
-            for revenue in revenue_balances:
-                if abs(revenue['balance']) > 0.01:  # Allow for rounding differences
-                    all_temporary_zero = False
-                    temporary_accounts_with_balance.append(revenue)
-        
-        if expense_balances:
-            for expense in expense_balances:
-                if abs(expense['balance']) > 0.01:  # Allow for rounding differences
-                    all_temporary_zero = False
-                    temporary_accounts_with_balance.append(expense)
+        # Get only permanent accounts (Asset, Liability, Equity) after closing entries
+        accounts = [account for account in all_accounts
+                    if account['type'] in ('Asset', 'Liability', 'Equity')]
+        total_debit = sum(account['debit'] for account in accounts)
+        total_credit = sum(account['credit'] for account in accounts)
+        
+        # Check if all temporary accounts have zero balance (proper closing)
+        temporary_accounts_with_balance = [
+            {'code': account['code'], 'name': account['name'], 'balance': account['balance']}
+            for account in all_accounts
+            if account['type'] in ('Revenue', 'Expense') and abs(account['balance']) > 0.01  # Allow for rounding differences
+        ]
+        all_temporary_zero = not temporary_accounts_with_balance
         
         return render_template('post_closing_trial_balance.html',
                              accounts=accounts,
                              total_debit=total_debit,
                              total_credit=total_credit,
                              all_temporary_zero=all_temporary_zero,
-                             temporary_accounts_with_balance=temporary_accounts_with_balance or [])
+                             temporary_accounts_with_balance=temporary_accounts_with_balance or [],
+                             date_to=as_of,
+                             today=as_of.isoformat() if as_of else datetime.now().strftime('%Y-%m-%d'))
                              
     except Exception as e:
         print(f"Post-closing trial balance error: {e}")
         flash('Error loading post-closing trial balance', 'error')
         return redirect(url_for('dashboard'))
 
+# ============ EXPORT ============
+# Rows per fetch from the server-side cursor, and per chunk written to the client
+EXPORT_FETCH_SIZE = int(os.environ.get('EXPORT_FETCH_SIZE', '2000'))
+EXPORT_FORMATS = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+
+def stream_query(name, params=()):
+    """Yield the rows of a registered query as dicts without loading the result set.
+
+    Runs on its own read connection (the response outlives the request's one):
+    a named server-side cursor on PostgreSQL, stepped fetchmany() on SQLite.
+    """
+    conn = PooledConnection(get_read_pool())
+    try:
+        if use_postgres():
+            # Named cursors only live inside a transaction: pooled connections are autocommit,
+            # so hold this one in a real (read-only) transaction for the whole stream
+            conn.raw.autocommit = False
+            conn.cursor().execute("SET TRANSACTION READ ONLY")
+            cursor = conn.raw.cursor(name=f"export_{secrets.token_hex(4)}")
+            cursor.itersize = EXPORT_FETCH_SIZE
+        else:
+            cursor = conn.cursor()
+        cursor.execute(QUERIES[name].direct_sql, params)
+        columns = None
+        while True:
+            rows = cursor.fetchmany(EXPORT_FETCH_SIZE)
+            if not rows:
+                break
+            if columns is None:
+                columns = [desc[0] for desc in cursor.description]
+            for row in rows:
+                yield dict(zip(columns, row))
+        cursor.close()
+    finally:
+        # Rolls back the read-only transaction, also when the client disconnects mid-stream
+        if use_postgres():
+            try:
+                conn.raw.rollback()
+                conn.raw.autocommit = True
+            except Exception as e:
+                print(f"DEBUG: Discarding export connection: {e}")
+                conn.release(discard=True)
+        conn.release()
+
+def export_value(value):
+    """CSV/JSON-friendly form of a column value"""
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if value is not None and not isinstance(value, (str, int, float)):
+        return float(value)  # Decimal from PostgreSQL
+    return value
+
+def export_response(filename, columns, rows, fmt):
+    """Streamed CSV or JSON Lines download of `rows` (an iterable of dicts)"""
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if fmt == 'csv':
+            writer.writerow(columns)
+            # Header goes out before the first row is fetched
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        for count, row in enumerate(rows, 1):
+            values = [export_value(row[column]) for column in columns]
+            if fmt == 'csv':
+                writer.writerow(values)
+            else:
+                buffer.write(json.dumps(dict(zip(columns, values))) + '\n')
+            if count % EXPORT_FETCH_SIZE == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    
+    return Response(generate(), mimetype=EXPORT_FORMATS[fmt],
+                    headers={'Content-Disposition': f'attachment; filename={filename}.{fmt}'})
+
+def export_format():
+    """?format= of an export request (csv by default); None when unsupported"""
+    fmt = request.args.get('format', 'csv')
+    return fmt if fmt in EXPORT_FORMATS else None
+
+def date_bounds(date_from, date_to):
+    """Inclusive ISO date bounds for an optional report range"""
+    return (date_from.isoformat() if date_from else LEDGER_START[0],
+            date_to.isoformat() if date_to else KEYSET_START[0])
+
+@app.route('/export/journal')
+@read_only_db
+def export_journal():
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    
+    fmt = export_format()
+    if fmt is None:
+        flash('Format ekspor tidak dikenal!', 'error')
+        return redirect(url_for('journal'))
+    
+    params = (session['user_id'],) + date_bounds(*get_report_range())
+    catalog = get_chart_of_accounts()
+    def rows():
+        for line in stream_query('export_journal_lines', params):
+            account = catalog.get(line['account_code'])
+            line['account_name'] = account['name'] if account else ''
+            yield line
+    
+    return export_response('jurnal_umum',
+                           ['entry_no', 'date', 'description', 'account_code', 'account_name', 'debit', 'credit'],
+                           rows(), fmt)
+
+@app.route('/export/ledger')
+@read_only_db
+def export_ledger():
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    
+    fmt = export_format()
+    account = get_chart_of_accounts().get(request.args.get('account_code', ''))
+    if fmt is None or account is None:
+        flash('Pilih akun dan format ekspor yang valid!', 'error')
+        return redirect(url_for('ledger'))
+    
+    user_id = session['user_id']
+    date_from, date_to = get_report_range()
+    params = (user_id, account['code']) + date_bounds(date_from, date_to)
+    opening = ledger_opening_balance(user_id, account, date_from)
+    sign = 1 if account['normal_balance'] == 'Debit' else -1
+    def rows():
+        # Running balance carried forward in Python: the stream is already in ledger order
+        balance = opening
+        for line in stream_query('export_ledger_lines', params):
+            balance += sign * (float(line['debit'] or 0) - float(line['credit'] or 0))
+            line['balance'] = balance
+            yield line
+    
+    return export_response(f"buku_besar_{account['code']}",
+                           ['date', 'entry_no', 'description', 'debit', 'credit', 'balance'],
+                           rows(), fmt)
+
+@app.route('/export/trial_balance')
+@read_only_db
+def export_trial_balance():
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    
+    fmt = export_format()
+    if fmt is None:
+        flash('Format ekspor tidak dikenal!', 'error')
+        return redirect(url_for('trial_balance'))
+    
+    # One row per account: already bounded by the chart of accounts
+    date_from, date_to = get_report_range()
+    accounts, _, _ = compute_trial_balance(session['user_id'], date_from=date_from, date_to=date_to)
+    return export_response('neraca_saldo', ['code', 'name', 'type', 'debit', 'credit'], accounts, fmt)
+
+# ============ IMPORT ============
+# Journal lines written per batch; balances are applied per batch as well
+IMPORT_CHUNK_SIZE = int(os.environ.get('IMPORT_CHUNK_SIZE', '5000'))
+# Validation keeps going after the first problem, up to this many errors
+IMPORT_MAX_ERRORS = int(os.environ.get('IMPORT_MAX_ERRORS', '100'))
+# Same columns as /export/journal (account_name is ignored), so exports re-import as-is
+IMPORT_COLUMNS = ('entry_no', 'date', 'description', 'account_code', 'debit', 'credit')
+
+class JournalImportError(Exception):
+    """An import file or API batch was rejected; errors is a list of (location, message).
+
+    The location is the first line number of the problem for files, (entry, line)
+    indexes for the JSON API.
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__(f"{len(errors)} error(s) in import file")
+
+def import_format(filename, fmt=None):
+    """csv or jsonl, from an explicit format or the file extension"""
+    if fmt:
+        return fmt
+    return 'jsonl' if filename.lower().endswith(('.jsonl', '.ndjson', '.json')) else 'csv'
+
+def read_import_rows(stream, fmt):
+    """Yield (line number, row dict) from a CSV (with header row) or JSON Lines text stream"""
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        missing = [column for column in IMPORT_COLUMNS if column not in (reader.fieldnames or [])]
+        if missing:
+            raise JournalImportError([(1, f"Kolom tidak ditemukan: {', '.join(missing)}")])
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line_no, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            raise JournalImportError([(line_no, f"JSON tidak valid: {e}")])
+        if not isinstance(row, dict):
+            raise JournalImportError([(line_no, "Setiap baris harus berupa objek JSON")])
+        yield line_no, row
+
+def parse_amount(value):
+    """Non-negative amount of an import cell (blank is 0); ValueError otherwise"""
+    amount = float(value) if value not in (None, '') else 0.0
+    if amount < 0 or amount != amount:
+        raise ValueError(value)
+    return amount
+
+def group_import_rows(rows):
+    """(entry_no, [(line number, row), ...]) per run of consecutive rows of one entry"""
+    for entry_no, group in groupby(rows, key=lambda item: str(item[1].get('entry_no') or '').strip()):
+        yield entry_no, list(group)
+
+def validate_import_entry(entry_no, rows, catalog, closed_period):
+    """Check one entry's rows; returns (journal_date, description, lines, errors).
+
+    lines are (account_code, debit, credit) with zero lines dropped, like the journal form.
+    """
+    errors = []
+    first_line = rows[0][0]
+    journal_date = str(rows[0][1].get('date') or '').strip()
+    description = next((str(row.get('description')).strip() for _, row in rows if row.get('description')), '')
+    if not entry_no:
+        errors.append((first_line, "Nomor entri kosong"))
+    try:
+        parsed = parse_report_date(journal_date)
+        if parsed is None:
+            errors.append((first_line, f"Tanggal entri {entry_no} kosong"))
+        else:
+            # strptime also takes '2025-5-5'; everything downstream (periods, rollups) needs ISO dates
+            journal_date = parsed.isoformat()
+            if closed_period is not None and period_of(journal_date) <= closed_period:
+                errors.append((first_line, f"Periode {period_of(journal_date)} sudah ditutup"))
+    except ValueError:
+        errors.append((first_line, f"Tanggal '{journal_date}' harus YYYY-MM-DD"))
+    if not description:
+        errors.append((first_line, f"Deskripsi entri {entry_no} kosong"))
+    
+    lines = []
+    for line_no, row in rows:
+        line_date = str(row.get('date') or '').strip()
+        if line_date and line_date != journal_date:
+            try:
+                same_date = parse_report_date(line_date).isoformat() == journal_date
+            except ValueError:
+                same_date = False
+            if not same_date:
+                errors.append((line_no, f"Tanggal berbeda dalam entri {entry_no}"))
+        account_code = str(row.get('account_code') or '').strip()
+        if catalog.get(account_code) is None:
+            errors.append((line_no, f"Akun '{account_code}' tidak ada"))
+        try:
+            debit, credit = parse_amount(row.get('debit')), parse_amount(row.get('credit'))
+        except ValueError:
+            errors.append((line_no, "Debit/kredit harus angka positif"))
+            continue
+        if debit > 0 and credit > 0:
+            errors.append((line_no, "Satu baris tidak boleh berisi debit dan kredit sekaligus"))
+        elif debit > 0 or credit > 0:
+            lines.append((account_code, debit, credit))
+    
+    total_debit = sum(line[1] for line in lines)
+    total_credit = sum(line[2] for line in lines)
+    if not lines:
+        errors.append((first_line, f"Entri {entry_no} tidak memiliki baris"))
+    elif abs(total_debit - total_credit) > 0.01:
+        errors.append((first_line, f"Entri {entry_no} tidak seimbang: debit {total_debit:,.2f}, kredit {total_credit:,.2f}"))
+    return journal_date, description, lines, errors
+
+def post_journal_entries(tx, user_id, entries):
+    """Validate and post (entry_no, [(location, row dict), ...]) entries in the caller's transaction.
+
+    Entries are validated against the cached chart of accounts and written
+    IMPORT_CHUNK_SIZE lines at a time (headers, lines and balance deltas each as one
+    batched statement). Any error raises JournalImportError with every problem found,
+    and the caller's transaction rolls back. The summary maps entry_no to the new
+    journal id under 'ids'.
+    """
+    catalog = get_chart_of_accounts()
+    lock_user_periods(tx, user_id)
+    closed_period = latest_closed_period(tx, user_id)
+    errors = []
+    seen = set()
+    chunk = {}
+    summary = {'journals': 0, 'lines': 0, 'total_debit': 0.0, 'ids': {}}
+    
+    def flush():
+        entries = dict(chunk)
+        chunk.clear()
+        if errors or not entries:
+            return
+        placeholders = ', '.join('?' * len(entries))
+        entry_nos = tuple(entries)
+        for row in tx.fetch(f"SELECT entry_no FROM journals WHERE user_id = ? AND entry_no IN ({placeholders})",
+                            (user_id,) + entry_nos):
+            errors.append((entries[row['entry_no']][0], f"Nomor entri {row['entry_no']} sudah ada"))
+        if errors:
+            return
+        tx.insert_many('journals', ('entry_no', 'date', 'description', 'user_id'),
+                       [(entry_no, journal_date, description, user_id)
+                        for entry_no, (_, journal_date, description, _) in entries.items()])
+        count_documents(tx, user_id, 'journal', len(entries), entries)
+        ids = {row['entry_no']: row['id'] for row in tx.fetch(
+            f"SELECT id, entry_no FROM journals WHERE user_id = ? AND entry_no IN ({placeholders})",
+            (user_id,) + entry_nos)}
+        lines = [(ids[entry_no], account_code, debit, credit, journal_date)
+                 for entry_no, (_, journal_date, _, entry_lines) in entries.items()
+                 for account_code, debit, credit in entry_lines]
+        tx.insert_many('journal_details', JOURNAL_LINE_COLUMNS, [line[:4] + (user_id, line[4]) for line in lines])
+        run_posting_hooks(tx, user_id, [line[1:] for line in lines])
+        summary['ids'].update(ids)
+        summary['journals'] += len(entries)
+        summary['lines'] += len(lines)
+        summary['total_debit'] += sum(line[2] for line in lines)
+    
+    pending_lines = 0
+    for entry_no, group in entries:
+        if entry_no and entry_no in seen:
+            errors.append((group[0][0], f"Nomor entri {entry_no} muncul lebih dari sekali "
+                                        f"(baris satu entri harus berurutan)"))
+        else:
+            seen.add(entry_no)
+            journal_date, description, lines, entry_errors = validate_import_entry(
+                entry_no, group, catalog, closed_period)
+            errors.extend(entry_errors)
+            if not entry_errors and not errors:
+                chunk[entry_no] = (group[0][0], journal_date, description, lines)
+                pending_lines += len(lines)
+        if len(errors) >= IMPORT_MAX_ERRORS:
+            break
+        if pending_lines >= IMPORT_CHUNK_SIZE:
+            flush()
+            pending_lines = 0
+    flush()
+    
+    if errors:
+        raise JournalImportError(sorted(errors)[:IMPORT_MAX_ERRORS])
+    return summary
+
+def import_journals(tx, user_id, rows):
+    """Post (line number, row dict) pairs of an import file; rows of one entry must be consecutive"""
+    return post_journal_entries(tx, user_id, group_import_rows(rows))
+
+@app.cli.command('import-journals')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--user', 'user_id', type=int, required=True, help='Post the entries for this user')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), default=None,
+              help='File format (default: from the file extension)')
+def import_journals_command(path, user_id, fmt):
+    """Import journal entries from a CSV or JSON Lines file in one transaction.
+
+    Columns: entry_no, date, description, account_code, debit, credit (one row per line).
+    """
+    started = time.monotonic()
+    try:
+        with open(path, newline='', encoding='utf-8-sig') as stream:
+            with transaction() as tx:
+                summary = import_journals(tx, user_id, read_import_rows(stream, import_format(path, fmt)))
+    except JournalImportError as e:
+        for line_no, message in e.errors:
+            click.echo(f"line {line_no}: {message}", err=True)
+        click.echo(f"Import rejected, nothing was written ({len(e.errors)} errors)", err=True)
+        raise SystemExit(1)
+    click.echo(f"Imported {summary['journals']} journals / {summary['lines']} lines "
+               f"in {time.monotonic() - started:.1f}s")
+
+@app.route('/import_journals', methods=['POST'])
+def import_journals_upload():
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    
+    upload = request.files.get('file')
+    if upload is None or not upload.filename:
+        flash('Pilih file CSV atau JSONL untuk diimpor!', 'error')
+        return redirect(url_for('journal'))
+    
+    try:
+        stream = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+        with transaction() as tx:
+            def post():
+                summary = import_journals(tx, session['user_id'],
+                                          read_import_rows(stream, import_format(upload.filename)))
+                return {'message': f"Import berhasil: {summary['journals']} jurnal, {summary['lines']} baris "
+                                   f"(total {summary['total_debit']:,.2f})",
+                        'category': 'success'}
+            
+            result, _ = idempotent_post(tx, session['user_id'], post)
+        flash(result['message'], result['category'])
+    except JournalImportError as e:
+        # transaction() already rolled back
+        for line_no, message in e.errors[:10]:
+            flash(f'Baris {line_no}: {message}', 'error')
+        if len(e.errors) > 10:
+            flash(f'...dan {len(e.errors) - 10} error lainnya. Tidak ada data yang disimpan.', 'error')
+        else:
+            flash('Import dibatalkan, tidak ada data yang disimpan.', 'error')
+    except Exception as e:
+        print(f"Journal import error: {e}")
+        flash(f'Error mengimpor jurnal: {str(e)}', 'error')
+    return redirect(url_for('journal'))
+
+# ============ POSTING API ============
+# Entries accepted per request; larger batches go through import-journals
+API_MAX_ENTRIES = int(os.environ.get('API_MAX_ENTRIES', '5000'))
+
+def api_error(message, status):
+    return jsonify({'error': message}), status
+
+def api_key_hash(key):
+    """Only the SHA-256 of an API key is stored"""
+    return hashlib.sha256(key.encode()).hexdigest()
+
+def api_user_id():
+    """User of an API request: an `Authorization: Bearer <api key>` header, else the login session.
+
+    None when neither authenticates (an invalid key does not fall back to the session).
+    """
+    scheme, _, key = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer':
+        return session.get('user_id')
+    row = execute_query("SELECT user_id FROM api_keys WHERE key_hash = ?",
+                        (api_key_hash(key.strip()),), fetch=True)
+    return row[0]['user_id'] if row else None
+
+def api_unauthorized():
+    response = jsonify({'error': 'Login atau API key diperlukan'})
+    response.headers['WWW-Authenticate'] = 'Bearer'
+    return response, 401
+
+@app.cli.command('create-api-key')
+@click.option('--user', 'user_id', type=int, required=True, help='Key posts as this user')
+@click.option('--name', default='', help='Label to recognise the key by')
+def create_api_key_command(user_id, name):
+    """Create an API key for --user and print it (it cannot be shown again)."""
+    key = f"mh_{secrets.token_urlsafe(32)}"
+    with transaction() as tx:
+        if tx.fetch_one("SELECT id FROM users WHERE id = ?", (user_id,)) is None:
+            raise click.BadParameter(f'no user {user_id}', param_hint='--user')
+        tx.execute("INSERT INTO api_keys (user_id, name, key_hash) VALUES (?, ?, ?)",
+                   (user_id, name, api_key_hash(key)))
+    click.echo(key)
+
+@app.route('/api/journals', methods=['POST'])
+def api_post_journals():
+    """Post a batch of journal entries in one transaction.
+
+    Body: {"entries": [{"entry_no", "date", "description", "lines": [{"account_code",
+    "debit", "credit"}, ...]}, ...]} (or the bare list). Returns 201 with the new ids,
+    or 422 with every validation error; nothing is written unless all entries are valid.
+    With an Idempotency-Key header a retried batch returns the original response.
+    Authenticates with an API key (see create-api-key) or the login session; 401 otherwise.
+    """
+    user_id = api_user_id()
+    if user_id is None:
+        return api_unauthorized()
+    
+    payload = request.get_json(silent=True)
+    entries = payload.get('entries') if isinstance(payload, dict) else payload
+    if not isinstance(entries, list) or not entries:
+        return api_error('Body harus berisi daftar "entries"', 400)
+    if len(entries) > API_MAX_ENTRIES:
+        return api_error(f'Maksimal {API_MAX_ENTRIES} entri per request', 413)
+    for index, entry in enumerate(entries):
+        if (not isinstance(entry, dict) or not isinstance(entry.get('lines'), list) or not entry['lines']
+                or not all(isinstance(line, dict) for line in entry['lines'])):
+            return api_error(f'Entri {index} harus objek dengan "lines" berisi minimal satu baris', 400)
+    
+    def grouped():
+        for index, entry in enumerate(entries):
+            header = {key: entry.get(key) for key in ('entry_no', 'date', 'description')}
+            yield (str(entry.get('entry_no') or '').strip(),
+                   [((index, line_index), dict(line, **header)) for line_index, line in enumerate(entry['lines'])])
+    
+    try:
+        with transaction() as tx:
+            def post():
+                summary = post_journal_entries(tx, user_id, grouped())
+                ids = summary['ids']
+                return {
+                    'journals': [{'entry_no': entry_no, 'id': ids[entry_no]}
+                                 for entry_no in (str(entry['entry_no']).strip() for entry in entries)],
+                    'lines': summary['lines'],
+                    'total_debit': summary['total_debit'],
+                }
+            
+            result, replayed = idempotent_post(tx, user_id, post)
+    except JournalImportError as e:
+        return jsonify({'errors': [{'entry': entry, 'line': line, 'message': message}
+                                   for (entry, line), message in e.errors]}), 422
+    except IdempotencyConflict as e:
+        return api_error(str(e), 422)
+    except PeriodLocked as e:
+        return api_error(str(e), 409)
+    except Exception as e:
+        print(f"Journal API error: {e}")
+        return api_error(f'Error menyimpan jurnal: {str(e)}', 500)
+    
+    response = jsonify(result)
+    if replayed:
+        response.headers['Idempotent-Replayed'] = 'true'
+    return response, 201
+
 # ============ DELETE ROUTES ============
 
 @app.route('/delete_journal/<entry_no>', methods=['POST'])
@@ -2198,139 +3852,49 @@ def delete_journal(entry_no):
         return redirect(url_for('login'))
     
     try:
-        # Get journal ID first - GUNAKAN ? UNTUK SQLite
-        journal_result = execute_query(
-            "SELECT id FROM journals WHERE entry_no = ? AND user_id = ?",
-            (entry_no, session['user_id']),
-            fetch=True
-        )
-        
-        if journal_result and len(journal_result) > 0:
-            journal_id = journal_result[0]['id']
+        with transaction() as tx:
+            # Get journal ID first
+            journal_row = tx.fetch_one(
+                "SELECT id FROM journals WHERE entry_no = ? AND user_id = ?",
+                (entry_no, session['user_id'])
+            )
             
-            # Start transaction
-            execute_query("BEGIN", commit=True)
+            if journal_row is None:
+                flash('Jurnal tidak ditemukan!', 'error')
+                return redirect(url_for('journal'))
             
-            try:
-                # Get journal details untuk reverse saldo - GUNAKAN ?
-                details_result = execute_query(
-                    """SELECT jd.account_code, jd.debit, jd.credit 
-                       FROM journal_details jd 
-                       WHERE jd.journal_id = ?""",
-                    (journal_id,),
-                    fetch=True
-                )
-                
-                # Reverse saldo akun - GUNAKAN ?
-                if details_result:
-                    for detail in details_result:
-                        execute_query(
-                            """UPDATE accounts 
-                               SET balance = balance - ? + ?
-                               WHERE code = ? AND user_id = ?""",
-                            (detail['debit'], detail['credit'], 
-                             detail['account_code'], session['user_id']),
-                            commit=False
-                        )
-                
-                # Delete journal details - GUNAKAN ?
-                execute_query(
-                    "DELETE FROM journal_details WHERE journal_id = ?",
-                    (journal_id,),
-                    commit=False
-                )
-                
-                # Delete journal - GUNAKAN ?
-                execute_query(
-                    "DELETE FROM journals WHERE id = ?",
-                    (journal_id,),
-                    commit=False
-                )
-                
-                # Commit transaction
-                execute_query("COMMIT", commit=True)
-                flash('Jurnal berhasil dihapus!', 'success')
-                
-            except Exception as e:
-                # Rollback on error
-                execute_query("ROLLBACK", commit=True)
-                print(f"Delete journal transaction error: {e}")
-                flash(f'Error menghapus jurnal: {str(e)}', 'error')
-                
-        else:
-            flash('Jurnal tidak ditemukan!', 'error')
+            # Reverse saldo akun (grouped), then delete; details and cash documents cascade
+            delete_journals(tx, session['user_id'], [journal_row['id']])
+        
+        flash('Jurnal berhasil dihapus!', 'success')
             
     except Exception as e:
+        # transaction() already rolled back
         print(f"Delete journal error: {e}")
-        flash(f'Error: {str(e)}', 'error')
+        flash(f'Error menghapus jurnal: {str(e)}', 'error')
     
     return redirect(url_for('journal'))
 
-@app.route('/delete_adjusting_entry/<entry_no>')
+@app.route('/delete_adjusting_entry/<entry_no>', methods=['POST'])
 def delete_adjusting_entry(entry_no):
     if 'user_id' not in session:
         return redirect(url_for('login'))
     
     try:
-        # Start transaction
-        execute_query("BEGIN", commit=True)
-        
-        # 1. Ambil data entries sebelum dihapus untuk reverse saldo
-        entries = execute_query(
-            "SELECT account_code, debit, credit FROM adjusting_entries WHERE entry_no = ? AND user_id = ?",
-            (entry_no, session['user_id']),
-            fetch=True
-        )
-        
-        if entries:
-            # 2. Reverse saldo akun
-            for entry in entries:
-                reverse_success = execute_query(
-                    """UPDATE accounts 
-                       SET balance = balance - ? + ?
-                       WHERE code = ? AND user_id = ?""",
-                    (entry['debit'], entry['credit'], entry['account_code'], session['user_id']),
-                    commit=False
-                )
-                
-                if not reverse_success:
-                    execute_query("ROLLBACK", commit=True)
-                    flash(f'Error reverse saldo akun {entry["account_code"]}!', 'error')
-                    return redirect(url_for('adjusting'))
-        
-        # 3. Hapus entries
-        delete_entries_success = execute_query(
-            "DELETE FROM adjusting_entries WHERE entry_no = ? AND user_id = ?",
-            (entry_no, session['user_id']),
-            commit=False
-        )
+        with transaction() as tx:
+            # Reverse saldo akun, hapus entries dan header; refused in a closed period
+            deleted = delete_adjusting_journal(tx, session['user_id'], entry_no)
         
-        if not delete_entries_success:
-            execute_query("ROLLBACK", commit=True)
-            flash('Error menghapus detail jurnal!', 'error')
-            return redirect(url_for('adjusting'))
-        
-        # 4. Hapus journal header
-        delete_journal_success = execute_query(
-            "DELETE FROM adjusting_journals WHERE entry_no = ? AND user_id = ?",
-            (entry_no, session['user_id']),
-            commit=False
-        )
-        
-        if not delete_journal_success:
-            execute_query("ROLLBACK", commit=True)
-            flash('Error menghapus header jurnal!', 'error')
-            return redirect(url_for('adjusting'))
-        
-        # 5. Commit
-        commit_success = execute_query("COMMIT", commit=True)
-        if commit_success:
+        # Committed by transaction()
+        if deleted:
             flash('Jurnal penyesuaian berhasil dihapus!', 'success')
         else:
-            flash('Error commit transaksi penghapusan!', 'error')
+            flash('Jurnal penyesuaian tidak ditemukan!', 'error')
             
+    except PeriodLocked as e:
+        flash(str(e), 'error')
     except Exception as e:
-        execute_query("ROLLBACK", commit=True)
+        # transaction() already rolled back
         print(f"Delete adjusting error: {e}")
         flash(f'Error menghapus jurnal penyesuaian: {str(e)}', 'error')
     
@@ -2377,90 +3941,18 @@ def delete_cash_payment(payment_no):
         return redirect(url_for('login'))
     
     try:
-        # Get cash payment details first
-        payment_result = execute_query(
-            "SELECT id, amount FROM cash_payments WHERE payment_no = %s AND user_id = %s",
-            (payment_no, session['user_id']),
-            fetch=True
-        )
+        with transaction() as tx:
+            # Reverse saldo akun and delete the journal; its lines and the payment cascade
+            if not delete_cash_document(tx, session['user_id'], 'cash_payment', payment_no):
+                flash('Cash payment tidak ditemukan!', 'error')
+                return redirect(url_for('cash_payment'))
         
-        if payment_result and len(payment_result) > 0:
-            payment_id = payment_result[0]['id']
-            journal_entry_no = f"CP{payment_no}"
-            
-            # Start transaction
-            execute_query("BEGIN", commit=True)
-            
-            try:
-                # Get associated journal
-                journal_result = execute_query(
-                    "SELECT id FROM journals WHERE entry_no = %s AND user_id = %s",
-                    (journal_entry_no, session['user_id']),
-                    fetch=True
-                )
-                
-                # Delete journal entries if they exist
-                if journal_result and len(journal_result) > 0:
-                    journal_id = journal_result[0]['id']
-                    
-                    # Get journal details untuk reverse saldo
-                    details_result = execute_query(
-                        """SELECT jd.account_code, jd.debit, jd.credit 
-                           FROM journal_details jd 
-                           WHERE jd.journal_id = %s""",
-                        (journal_id,),
-                        fetch=True
-                    )
-                    
-                    # Reverse saldo akun
-                    if details_result:
-                        for detail in details_result:
-                            execute_query(
-                                """UPDATE accounts 
-                                   SET balance = balance - %s + %s
-                                   WHERE code = %s AND user_id = %s""",
-                                (detail['debit'], detail['credit'], 
-                                 detail['account_code'], session['user_id']),
-                                commit=False
-                            )
-                    
-                    # Delete journal details first
-                    execute_query(
-                        "DELETE FROM journal_details WHERE journal_id = %s",
-                        (journal_id,),
-                        commit=False
-                    )
-                    
-                    # Delete journal
-                    execute_query(
-                        "DELETE FROM journals WHERE id = %s",
-                        (journal_id,),
-                        commit=False
-                    )
-                
-                # Delete cash payment
-                execute_query(
-                    "DELETE FROM cash_payments WHERE id = %s",
-                    (payment_id,),
-                    commit=False
-                )
-                
-                # Commit transaction
-                execute_query("COMMIT", commit=True)
-                flash('Cash payment berhasil dihapus!', 'success')
-                
-            except Exception as e:
-                # Rollback on error
-                execute_query("ROLLBACK", commit=True)
-                print(f"Delete cash payment transaction error: {e}")
-                flash(f'Error menghapus cash payment: {str(e)}', 'error')
-                
-        else:
-            flash('Cash payment tidak ditemukan!', 'error')
+        flash('Cash payment berhasil dihapus!', 'success')
             
     except Exception as e:
+        # transaction() already rolled back
         print(f"Delete cash payment error: {e}")
-        flash(f'Error: {str(e)}', 'error')
+        flash(f'Error menghapus cash payment: {str(e)}', 'error')
     
     return redirect(url_for('cash_payment'))
 
@@ -2470,90 +3962,18 @@ def delete_cash_receipt(receipt_no):
         return redirect(url_for('login'))
     
     try:
-        # Get receipt data first
-        receipt_result = execute_query(
-            "SELECT id, amount FROM cash_receipts WHERE receipt_no = %s AND user_id = %s",
-            (receipt_no, session['user_id']),
-            fetch=True
-        )
+        with transaction() as tx:
+            # Reverse saldo akun and delete the journal; its lines and the receipt cascade
+            if not delete_cash_document(tx, session['user_id'], 'cash_receipt', receipt_no):
+                flash('Cash receipt tidak ditemukan!', 'error')
+                return redirect(url_for('cash_receipt'))
         
-        if receipt_result and len(receipt_result) > 0:
-            receipt_id = receipt_result[0]['id']
-            journal_entry_no = f"CR{receipt_no}"
-            
-            # Start transaction
-            execute_query("BEGIN", commit=True)
-            
-            try:
-                # Delete corresponding journal entries
-                journal_result = execute_query(
-                    "SELECT id FROM journals WHERE entry_no = %s AND user_id = %s",
-                    (journal_entry_no, session['user_id']),
-                    fetch=True
-                )
-                
-                # Delete journal entries if they exist
-                if journal_result and len(journal_result) > 0:
-                    journal_id = journal_result[0]['id']
-                    
-                    # Get journal details untuk reverse saldo
-                    details_result = execute_query(
-                        """SELECT jd.account_code, jd.debit, jd.credit 
-                           FROM journal_details jd 
-                           WHERE jd.journal_id = %s""",
-                        (journal_id,),
-                        fetch=True
-                    )
-                    
-                    # Reverse saldo akun
-                    if details_result:
-                        for detail in details_result:
-                            execute_query(
-                                """UPDATE accounts 
-                                   SET balance = balance - %s + %s
-                                   WHERE code = %s AND user_id = %s""",
-                                (detail['debit'], detail['credit'], 
-                                 detail['account_code'], session['user_id']),
-                                commit=False
-                            )
-                    
-                    # Delete journal details first
-                    execute_query(
-                        "DELETE FROM journal_details WHERE journal_id = %s",
-                        (journal_id,),
-                        commit=False
-                    )
-                    
-                    # Delete journal
-                    execute_query(
-                        "DELETE FROM journals WHERE id = %s",
-                        (journal_id,),
-                        commit=False
-                    )
-                
-                # Delete cash receipt
-                execute_query(
-                    "DELETE FROM cash_receipts WHERE id = %s",
-                    (receipt_id,),
-                    commit=False
-                )
-                
-                # Commit transaction
-                execute_query("COMMIT", commit=True)
-                flash('Cash receipt berhasil dihapus!', 'success')
-                
-            except Exception as e:
-                # Rollback on error
-                execute_query("ROLLBACK", commit=True)
-                print(f"Delete cash receipt transaction error: {e}")
-                flash(f'Error menghapus cash receipt: {str(e)}', 'error')
-                
-        else:
-            flash('Cash receipt tidak ditemukan!', 'error')
+        flash('Cash receipt berhasil dihapus!', 'success')
             
     except Exception as e:
+        # transaction() already rolled back
         print(f"Delete cash receipt error: {e}")
-        flash(f'Error: {str(e)}', 'error')
+        flash(f'Error menghapus cash receipt: {str(e)}', 'error')
     
     return redirect(url_for('cash_receipt'))
 
@@ -2564,7 +3984,7 @@ def delete_inventory(code):
     
     try:
         success = execute_query(
-            "DELETE FROM inventory WHERE code = %s AND user_id = %s",
+            "DELETE FROM inventory WHERE code = ? AND user_id = ?",
             (code, session['user_id']),
             commit=True
         )
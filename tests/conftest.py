@@ -0,0 +1,149 @@
+import os
+import sqlite3
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# app.py migrates money_hop_full.db in the working directory on import; keep that out of the checkout
+os.chdir(tempfile.mkdtemp(prefix='money_hop_tests_'))
+
+import app as money_hop  # noqa: E402
+
+
+def reset_pools():
+    """Forget the worker's pools so the next checkout opens the configured database"""
+    for pool in (money_hop._pool, money_hop._read_pool):
+        if pool is not None:
+            pool.close_all()
+    money_hop._pool = None
+    money_hop._read_pool = None
+    money_hop._coa_cache = None
+
+
+@pytest.fixture
+def blank_db(tmp_path, monkeypatch):
+    """Path of an empty SQLite file the app is pointed at (no migrations run yet)"""
+    path = str(tmp_path / 'money_hop_full.db')
+    monkeypatch.setitem(money_hop.app.config, 'DATABASE', path)
+    reset_pools()
+    yield path
+    reset_pools()
+
+
+@pytest.fixture
+def app_module(blank_db):
+    """The app module on a freshly migrated database"""
+    money_hop.run_migrations()
+    return money_hop
+
+
+@pytest.fixture
+def client(app_module):
+    """Test client logged in as user 1"""
+    client = app_module.app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = 1
+    return client
+
+
+@pytest.fixture
+def app_module_at_v4(blank_db, monkeypatch):
+    """The app module on a database migrated only up to schema version 4"""
+    with monkeypatch.context() as patch:
+        patch.setattr(money_hop, 'MIGRATIONS', [item for item in money_hop.MIGRATIONS if item[0] <= 4])
+        assert money_hop.run_migrations() == 4
+    return money_hop
+
+
+# Tables as the pre-migration init_db() created them on SQLite
+LEGACY_SQLITE_SCHEMA = """
+    CREATE TABLE users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT UNIQUE NOT NULL,
+        email TEXT UNIQUE,
+        password TEXT,
+        google_id TEXT UNIQUE,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE accounts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        code TEXT UNIQUE NOT NULL,
+        name TEXT NOT NULL,
+        type TEXT NOT NULL,
+        normal_balance TEXT NOT NULL
+    );
+    CREATE TABLE journals (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        entry_no TEXT UNIQUE NOT NULL,
+        date TEXT NOT NULL,
+        description TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    );
+    CREATE TABLE journal_details (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        journal_id INTEGER NOT NULL,
+        account_code TEXT NOT NULL,
+        debit REAL DEFAULT 0,
+        credit REAL DEFAULT 0,
+        FOREIGN KEY (journal_id) REFERENCES journals(id)
+    );
+    CREATE TABLE inventory (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        code TEXT UNIQUE NOT NULL,
+        name TEXT NOT NULL,
+        qty INTEGER DEFAULT 0,
+        price REAL DEFAULT 0,
+        user_id INTEGER NOT NULL,
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    );
+    CREATE TABLE cash_payments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        payment_no TEXT UNIQUE NOT NULL,
+        date TEXT NOT NULL,
+        description TEXT NOT NULL,
+        account_code TEXT NOT NULL,
+        amount REAL DEFAULT 0,
+        user_id INTEGER NOT NULL,
+        FOREIGN KEY (account_code) REFERENCES accounts(code),
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    );
+    CREATE TABLE cash_receipts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        receipt_no TEXT UNIQUE NOT NULL,
+        date TEXT NOT NULL,
+        description TEXT NOT NULL,
+        account_code TEXT NOT NULL,
+        amount REAL DEFAULT 0,
+        user_id INTEGER NOT NULL,
+        FOREIGN KEY (account_code) REFERENCES accounts(code),
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    );
+"""
+
+
+@pytest.fixture
+def legacy_db(blank_db):
+    """A database in the pre-migration schema with one user, two journals and a cash payment"""
+    with sqlite3.connect(blank_db) as conn:
+        conn.executescript(LEGACY_SQLITE_SCHEMA)
+        conn.execute("INSERT INTO users (id, username, password) VALUES (1, 'budi', 'x')")
+        conn.executemany("INSERT INTO accounts (code, name, type, normal_balance) VALUES (?, ?, ?, ?)",
+                         [('1-1000', 'Kas', 'Asset', 'Debit'), ('3-3000', 'Modal', 'Equity', 'Credit'),
+                          ('5-5100', 'Beban Sewa', 'Expense', 'Debit')])
+        for journal_id, entry_no, journal_date, lines in [
+            (1, 'J001', '2023-01-02', [('1-1000', 1000, 0), ('3-3000', 0, 1000)]),
+            (2, 'CP001', '2023-02-01', [('5-5100', 250, 0), ('1-1000', 0, 250)]),
+        ]:
+            conn.execute("INSERT INTO journals (id, entry_no, date, description, user_id) VALUES (?, ?, ?, ?, 1)",
+                         (journal_id, entry_no, journal_date, entry_no))
+            conn.executemany("INSERT INTO journal_details (journal_id, account_code, debit, credit) VALUES (?, ?, ?, ?)",
+                             [(journal_id,) + line for line in lines])
+        conn.execute("INSERT INTO cash_payments (payment_no, date, description, account_code, amount, user_id) "
+                     "VALUES ('001', '2023-02-01', 'Sewa', '5-5100', 250, 1)")
+    conn.close()
+    return blank_db
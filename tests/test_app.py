@@ -0,0 +1,500 @@
+import io
+import os
+import re
+import sqlite3
+import subprocess
+import sys
+
+import pytest
+
+from conftest import ROOT, money_hop, reset_pools
+
+
+def import_app(directory):
+    """Import app.py in a new interpreter with `directory` as the working directory (runs init_db)"""
+    result = subprocess.run([sys.executable, '-c', f'import sys; sys.path.insert(0, {ROOT!r}); import app'],
+                            cwd=directory, capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    assert 'Error initializing database' not in result.stdout, result.stdout
+    return result.stdout
+
+
+# ============ QUERY REGISTRY ============
+def test_prepare_query_rewrites_postgres_statements_once(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'use_postgres', lambda: True)
+    monkeypatch.setattr(app_module, '_postgres_sql', {})
+    query = "SELECT id FROM journals WHERE user_id = ? AND entry_no = ?"
+
+    prepared = app_module.prepare_query(query)
+
+    assert prepared == "SELECT id FROM journals WHERE user_id = %s AND entry_no = %s"
+    assert app_module.prepare_query(query) is prepared
+    assert app_module._postgres_sql == {query: prepared}
+
+
+def test_prepare_query_leaves_sqlite_statements_alone(app_module):
+    query = "SELECT id FROM journals WHERE user_id = ?"
+    assert app_module.prepare_query(query) is query
+
+
+def post(app_module, entry_no, journal_date, amount, user_id=1, debit='1-1000', credit='4-4000'):
+    """Post a two-line journal in its own transaction and return its id"""
+    with app_module.transaction() as tx:
+        return app_module.post_journal(tx, user_id, entry_no, journal_date, 'Test',
+                                       [(debit, amount, 0), (credit, 0, amount)])
+
+
+# ============ BALANCE SNAPSHOTS ============
+def test_backdated_posting_backfills_earlier_snapshots(app_module):
+    post(app_module, 'J001', '2024-05-10', 100)
+    post(app_module, 'J002', '2023-02-10', 40)
+
+    with app_module.transaction() as tx:
+        snapshots = {(row['period'], row['account_code']): row['debit_total'] for row in tx.fetch(
+            "SELECT period, account_code, debit_total FROM account_balance_snapshots WHERE user_id = 1")}
+    periods = sorted({period for period, _ in snapshots})
+    assert periods[:6] == ['2023-03', '2023-06', '2023-09', '2023-12', '2024-03', '2024-06']
+    assert snapshots[('2023-12', '1-1000')] == 40
+    assert snapshots[('2024-06', '1-1000')] == 140
+
+
+
+# ============ SCHEMA MIGRATIONS ============
+def test_import_upgrades_v4_database_with_journals(app_module_at_v4, blank_db):
+    """init_db() runs while app.py is still being imported, so upgrade in a fresh interpreter"""
+    with app_module_at_v4.transaction() as tx:
+        journal_id = tx.insert("INSERT INTO journals (entry_no, date, description, user_id) VALUES (?, ?, ?, ?)",
+                               ('J001', '2023-01-15', 'Modal awal', 1))
+        tx.insert_many('journal_details', ('journal_id', 'account_code', 'debit', 'credit'),
+                       [(journal_id, '1-1000', 500, 0), (journal_id, '3-3000', 0, 500)])
+    reset_pools()
+
+    import_app(os.path.dirname(blank_db))
+
+    with sqlite3.connect(blank_db) as conn:
+        assert conn.execute("SELECT MAX(version) FROM schema_version").fetchone()[0] == app_module_at_v4.MIGRATIONS[-1][0]
+        assert conn.execute("SELECT debit_total FROM account_balance_snapshots "
+                            "WHERE user_id = 1 AND account_code = '1-1000' AND period = '2023-03'").fetchone() == (500,)
+
+
+class RecordingTransaction:
+    """Stand-in for Transaction that records SQL for PostgreSQL-path checks (no server needed)"""
+
+    def __init__(self):
+        self.statements = []
+
+    def fetch_one(self, query, params=()):
+        self.statements.append((' '.join(query.split()), params))
+        return None
+
+
+def test_postgres_column_exists_only_looks_at_the_current_schema(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'use_postgres', lambda: True)
+    tx = RecordingTransaction()
+
+    assert app_module.column_exists(tx, 'journals', 'created_at') is False
+    (query, params), = tx.statements
+    assert 'table_schema = current_schema()' in query
+    assert params == ('journals', 'created_at')
+
+
+def close(app_module, period, user_id=1):
+    with app_module.transaction() as tx:
+        return app_module.close_books(tx, user_id, period)
+
+
+# ============ PERIOD CLOSING ============
+def test_adjusting_entries_respect_closed_periods(app_module):
+    with app_module.transaction() as tx:
+        app_module.post_adjusting_entry(tx, 1, 'AJ001', '2024-01-31', 'Penyusutan',
+                                        [('5-5300', 25, 0), ('1-1300', 0, 25)])
+    close(app_module, '2024-01')
+
+    with pytest.raises(app_module.PeriodLocked):
+        with app_module.transaction() as tx:
+            app_module.post_adjusting_entry(tx, 1, 'AJ002', '2024-01-15', 'Terlambat',
+                                            [('5-5300', 10, 0), ('1-1300', 0, 10)])
+    with pytest.raises(app_module.PeriodLocked):
+        with app_module.transaction() as tx:
+            app_module.delete_adjusting_journal(tx, 1, 'AJ001')
+
+    with app_module.transaction() as tx:
+        app_module.post_adjusting_entry(tx, 1, 'AJ002', '2024-02-01', 'Periode berikutnya',
+                                        [('5-5300', 10, 0), ('1-1300', 0, 10)])
+        assert [row['entry_no'] for row in tx.fetch(
+            "SELECT entry_no FROM adjusting_journals WHERE user_id = 1 ORDER BY entry_no")] == ['AJ001', 'AJ002']
+        assert app_module.delete_adjusting_journal(tx, 1, 'AJ002') is True
+
+
+def test_closing_rejects_a_malformed_period(client, app_module):
+    with pytest.raises(ValueError):
+        app_module.period_start('2024-1')
+
+    response = client.post('/closing_entries', data={'period': '2024-1'})
+
+    assert response.status_code == 302
+    assert flashes(client) == [('error', 'Periode harus berformat YYYY-MM!')]
+    with app_module.transaction() as tx:
+        assert tx.fetch("SELECT period FROM closed_periods") == []
+
+
+# ============ TEMPLATES ============
+def test_pager_macro(app_module):
+    pagination = app_module.app.jinja_env.get_template('pagination.html').module
+
+    first_page = str(pagination.pager('/journal', '/journal?before=abc', None))
+    assert 'href="/journal?before=abc"' in first_page and 'Terbaru' not in first_page
+    last_page = str(pagination.pager('/journal', None, 'abc'))
+    assert 'href="/journal"' in last_page and 'Lebih Lama' not in last_page
+    assert str(pagination.pager('/journal', None, None)).strip() == ''
+
+
+def test_adjusting_history_pages(client, app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'HISTORY_PAGE_SIZE', 1)
+    with app_module.transaction() as tx:
+        for entry_no, journal_date in [('AJ001', '2024-01-31'), ('AJ002', '2024-02-29')]:
+            app_module.post_adjusting_entry(tx, 1, entry_no, journal_date, 'Penyusutan',
+                                            [('5-5300', 10, 0), ('1-1300', 0, 10)])
+
+    first_page = client.get('/adjusting_entries').get_data(as_text=True)
+    assert 'AJ002' in first_page and 'AJ001' not in first_page
+    next_url = re.search(r'href="(/adjusting_entries\?before=[^"]+)"', first_page).group(1)
+
+    second_page = client.get(next_url).get_data(as_text=True)
+    assert 'AJ001' in second_page and 'AJ002' not in second_page
+    assert 'Terbaru' in second_page and 'Lebih Lama' not in second_page
+    assert 'action="/delete_adjusting_entry/AJ001"' in second_page
+
+    client.post('/delete_adjusting_entry/AJ001')
+    with app_module.transaction() as tx:
+        assert [row['entry_no'] for row in tx.fetch("SELECT entry_no FROM adjusting_journals")] == ['AJ002']
+
+
+def test_period_fields_macro(app_module):
+    period_filter = app_module.app.jinja_env.get_template('period_filter.html').module
+
+    fields = str(period_filter.period_fields('2024-01-01', '2024-03-31'))
+    assert 'name="from"' in fields and 'value="2024-01-01"' in fields and 'value="2024-03-31"' in fields
+    as_of = str(period_filter.period_fields(None, '2024-03-31', to_name='as_of', to_label='Per Tanggal', with_from=False))
+    assert 'name="from"' not in as_of and 'name="as_of"' in as_of
+
+
+# ============ EXPORT ============
+class FakePostgresCursor:
+    """psycopg2-like cursor: named (server-side) cursors refuse to run on an autocommit connection"""
+
+    def __init__(self, conn, name=None):
+        self.conn = conn
+        self.name = name
+        self.rows = []
+        self.description = None
+
+    def execute(self, query, params=()):
+        if self.name and self.conn.autocommit:
+            raise RuntimeError("can't use a named cursor outside of transactions")
+        if not self.conn.autocommit:
+            self.conn.status = 2
+        self.conn.statements.append(query)
+        if self.name:
+            self.rows = [(index, f'J{index:03d}') for index in range(5)]
+            self.description = [('id',), ('entry_no',)]
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def close(self):
+        pass
+
+
+class FakePostgresConnection:
+    def __init__(self):
+        # connect_postgres() hands out autocommit connections
+        self.autocommit = True
+        self.status = 0
+        self.statements = []
+
+    def cursor(self, name=None):
+        return FakePostgresCursor(self, name)
+
+    def rollback(self):
+        self.statements.append('ROLLBACK')
+        self.status = 0
+
+    def get_transaction_status(self):
+        return self.status
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def fake_postgres_pool(app_module, monkeypatch):
+    connections = []
+
+    def connect():
+        connections.append(FakePostgresConnection())
+        return connections[-1]
+
+    monkeypatch.setattr(app_module, 'use_postgres', lambda: True)
+    monkeypatch.setattr(app_module, '_pool', app_module.ConnectionPool(connect))
+    return connections
+
+
+def test_stream_query_holds_postgres_connection_in_a_transaction(app_module, fake_postgres_pool, monkeypatch):
+    monkeypatch.setattr(app_module, 'EXPORT_FETCH_SIZE', 2)
+
+    rows = list(app_module.stream_query('export_journal_lines', (1, '0001-01-01', '9999-12-31')))
+
+    assert [row['entry_no'] for row in rows] == ['J000', 'J001', 'J002', 'J003', 'J004']
+    conn, = fake_postgres_pool
+    assert conn.statements[0] == 'SET TRANSACTION READ ONLY'
+    assert conn.statements[-1] == 'ROLLBACK'
+    assert conn.autocommit is True
+
+
+def test_stream_query_restores_autocommit_when_the_client_disconnects(app_module, fake_postgres_pool):
+    stream = app_module.stream_query('export_journal_lines', (1, '0001-01-01', '9999-12-31'))
+    next(stream)
+    stream.close()
+
+    conn, = fake_postgres_pool
+    assert conn.autocommit is True and conn.status == 0
+    assert app_module.get_pool().statistics()['idle'] == 1
+
+
+# ============ IMPORT ============
+IMPORT_HEADER = 'entry_no,date,description,account_code,debit,credit\n'
+
+
+def run_import(app_module, tmp_path, body):
+    path = tmp_path / 'journals.csv'
+    path.write_text(IMPORT_HEADER + body)
+    return app_module.app.test_cli_runner().invoke(args=['import-journals', str(path), '--user', '1'])
+
+
+def test_import_normalises_non_padded_dates(app_module, tmp_path):
+    result = run_import(app_module, tmp_path, 'J001,2025-5-5,Setoran,1-1000,100,0\n'
+                                              'J001,2025-05-05,Setoran,3-3000,0,100\n')
+
+    assert result.exit_code == 0, result.output
+    with app_module.transaction() as tx:
+        assert tx.fetch_one("SELECT date FROM journals WHERE entry_no = 'J001'")['date'] == '2025-05-05'
+        assert tx.fetch_one("SELECT period FROM account_period_balances "
+                            "WHERE user_id = 1 AND account_code = '1-1000'")['period'] == '2025-05'
+
+
+def test_import_reports_non_padded_date_in_closed_period_as_row_error(app_module, tmp_path):
+    post(app_module, 'J001', '2024-01-10', 100)
+    close(app_module, '2024-01')
+
+    result = run_import(app_module, tmp_path, 'J002,2024-1-5,Terlambat,1-1000,10,0\n'
+                                              'J002,2024-1-5,Terlambat,4-4000,0,10\n')
+
+    assert result.exit_code == 1
+    assert result.exception is None or isinstance(result.exception, SystemExit)
+    assert 'line 2: Periode 2024-01 sudah ditutup' in result.output
+
+
+# ============ POSTING API ============
+def api_entry(entry_no, journal_date, amount=100):
+    return {'entry_no': entry_no, 'date': journal_date, 'description': 'API',
+            'lines': [{'account_code': '1-1000', 'debit': amount}, {'account_code': '4-4000', 'credit': amount}]}
+
+
+def test_api_posts_non_padded_date_as_iso(client, app_module):
+    response = client.post('/api/journals', json={'entries': [api_entry('J001', '2025-5-5')]})
+
+    assert response.status_code == 201, response.get_json()
+    with app_module.transaction() as tx:
+        assert tx.fetch_one("SELECT date FROM journals WHERE entry_no = 'J001'")['date'] == '2025-05-05'
+    assert app_module.verify_account_balances() == []
+
+
+def test_api_rejects_non_padded_date_in_closed_period(client, app_module):
+    post(app_module, 'J001', '2024-01-10', 100)
+    close(app_module, '2024-01')
+
+    response = client.post('/api/journals', json={'entries': [api_entry('J002', '2024-1-5')]})
+
+    assert response.status_code == 422
+    assert response.get_json()['errors'] == [{'entry': 0, 'line': 0, 'message': 'Periode 2024-01 sudah ditutup'}]
+
+
+def test_api_authenticates_with_an_api_key(app_module):
+    with app_module.transaction() as tx:
+        tx.execute("INSERT INTO users (id, username, password) VALUES (2, 'kasir', 'x')")
+    result = app_module.app.test_cli_runner().invoke(args=['create-api-key', '--user', '2', '--name', 'pos'])
+    assert result.exit_code == 0, result.output
+    key = result.output.strip()
+    api = app_module.app.test_client()
+
+    response = api.post('/api/journals', json={'entries': [api_entry('J001', '2025-05-05')]})
+    assert response.status_code == 401 and response.is_json
+    assert response.headers['WWW-Authenticate'] == 'Bearer'
+    response = api.post('/api/journals', json={'entries': [api_entry('J001', '2025-05-05')]},
+                        headers={'Authorization': 'Bearer mh_wrong'})
+    assert response.status_code == 401 and response.is_json
+
+    response = api.post('/api/journals', json={'entries': [api_entry('J001', '2025-05-05')]},
+                        headers={'Authorization': f'Bearer {key}'})
+    assert response.status_code == 201, response.get_json()
+    with app_module.transaction() as tx:
+        assert tx.fetch_one("SELECT user_id FROM journals WHERE entry_no = 'J001'")['user_id'] == 2
+        assert key not in {row['key_hash'] for row in tx.fetch("SELECT key_hash FROM api_keys")}
+
+
+# ============ IDEMPOTENCY ============
+def upload_journals(client, body, key):
+    return client.post('/import_journals', headers={'Idempotency-Key': key},
+                       data={'file': (io.BytesIO((IMPORT_HEADER + body).encode()), 'journals.csv')},
+                       content_type='multipart/form-data')
+
+
+def flashes(client):
+    with client.session_transaction() as session:
+        return session.pop('_flashes', [])
+
+
+def test_upload_retry_with_same_key_but_different_file_conflicts(client, app_module):
+    first = 'J001,2024-03-01,Setoran,1-1000,100,0\nJ001,2024-03-01,Setoran,3-3000,0,100\n'
+    second = 'J002,2024-03-02,Jasa,1-1000,40,0\nJ002,2024-03-02,Jasa,4-4000,0,40\n'
+
+    upload_journals(client, first, 'upload-1')
+    assert flashes(client)[0][0] == 'success'
+    upload_journals(client, first, 'upload-1')
+    assert flashes(client)[0][0] == 'success'
+    upload_journals(client, second, 'upload-1')
+    category, message = flashes(client)[0]
+
+    assert category == 'error' and 'upload-1' in message
+    with app_module.transaction() as tx:
+        assert [row['entry_no'] for row in tx.fetch("SELECT entry_no FROM journals")] == ['J001']
+
+
+# ============ JOURNAL WRITER ============
+def test_delete_unlinked_cash_document_removes_its_journal(app_module):
+    with app_module.transaction() as tx:
+        app_module.post_cash_document(tx, 1, 'cash_payment', '001', '2024-03-05', 'Sewa', '5-5100', 75)
+        app_module.post_cash_document(tx, 1, 'cash_payment', '002', '2024-03-06', 'Listrik', '5-5200', 20)
+        # As left by rows written before journal_id existed
+        tx.execute("UPDATE cash_payments SET journal_id = NULL")
+
+    with app_module.transaction() as tx:
+        assert app_module.delete_cash_document(tx, 1, 'cash_payment', '001') is True
+
+    with app_module.transaction() as tx:
+        assert [row['payment_no'] for row in tx.fetch("SELECT payment_no FROM cash_payments")] == ['002']
+        assert [row['entry_no'] for row in tx.fetch("SELECT entry_no FROM journals")] == ['CP002']
+        assert tx.fetch_one("SELECT row_count FROM document_sequences "
+                            "WHERE user_id = 1 AND doc_type = 'cash_payment'")['row_count'] == 1
+    assert app_module.verify_account_balances() == []
+
+
+def test_migrate_legacy_database(legacy_db):
+    app_module = money_hop
+    assert app_module.run_migrations() == app_module.MIGRATIONS[-1][0]
+
+    with app_module.transaction() as tx:
+        assert tx.fetch_one("PRAGMA foreign_keys")['foreign_keys'] == 1
+        assert [(row['table'], row['on_delete']) for row in tx.fetch("PRAGMA foreign_key_list(journal_details)")] \
+            == [('journals', 'CASCADE')]
+        assert tx.fetch_one("SELECT journal_id FROM cash_payments WHERE payment_no = '001'")['journal_id'] == 2
+        assert 'UNIQUE' not in tx.fetch_one("SELECT sql FROM sqlite_master WHERE name = 'cash_payments'")['sql']
+        assert tx.fetch_one("SELECT COUNT(*) as count FROM journal_details jd JOIN journals j ON j.id = jd.journal_id "
+                            "WHERE jd.user_id = j.user_id AND jd.date = j.date")['count'] \
+            == tx.fetch_one("SELECT COUNT(*) as count FROM journal_details")['count']
+    assert app_module.verify_account_balances() == []
+
+    with app_module.transaction() as tx:
+        assert app_module.delete_cash_document(tx, 1, 'cash_payment', '001') is True
+        assert tx.fetch_one("SELECT COUNT(*) as count FROM journal_details")['count'] == 2
+    assert app_module.verify_account_balances() == []
+
+
+def test_import_upgrades_legacy_database(legacy_db):
+    import_app(os.path.dirname(legacy_db))
+
+    with sqlite3.connect(legacy_db) as conn:
+        assert conn.execute("SELECT MAX(version) FROM schema_version").fetchone()[0] == money_hop.MIGRATIONS[-1][0]
+        assert conn.execute("SELECT COUNT(*) FROM account_balance_snapshots WHERE period = '2023-03'").fetchone()[0] == 3
+
+
+# ============ LEDGER ============
+def test_ledger_pages_read_the_account_side_index(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'HISTORY_PAGE_SIZE', 2)
+    with app_module.transaction() as tx:
+        for user_id in (1, 2):
+            for entry_no, journal_date in [('J001', '2024-01-05'), ('J002', '2024-01-20'), ('J003', '2024-02-03')]:
+                app_module.post_journal(tx, user_id, entry_no, journal_date, 'Penjualan',
+                                        [('1-1000', 100, 0), ('4-4000', 0, 100)])
+    close(app_module, '2024-01')
+    account = app_module.get_chart_of_accounts().get('4-4000')
+
+    with app_module.app.test_request_context('/ledger'):
+        opening, rows, next_cursor = app_module.ledger_page(1, account)
+    assert opening == 0.0 and [(row['entry_no'], row['balance']) for row in rows] == [('J001', 100), ('J002', 200)]
+    with app_module.app.test_request_context(f'/ledger?after={next_cursor}'):
+        _, rows, next_cursor = app_module.ledger_page(1, account)
+    # The closing journal's lines carry the closing date too
+    assert [(row['entry_no'], row['balance']) for row in rows] == [('CL2024-01', 0), ('J003', 100)]
+    assert next_cursor is None
+
+    with app_module.transaction() as tx:
+        plan = ' '.join(row['detail'] for row in tx.fetch(
+            'EXPLAIN QUERY PLAN ' + app_module.QUERIES['ledger_page'].direct_sql,
+            (0, 1, 1, '4-4000', '0001-01-01', '9999-12-31') + app_module.LEDGER_START + (3,)))
+    assert 'ix_journal_details_user_account_date' in plan and 'ix_journals_user_date_entry' not in plan
+
+
+# ============ DOCUMENT SEQUENCES ============
+def sequences(app_module):
+    with app_module.transaction() as tx:
+        return {row['doc_type']: (row['next_value'], row['row_count'])
+                for row in tx.fetch("SELECT doc_type, next_value, row_count FROM document_sequences WHERE user_id = 1")}
+
+
+def test_form_views_only_peek_at_the_next_number(client, app_module):
+    for url in ('/journal', '/journal', '/cash_payment', '/cash_receipt', '/adjusting_entries'):
+        client.get(url)
+
+    assert sequences(app_module) == {}
+    assert app_module.peek_document_number(1, 'journal') == ('J001', 0)
+
+
+def test_blank_numbers_are_reserved_when_posting(client, app_module):
+    post(app_module, None, '2024-03-01', 10)
+    post(app_module, 'J010', '2024-03-02', 10)
+    client.post('/journal', data={'entry_no': '', 'date': '2024-03-03', 'description': 'Form',
+                                  'account_code[]': ['1-1000', '4-4000'], 'debit[]': ['5', '0'], 'credit[]': ['0', '5']})
+    client.post('/cash_payment', data={'payment_no': '', 'date': '2024-03-04', 'description': 'Sewa',
+                                       'account_code': '5-5100', 'amount': '20'})
+
+    with app_module.transaction() as tx:
+        assert [row['entry_no'] for row in tx.fetch("SELECT entry_no FROM journals ORDER BY id")] \
+            == ['J001', 'J010', 'J011', 'CPCP001']
+        assert tx.fetch_one("SELECT payment_no FROM cash_payments")['payment_no'] == 'CP001'
+    assert sequences(app_module) == {'journal': (12, 4), 'cash_payment': (2, 1)}
+    assert app_module.peek_document_number(1, 'journal') == ('J012', 4)
+
+
+def test_cash_document_numbers_are_unique_per_user(app_module):
+    for user_id in (1, 2):
+        client = app_module.app.test_client()
+        with client.session_transaction() as session:
+            session['user_id'] = user_id
+        client.post('/cash_payment', data={'payment_no': '', 'date': '2024-03-04', 'description': 'Sewa',
+                                           'account_code': '5-5100', 'amount': '20'})
+        client.post('/cash_receipt', data={'receipt_no': '', 'date': '2024-03-05', 'description': 'Jasa',
+                                           'account_code': '4-4000', 'amount': '30'})
+
+    with app_module.transaction() as tx:
+        assert [(row['user_id'], row['payment_no']) for row in tx.fetch(
+            "SELECT user_id, payment_no FROM cash_payments ORDER BY user_id")] == [(1, 'CP001'), (2, 'CP001')]
+        assert [(row['user_id'], row['receipt_no']) for row in tx.fetch(
+            "SELECT user_id, receipt_no FROM cash_receipts ORDER BY user_id")] == [(1, 'CR001'), (2, 'CR001')]
+    assert app_module.peek_document_number(2, 'cash_payment') == ('CP002', 1)
+
+    with pytest.raises(Exception, match='UNIQUE'):
+        with app_module.transaction() as tx:
+            app_module.post_cash_document(tx, 2, 'cash_payment', 'CP001', '2024-03-06', 'Lagi', '5-5100', 5)